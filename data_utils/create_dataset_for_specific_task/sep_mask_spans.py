@@ -0,0 +1,56 @@
+from tqdm import tqdm
+PATH_PREFIX = '/home/ubuntu/omelnikov/spellchecker/'
+# PATH_PREFIX = '/Users/olegmelnikov/PycharmProjects/spellchecker/'
+
+
+# Same task as sep_mask_all_at_a_time, but target is only the words in place of masks:
+# noise - 'luk </s> foward </s> I <mask> <mask> to it', gt - 'look <sep> forward'
+def create_dataset_for_sep_mask_spans(noise_old: str, gt_old: str, noise_new: str, gt_new: str,
+                                      test_mode: bool = False, sep_token: str = '</s>', span_sep_token: str = '<sep>'):
+
+    with open(PATH_PREFIX + noise_old) as f:
+        with open(PATH_PREFIX + gt_old) as g:
+            with open(PATH_PREFIX + noise_new, 'w') as t:
+                with open(PATH_PREFIX + gt_new, 'w') as s:
+                    ttl = 0
+                    print_one_sample = True
+                    for i, j in tqdm(zip(f.readlines(), g.readlines())):
+                        if test_mode and ttl == 10:
+                            break
+                        ttl += 1
+                        words_noise, words_gt = i[:-1].split(' '), j[:-1].split(' ')
+                        if len(words_noise) == len(words_gt):
+                            was = False
+                            words_before_sep = []
+                            spans = []
+                            sent_with_masks = words_noise
+                            for ind in range(len(words_noise)):
+                                if words_noise[ind] != words_gt[ind] or (ind == len(words_noise) - 1 and not was):
+                                    was = True
+                                    words_before_sep.append(words_noise[ind])
+                                    spans.append(words_gt[ind])
+                                    sent_with_masks[ind] = '<mask>'
+                            text_noise = f' {sep_token} '.join(words_before_sep) + f' {sep_token} ' + \
+                                         ' '.join(sent_with_masks) + '\n'
+                            text_gt = f' {span_sep_token} '.join(spans) + '\n'
+                            if test_mode or print_one_sample:
+                                print(f'Text noise - |{text_noise}|')
+                                print(f'Text gt - |{text_gt}|')
+                                print()
+                                print_one_sample = False
+                            if not test_mode:
+                                t.write(text_noise)
+                                s.write(text_gt)
+
+
+def test():
+    create_dataset_for_sep_mask_spans('dataset/1blm/1blm.train.noise', 'dataset/1blm/1blm.train.gt',
+                                      'dataset/1blm/1blm.train.noise.sep_mask_spans',
+                                      'dataset/1blm/1blm.train.gt.sep_mask_spans')
+    create_dataset_for_sep_mask_spans('dataset/1blm/1blm.test.noise', 'dataset/1blm/1blm.test.gt',
+                                      'dataset/1blm/1blm.test.noise.sep_mask_spans',
+                                      'dataset/1blm/1blm.test.gt.sep_mask_spans')
+
+
+if __name__ == '__main__':
+    test()
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Tuple
 
 import syntok
 import syntok.segmenter
@@ -9,16 +9,23 @@ class SyntokTextTokenizer:
     _tokenizer = Tokenizer(emit_hyphen_or_underscore_sep=True, replace_not_contraction=False)
 
     def split_to_sentences(self, text: str) -> List[str]:
-        sentences: List[str] = []
+        return [text[start:end] for start, end in self.split_to_sentence_spans(text)]
+
+    def split_to_sentence_spans(self, text: str) -> List[Tuple[int, int]]:
+        # character intervals of sentences, whitespace between them isn't covered
+        spans: List[Tuple[int, int]] = []
         for par in syntok.segmenter.analyze(text):
             for sent in par:
                 sent_tokens = list(sent)
                 start, end = sent_tokens[0].offset, sent_tokens[-1].offset + len(sent_tokens[-1].value)
-                sentences.append(text[start:end])
-        return sentences
+                spans.append((start, end))
+        return spans
 
     def tokenize(self, text: str) -> List[str]:
         tokens: List[str] = []
         for token in self._tokenizer.tokenize(text):
             tokens.append(token.value)
         return tokens
+
+    def tokenize_with_offsets(self, text: str) -> List[Tuple[str, int]]:
+        return [(token.value, token.offset) for token in self._tokenizer.tokenize(text)]
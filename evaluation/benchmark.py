@@ -0,0 +1,169 @@
+import json
+import os
+import time
+from typing import Dict, List
+
+import torch
+from tqdm import tqdm
+
+from model.spellcheck_model import BartChecker, BartSepMaskAllChecker, DocumentChecker
+from model.detector import BaseDetector, HunspellDetector
+from model.candidator import HunspellCandidator
+from model.ranker import BaseRanker, MaskedLMRanker, BartSepMaskAllRanker, FeaturesMetaRanker, LightGBMRanker
+from model.decoding import copy_speculative_greedy
+from data_utils.utils import get_texts_from_file
+
+PATH_PREFIX = '/home/ubuntu/omelnikov/spellchecker/'
+
+
+def save_report(report: Dict, exp_save_dir: str = None, file_name: str = 'benchmark.json'):
+    if exp_save_dir is not None:
+        if not os.path.exists(exp_save_dir):
+            os.makedirs(exp_save_dir)
+        with open(exp_save_dir + file_name, 'w') as result_file:
+            json.dump(report, result_file, indent=4)
+    print(f'\nBenchmark report:\n{report}\n')
+
+
+def speculative_decoding_benchmark(checker: BartChecker, texts: List[str], exp_save_dir: str = None,
+                                   min_length: int = 5, max_length: int = 500) -> Dict:
+    # Compares greedy generate with input-copy speculative decoding: speed, tokens per decoder call, equality
+    greedy_time, speculative_time = 0.0, 0.0
+    tokens, decoder_calls, mismatches = 0, 0, 0
+
+    for text in tqdm(texts):
+        input_ids = checker.tokenizer([text], return_tensors='pt').to(checker.device)['input_ids']
+
+        start_time = time.time()
+        with torch.no_grad():
+            greedy_ids = checker.model.generate(input_ids, num_beams=1, min_length=min_length,
+                                                max_length=max_length)[0].tolist()
+        greedy_time += time.time() - start_time
+
+        start_time = time.time()
+        speculative_ids, calls = copy_speculative_greedy(checker.model, input_ids, min_length=min_length,
+                                                         max_length=max_length, draft_len=checker.draft_len)
+        speculative_time += time.time() - start_time
+
+        tokens += len(speculative_ids) - 1
+        decoder_calls += calls
+        mismatches += int(speculative_ids != greedy_ids)
+
+    report = {
+        'Model': str(checker),
+        'Sentences': len(texts),
+        'Tokens accepted per step': round(tokens / decoder_calls, 2) if decoder_calls > 0 else 0,
+        'Greedy time per sentence (ms)': round(greedy_time * 1000 / len(texts), 1),
+        'Speculative time per sentence (ms)': round(speculative_time * 1000 / len(texts), 1),
+        'Outputs different from greedy': mismatches,
+    }
+    save_report(report, exp_save_dir, 'speculative_decoding.json')
+    return report
+
+
+def document_benchmark(checker: DocumentChecker, texts: List[str], sentences_per_document: int = 100,
+                       exp_save_dir: str = None) -> Dict:
+    # Latency of document mode on documents glued from consecutive sentences (100 sentences ~ 5 pages)
+    documents = [' '.join(texts[i: i + sentences_per_document]) for i in range(0, len(texts), sentences_per_document)]
+    checker.sentences, checker.corrected_sentences = 0, 0
+
+    start_time = time.time()
+    checker.correct_strings(documents)
+    total_time = time.time() - start_time
+
+    report = {
+        'Model': str(checker),
+        'Documents': len(documents),
+        **checker.stats(),
+        'Time per document (ms)': round(total_time * 1000 / len(documents), 1),
+        'Time per corrected sentence (ms)': round(total_time * 1000 / max(checker.corrected_sentences, 1), 1),
+    }
+    save_report(report, exp_save_dir, 'document_mode.json')
+    return report
+
+
+def detector_scaling_benchmark(detector: BaseDetector, texts: List[str], sizes: List[int],
+                               exp_save_dir: str = None) -> Dict:
+    # Detection time of documents of growing size (in KB), time per KB should stay flat for linear scaling
+    report = {'Model': type(detector).__name__}
+    corpus = ' '.join(texts)
+    for size in sizes:
+        document = (corpus * (size * 1024 // max(len(corpus), 1) + 1))[: size * 1024]
+        start_time = time.time()
+        spells = detector.detect(document)
+        total_time = time.time() - start_time
+        report[f'{size} KB'] = {'Errors': len(spells), 'Time (ms)': round(total_time * 1000, 1),
+                                'Time per KB (ms)': round(total_time * 1000 / size, 2)}
+    save_report(report, exp_save_dir, 'detector_scaling.json')
+    return report
+
+
+def ranker_benchmark(rankers: Dict[str, BaseRanker], texts: List[str], exp_save_dir: str = None) -> Dict:
+    # Ranking time per error and per sentence with detection and candidates computed once and shared by all
+    # rankers; for rankers over features also time of the model alone, with features computed beforehand
+    detector, candidator = HunspellDetector(), HunspellCandidator()
+    inputs = []
+    for text in texts:
+        spelled_words = detector.detect(text)
+        inputs.append((text, spelled_words, candidator.get_candidates(text, spelled_words)))
+    num_errors = max(sum(len(spelled_words) for _, spelled_words, _ in inputs), 1)
+
+    inputs = [(text, spelled_words, candidates) for text, spelled_words, candidates in inputs
+              if len(spelled_words) > 0]
+    num_sentences = max(len(inputs), 1)
+
+    report = {'Errors': num_errors, 'Sentences with errors': len(inputs)}
+    for ranker_name, ranker in rankers.items():
+        start_time = time.time()
+        for text, spelled_words, candidates in inputs:
+            ranker.rank(text, spelled_words, candidates)
+        total_time = time.time() - start_time
+        report[ranker_name] = {
+            'Time per error (ms)': round(total_time * 1000 / num_errors, 2),
+            'Time per sentence (ms)': round(total_time * 1000 / num_sentences, 3),
+        }
+        if isinstance(ranker, FeaturesMetaRanker):
+            all_features = [ranker.features_collector.collect(spelled_words, candidates)
+                            for _, spelled_words, candidates in inputs]
+            start_time = time.time()
+            for features in all_features:
+                ranker.model.predict_best(features)
+            report[ranker_name]['Model time per sentence (ms)'] = \
+                round((time.time() - start_time) * 1000 / num_sentences, 3)
+    save_report(report, exp_save_dir, 'rankers.json')
+    return report
+
+
+if __name__ == '__main__':
+    texts_noise = get_texts_from_file(PATH_PREFIX + 'dataset/bea/bea500.noise')
+
+    # input-copy speculative decoding
+    checker = BartChecker(speculative=True)
+    checker.from_pretrained()
+    speculative_decoding_benchmark(checker, texts_noise, PATH_PREFIX + 'experiments/bart-speculative-decoding/')
+
+    # document mode of the sep-mask model
+    # sep_mask_checker = BartSepMaskAllChecker()
+    # sep_mask_checker.from_pretrained()
+    # document_benchmark(DocumentChecker(sep_mask_checker), texts_noise,
+    #                    exp_save_dir=PATH_PREFIX + 'experiments/sep-mask-document-mode/')
+
+    # detector scaling on long documents
+    # detector_scaling_benchmark(HunspellDetector(), texts_noise, sizes=[1, 4, 16, 64],
+    #                            exp_save_dir=PATH_PREFIX + 'experiments/hunspell-detector-scaling/')
+
+    # masked LM ranker against the sep-mask BART ranker
+    # ranker_benchmark({'mlm': MaskedLMRanker(),
+    #                   'sep-mask-bart': BartSepMaskAllRanker(PATH_PREFIX + 'training/checkpoints/bart-sep-mask_v1_3.pt')},
+    #                  texts_noise, exp_save_dir=PATH_PREFIX + 'experiments/rankers-speed/')
+
+    # LightGBM over cheap features against logistic regression over the same features, model time per sentence
+    # should stay under 1 ms
+    # cheap_features = ['levenshtein', 'keyboard_edit', 'unigram_freq', 'soundex_match', 'case_match', 'length_diff',
+    #                   'ngram_lm']
+    # lightgbm = FeaturesMetaRanker(PATH_PREFIX + 'model/ranking_utils/lightgbm_cheap_features_ranker.txt',
+    #                               features_names=cheap_features, ranker_class=LightGBMRanker)
+    # logreg = FeaturesMetaRanker(PATH_PREFIX + 'model/ranking_utils/cheap_features_ranker.pickle',
+    #                             features_names=cheap_features[:-1])
+    # ranker_benchmark({'lightgbm': lightgbm, 'logreg': logreg}, texts_noise,
+    #                  exp_save_dir=PATH_PREFIX + 'experiments/features-rankers-speed/')
@@ -1,6 +1,7 @@
 import json
 import datetime
 import os
+import time
 from tqdm import tqdm
 from model.spellcheck_model import *
 from data_utils.utils import get_texts_from_file
@@ -16,6 +17,7 @@ PATH_PREFIX = '/home/ubuntu/omelnikov/spellchecker/'
 def evaluate(model: SpellCheckModelBase, texts_gt: List[str], texts_noise: List[str], exp_save_dir: str = None) -> Dict:
     tp, fp_1, fp_2, tn, fn = 0, 0, 0, 0, 0
     broken_tokenization_cases = 0
+    correction_time = 0.0
     fp_1_examples, fp_2_examples, fn_examples = [], [], []
 
     # Prepare folder and file to save info
@@ -26,7 +28,9 @@ def evaluate(model: SpellCheckModelBase, texts_gt: List[str], texts_noise: List[
 
     # Iterating over all texts, comparing corrected version to gt
     for text_gt, text_noise in tqdm(zip(texts_gt, texts_noise), total=len(texts_gt)):
+        start_time = time.time()
         text_res = model.correct(text_noise)
+        correction_time += time.time() - start_time
         words_gt, words_noise, words_res = text_gt.split(' '), text_noise.split(' '), text_res.split(' ')
 
         # If tokenization not preserved, then do nothing
@@ -86,6 +90,7 @@ def evaluate(model: SpellCheckModelBase, texts_gt: List[str], texts_noise: List[
     f_0_5 = round((1 + 0.5 ** 2) * precision * recall / ((precision * 0.5 ** 2) + recall), 2) \
         if (precision > 0 or recall > 0) else 0
     broken_tokenization_cases = round(broken_tokenization_cases / len(texts_gt), 2)
+    time_per_sentence = round(correction_time * 1000 / len(texts_gt), 1)
 
     # Leave at most 3 random examples of each mistake
     sample = lambda array: random.sample(array, min(len(array), 3))
@@ -101,6 +106,7 @@ def evaluate(model: SpellCheckModelBase, texts_gt: List[str], texts_noise: List[
             'F_0_5': f_0_5,
             'Word-level accuracy': word_level_accuracy,
             'Broken tokenization cases': broken_tokenization_cases,
+            'Time per sentence (ms)': time_per_sentence,
         },
         'Mistakes examples': {
             'Wrong correction of real mistake': fp_2_examples,
@@ -203,6 +209,119 @@ def evaluate_ranker(model: DetectorCandidatorRanker, texts_gt: List[str], texts_
     return report
 
 
+def evaluate_detector(detector: BaseDetector, texts_gt: List[str], texts_noise: List[str],
+                      exp_save_dir: str = None) -> Dict:
+    # Word-level recall and precision of error detection, texts with different number of words are skipped
+    tp, fp, fn = 0, 0, 0
+
+    start_time = time.time()
+    all_spells = detector.detect_batch(texts_noise)
+    total_time = time.time() - start_time
+
+    for text_gt, text_noise, spells in zip(texts_gt, texts_noise, all_spells):
+        words_gt, words_noise = text_gt.split(' '), text_noise.split(' ')
+        if len(words_gt) != len(words_noise):
+            continue
+        cur_ind = 0
+        for word_gt, word_noise in zip(words_gt, words_noise):
+            cur_end = cur_ind + len(word_noise)
+            detected = any(spell.interval[0] < cur_end and cur_ind < spell.interval[1] for spell in spells)
+            if word_gt != word_noise:
+                tp += int(detected)
+                fn += int(not detected)
+            else:
+                fp += int(detected)
+            cur_ind = cur_end + 1
+
+    report = {
+        'Date': datetime.datetime.now().strftime("%d/%m/%Y %H:%M"),
+        'Model': type(detector).__name__,
+        'Metrics': {
+            'Recall': round(tp / (tp + fn), 4) if tp + fn > 0 else 0.0,
+            'Precision': round(tp / (tp + fp), 4) if tp + fp > 0 else 0.0,
+            'Time per sentence (ms)': round(total_time * 1000 / len(texts_noise), 1),
+        },
+    }
+    if hasattr(detector, 'stats'):
+        report['Metrics'].update(detector.stats())
+
+    if exp_save_dir is not None:
+        if not os.path.exists(exp_save_dir):
+            os.makedirs(exp_save_dir)
+        with open(exp_save_dir + 'detector_report.json', 'w') as result_file:
+            json.dump(report, result_file, indent=4)
+
+    print(f'\nDetector evaluation report:\n{report}\n')
+
+    return report
+
+
+def evaluate_cascade_gates(bert_detector: BERTDetector, texts_gt: List[str], texts_noise: List[str],
+                           rare_word_counts: List[Optional[int]], exp_save_dir: str = None) -> Dict:
+    # Detection recall against BERT invocation rate of CascadeDetector for rare-word gate thresholds
+    # (None - gate only on Hunspell errors)
+    tradeoff = {}
+    for rare_word_count in rare_word_counts:
+        gate_name = 'spells' if rare_word_count is None else f'rare_{rare_word_count}'
+        detector = CascadeDetector(bert_detector, rare_word_count=rare_word_count)
+        gate_save_dir = exp_save_dir + f'{gate_name}/' if exp_save_dir is not None else None
+        tradeoff[gate_name] = evaluate_detector(detector, texts_gt, texts_noise, gate_save_dir)['Metrics']
+
+    if exp_save_dir is not None:
+        with open(exp_save_dir + 'cascade_gates.json', 'w') as result_file:
+            json.dump(tradeoff, result_file, indent=4)
+
+    print(f'\nCascade gates tradeoff:\n{tradeoff}\n')
+
+    return tradeoff
+
+
+def evaluate_context_windows(model: SpellCheckModelBase, scorer: BartCandidatesScorer, texts_gt: List[str],
+                             texts_noise: List[str], windows: List[Optional[int]],
+                             exp_save_dir: str = None) -> Dict:
+    # Quality-latency tradeoff of ranking with only +-window words around each error (None means whole text)
+    tradeoff = {}
+    initial_window = scorer.context_window
+    for window in windows:
+        window_name = 'full' if window is None else str(window)
+        scorer.context_window = window
+        window_save_dir = exp_save_dir + f'window_{window_name}/' if exp_save_dir is not None else None
+        tradeoff[window_name] = evaluate(model, texts_gt, texts_noise, window_save_dir)['Metrics']
+    scorer.context_window = initial_window
+
+    if exp_save_dir is not None:
+        with open(exp_save_dir + 'context_windows.json', 'w') as result_file:
+            json.dump(tradeoff, result_file, indent=4)
+
+    print('\nContext window tradeoff:\n')
+    for window_name, metrics in tradeoff.items():
+        print(f'Window {window_name}: F_0_5 {metrics["F_0_5"]}, Time per sentence (ms) {metrics["Time per sentence (ms)"]}')
+
+    return tradeoff
+
+
+def evaluate_decoding_policies(model: SpellCheckModelBase, texts_gt: List[str], texts_noise: List[str],
+                               policies: Dict[str, DecodingPolicy], exp_save_dir: str = None) -> Dict:
+    # Quality-latency tradeoff of generate() settings, model must have decoding_policy attribute
+    tradeoff = {}
+    initial_policy = model.decoding_policy
+    for policy_name, policy in policies.items():
+        model.decoding_policy = policy
+        policy_save_dir = exp_save_dir + f'policy_{policy_name}/' if exp_save_dir is not None else None
+        tradeoff[policy_name] = evaluate(model, texts_gt, texts_noise, policy_save_dir)['Metrics']
+    model.decoding_policy = initial_policy
+
+    if exp_save_dir is not None:
+        with open(exp_save_dir + 'decoding_policies.json', 'w') as result_file:
+            json.dump(tradeoff, result_file, indent=4)
+
+    print('\nDecoding policy tradeoff:\n')
+    for policy_name, metrics in tradeoff.items():
+        print(f'Policy {policy_name}: F_0_5 {metrics["F_0_5"]}, Time per sentence (ms) {metrics["Time per sentence (ms)"]}')
+
+    return tradeoff
+
+
 def evaluation_test():
     d_model = 256
     checkpoint = 'training/model_big_0_9.pt'
@@ -259,6 +378,51 @@ if __name__ == '__main__':
     # model = DetectorCandidatorRanker()
     # evaluate_ranker(model, texts_gt, texts_noise, PATH_PREFIX + 'experiments/3-stage-oldbart-ranker/')
 
+    # detector candidator ranker replaying detections and candidates stored by model/stage_store.py
+    # from model.stage_store import StageStore, StoredDetector, StoredCandidator
+    # store = StageStore(PATH_PREFIX + 'dataset/stage_store/bea60k_hunspell.arrow')
+    # model = DetectorCandidatorRanker(detector=StoredDetector(store), candidator=StoredCandidator(store))
+    # evaluate_ranker(model, texts_gt, texts_noise, PATH_PREFIX + 'experiments/3-stage-stored-stages-ranker/')
+
+    # context window of the ranker on bea500
+    # texts_gt, texts_noise = get_texts_from_file(PATH_PREFIX + 'dataset/bea/bea500.gt'), \
+    #                         get_texts_from_file(PATH_PREFIX + 'dataset/bea/bea500.noise')
+    # checker = DCR()
+    # checker.from_pretrained()
+    # evaluate_context_windows(checker, checker.scorer, texts_gt, texts_noise, windows=[None, 16, 8, 4, 2],
+    #                          exp_save_dir=PATH_PREFIX + 'experiments/dcr-context-windows/')
+
+    # detection recall against BERT invocation rate on bea500
+    # bert_detector = BERTDetector()
+    # evaluate_detector(HunspellDetector(), texts_gt, texts_noise, PATH_PREFIX + 'experiments/detector-hunspell/')
+    # evaluate_detector(bert_detector, texts_gt, texts_noise, PATH_PREFIX + 'experiments/detector-bert/')
+    # evaluate_detector(CascadeDetector(bert_detector), texts_gt, texts_noise,
+    #                   PATH_PREFIX + 'experiments/detector-cascade-rare-words/')
+    # evaluate_cascade_gates(bert_detector, texts_gt, texts_noise, rare_word_counts=[None, 1, 5, 20, 100],
+    #                        exp_save_dir=PATH_PREFIX + 'experiments/detector-cascade-gates/')
+    # evaluate_detector(CascadeDetector(bert_detector, max_words=25, rare_word_count=None), texts_gt, texts_noise,
+    #                   PATH_PREFIX + 'experiments/detector-cascade-spells-length/')
+    # evaluate_detector(TinyDetector(PATH_PREFIX + 'training/checkpoints/tiny-detector_v0_2.pt'), texts_gt,
+    #                   texts_noise, PATH_PREFIX + 'experiments/detector-tiny/')
+
+    # tag and pick against sep-mask on bea500: F_0_5 and Time per sentence (ms) in both reports
+    # evaluate(TagAndPickChecker(PATH_PREFIX + 'training/checkpoints/tag-and-pick_v0_1.pt'), texts_gt, texts_noise,
+    #          PATH_PREFIX + 'experiments/tag-and-pick/')
+    # sep_mask_checker = BartSepMaskAllChecker()
+    # sep_mask_checker.from_pretrained()
+    # evaluate(sep_mask_checker, texts_gt, texts_noise, PATH_PREFIX + 'experiments/sep-mask-bea500/')
+
+    # decoding policies of the sep-mask model on bea500
+    # checker = BartSepMaskAllChecker()
+    # checker.from_pretrained()
+    # policies = {
+    #     'fixed': DecodingPolicy(),
+    #     'by_errors': DecodingPolicy(max_length_ratio=1.5, beams_by_errors=[(1, 1), (3, 2)], early_stopping=True),
+    #     'greedy': DecodingPolicy(num_beams=1, max_length_ratio=1.5),
+    # }
+    # evaluate_decoding_policies(checker, texts_gt, texts_noise, policies,
+    #                            exp_save_dir=PATH_PREFIX + 'experiments/sep-mask-decoding-policies/')
+
     # bert bart 214056 1236504
     # model_name = 'bart-sep-mask-all-sent_v0_214056'
     # checkpoint = f'training/checkpoints/{model_name}'
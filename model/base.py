@@ -1,4 +1,5 @@
-from typing import Tuple
+from abc import ABC, abstractmethod
+from typing import List, Tuple
 import attr
 
 
@@ -10,3 +11,10 @@ class SpelledWord:
 
     def __attrs_post_init__(self):
         self.word = self.text[self.interval[0]:self.interval[1]]
+
+
+class CandidatesScorer(ABC):
+    # score of every candidate in place of its spelled word, higher is better
+    @abstractmethod
+    def score(self, spelled_words: List[SpelledWord], candidates: List[List[str]]) -> List[List[float]]:
+        raise NotImplementedError
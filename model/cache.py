@@ -0,0 +1,211 @@
+import hashlib
+import pickle
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+from model.base import SpelledWord
+
+
+def hash_key(*parts: str) -> bytes:
+    # compact fixed-size key, so long contexts don't stay in memory
+    return hashlib.md5('\x00'.join(parts).encode('utf-8')).digest()
+
+
+def approx_size(obj: Any) -> int:
+    if isinstance(obj, (tuple, list)):
+        return sys.getsizeof(obj) + sum(approx_size(item) for item in obj)
+    return sys.getsizeof(obj)
+
+
+class LRUCache:
+    def __init__(self, max_size: int = 100000, ttl: Optional[float] = None, max_memory: Optional[int] = None):
+        # ttl in seconds, max_memory in bytes (approximate size of keys and values)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_memory = max_memory
+        # key -> (value, expiration time, size)
+        self._data: OrderedDict = OrderedDict()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data and not self._expired(key)
+
+    def _expired(self, key: Hashable) -> bool:
+        expiration_time = self._data[key][1]
+        return expiration_time is not None and expiration_time < time.time()
+
+    def _remove(self, key: Hashable):
+        self.memory -= self._data.pop(key)[2]
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key in self._data and self._expired(key):
+            self._remove(key)
+            self.expirations += 1
+        if key not in self._data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return self._data[key][0]
+
+    def put(self, key: Hashable, value: Any):
+        if key in self._data:
+            self._remove(key)
+        expiration_time = time.time() + self.ttl if self.ttl is not None else None
+        size = approx_size(key) + approx_size(value) if self.max_memory is not None else 0
+        self._data[key] = (value, expiration_time, size)
+        self.memory += size
+        self._shrink()
+
+    def _shrink(self):
+        while len(self._data) > self.max_size or (self.max_memory is not None and self.memory > self.max_memory):
+            self.memory -= self._data.popitem(last=False)[1][2]
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+        self.memory = 0
+
+    def stats(self) -> Dict[str, float]:
+        requests = self.hits + self.misses
+        return {
+            'Size': len(self._data),
+            'Memory': self.memory,
+            'Hits': self.hits,
+            'Misses': self.misses,
+            'Hit rate': round(self.hits / requests, 4) if requests > 0 else 0.0,
+            'Evictions': self.evictions,
+            'Expirations': self.expirations,
+        }
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            pickle.dump(self._data, f)
+
+    def load(self, path: str):
+        with open(path, 'rb') as f:
+            self._data = pickle.load(f)
+        self.memory = sum(entry[2] for entry in self._data.values())
+        self._shrink()
+
+
+class CorrectionsMemo:
+    """
+    Memo of misspellings with one correction regardless of context ("recieve" -> "receive").
+    A correction is trusted once it was chosen in at least min_contexts distinct contexts and at least
+    min_agreement share of all observed contexts of the word. Observations come online from the ranker
+    (observe) or from a parallel corpus (fit_from_parallel_texts).
+    """
+
+    def __init__(self, min_contexts: int = 3, min_agreement: float = 1.0, context_size: int = 2,
+                 learn_online: bool = True, max_contexts: int = 100):
+        self.min_contexts = min_contexts
+        self.min_agreement = min_agreement
+        self.context_size = context_size
+        self.learn_online = learn_online
+        self.max_contexts = max_contexts
+        # word -> correction -> hashes of distinct contexts (at most max_contexts of them)
+        self._observations: Dict[str, Dict[str, Set[bytes]]] = {}
+        self._blocked: Set[str] = set()
+        self.hits = 0
+        self.misses = 0
+
+    def context_key(self, spelled_word: SpelledWord) -> bytes:
+        text, start, finish = spelled_word.text, spelled_word.interval[0], spelled_word.interval[1]
+        left = text[:start].split()[-self.context_size:] if self.context_size > 0 else []
+        right = text[finish:].split()[:self.context_size]
+        return hash_key(*left, '<w>', *right)
+
+    def add(self, word: str, correction: str, context: bytes):
+        if word in self._blocked or len(correction) == 0:
+            return
+        contexts = self._observations.setdefault(word, {}).setdefault(correction, set())
+        if len(contexts) < self.max_contexts:
+            contexts.add(context)
+
+    def observe(self, spelled_word: SpelledWord, correction: str):
+        self.add(spelled_word.word, correction, self.context_key(spelled_word))
+
+    def confidence(self, word: str) -> Dict[str, int]:
+        # number of distinct contexts per correction of the word
+        return {correction: len(contexts) for correction, contexts in self._observations.get(word, {}).items()}
+
+    def _trusted_correction(self, word: str) -> Optional[str]:
+        counts = self.confidence(word)
+        if word in self._blocked or len(counts) == 0:
+            return None
+        correction, count = max(counts.items(), key=lambda item: item[1])
+        if count >= self.min_contexts and count >= self.min_agreement * sum(counts.values()):
+            return correction
+        return None
+
+    def lookup(self, word: str) -> Optional[str]:
+        correction = self._trusted_correction(word)
+        if correction is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return correction
+
+    def invalidate(self, word: str, block: bool = False):
+        # forget the word; blocked words are never learnt again
+        self._observations.pop(word, None)
+        if block:
+            self._blocked.add(word)
+
+    def split(self, spelled_words: List[SpelledWord]) -> Tuple[List[SpelledWord], List[SpelledWord], List[str]]:
+        # (words which need ranking, words corrected by memo, their corrections)
+        to_rank, memo_words, memo_corrections = [], [], []
+        for spelled_word in spelled_words:
+            correction = self.lookup(spelled_word.word)
+            if correction is None:
+                to_rank.append(spelled_word)
+            else:
+                memo_words.append(spelled_word)
+                memo_corrections.append(correction)
+        return to_rank, memo_words, memo_corrections
+
+    @staticmethod
+    def merge(spelled_words: List[SpelledWord], candidates: List[List[str]], corrections: List[str],
+              memo_words: List[SpelledWord], memo_corrections: List[str]):
+        merged = sorted(zip(spelled_words + memo_words, candidates + [[c] for c in memo_corrections],
+                            corrections + memo_corrections), key=lambda item: item[0].interval[0])
+        return [item[0] for item in merged], [item[1] for item in merged], [item[2] for item in merged]
+
+    def fit_from_parallel_texts(self, texts_noise: List[str], texts_gt: List[str]):
+        for text_noise, text_gt in zip(texts_noise, texts_gt):
+            words_noise, words_gt = text_noise.split(' '), text_gt.split(' ')
+            if len(words_noise) != len(words_gt):
+                continue
+            cur_shift = 0
+            for word_noise, word_gt in zip(words_noise, words_gt):
+                if word_noise != word_gt:
+                    self.observe(SpelledWord(text_noise, (cur_shift, cur_shift + len(word_noise))), word_gt)
+                cur_shift += len(word_noise) + 1
+
+    def stats(self) -> Dict[str, float]:
+        requests = self.hits + self.misses
+        return {
+            'Words': len(self._observations),
+            'Trusted words': sum(1 for word in self._observations if self._trusted_correction(word) is not None),
+            'Hits': self.hits,
+            'Misses': self.misses,
+            'Hit rate': round(self.hits / requests, 4) if requests > 0 else 0.0,
+        }
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            pickle.dump((self._observations, self._blocked), f)
+
+    def load(self, path: str):
+        with open(path, 'rb') as f:
+            self._observations, self._blocked = pickle.load(f)
@@ -0,0 +1,208 @@
+from typing import Dict, List, Optional, Tuple
+
+import attr
+import torch
+from transformers import BartForConditionalGeneration
+from transformers import LogitsProcessorList, MinLengthLogitsProcessor, NoRepeatNGramLogitsProcessor, \
+    ForcedBOSTokenLogitsProcessor, ForcedEOSTokenLogitsProcessor
+
+
+@attr.s(auto_attribs=True)
+class DecodingPolicy:
+    """
+    generate() settings chosen per input. Defaults are the fixed settings the checkers always used.
+    max_length_ratio: max_length = ratio * input tokens + max_length_extra (capped by max_length).
+    beams_by_errors / beams_by_length: (upper bound, num_beams) pairs checked in order, the first one with
+    detected errors (input tokens) not above the bound wins, otherwise num_beams is used.
+    early_stopping: passed to beam search, None keeps the model config value.
+    """
+    num_beams: int = 5
+    min_length: int = 5
+    max_length: int = 500
+    max_length_ratio: Optional[float] = None
+    max_length_extra: int = 10
+    beams_by_errors: List[Tuple[int, int]] = attr.ib(factory=list)
+    beams_by_length: List[Tuple[int, int]] = attr.ib(factory=list)
+    early_stopping: Optional[bool] = None
+
+    def get_num_beams(self, input_len: int, num_errors: Optional[int] = None) -> int:
+        if num_errors is not None:
+            for max_errors, num_beams in self.beams_by_errors:
+                if num_errors <= max_errors:
+                    return num_beams
+        for max_input_len, num_beams in self.beams_by_length:
+            if input_len <= max_input_len:
+                return num_beams
+        return self.num_beams
+
+    def get_max_length(self, input_len: int) -> int:
+        if self.max_length_ratio is None:
+            return self.max_length
+        return min(self.max_length, int(self.max_length_ratio * input_len) + self.max_length_extra)
+
+    def generate_kwargs(self, input_len: int, num_errors: Optional[int] = None) -> Dict:
+        num_beams = self.get_num_beams(input_len, num_errors)
+        max_length = self.get_max_length(input_len)
+        kwargs = {'num_beams': num_beams, 'min_length': min(self.min_length, max_length), 'max_length': max_length}
+        if num_beams > 1 and self.early_stopping is not None:
+            kwargs['early_stopping'] = self.early_stopping
+        return kwargs
+
+
+def greedy_logits_processors(model: BartForConditionalGeneration, min_length: int,
+                             max_length: int) -> LogitsProcessorList:
+    # the processors model.generate applies in greedy mode for BART configs
+    config = model.config
+    processors = LogitsProcessorList()
+    if config.no_repeat_ngram_size is not None and config.no_repeat_ngram_size > 0:
+        processors.append(NoRepeatNGramLogitsProcessor(config.no_repeat_ngram_size))
+    if min_length is not None and min_length > -1:
+        processors.append(MinLengthLogitsProcessor(min_length, config.eos_token_id))
+    if config.forced_bos_token_id is not None:
+        processors.append(ForcedBOSTokenLogitsProcessor(config.forced_bos_token_id))
+    if config.forced_eos_token_id is not None:
+        processors.append(ForcedEOSTokenLogitsProcessor(max_length, config.forced_eos_token_id))
+    return processors
+
+
+def copy_draft(draft: List[int], output: List[int], draft_len: int, ngram: int = 3) -> List[int]:
+    # Prompt lookup: find the last generated n-gram in the input and propose the tokens which follow it there.
+    # Output is shifted by the decoder start token, so occurrences near len(output) are preferred.
+    for n in range(min(ngram, len(output)), 0, -1):
+        pattern = output[-n:]
+        expected_start = len(output) - 1 - n
+        starts = sorted(range(len(draft) - n), key=lambda start: abs(start - expected_start))
+        for start in starts:
+            if draft[start: start + n] == pattern:
+                return draft[start + n: start + n + draft_len]
+    return []
+
+
+def trim_past_key_values(past_key_values, length: int):
+    # BART cache per layer: (self-attn key, self-attn value, cross-attn key, cross-attn value)
+    return tuple((layer[0][:, :, :length], layer[1][:, :, :length]) + tuple(layer[2:]) for layer in past_key_values)
+
+
+def copy_speculative_greedy(model: BartForConditionalGeneration, input_ids: torch.Tensor, min_length: int = 5,
+                            max_length: int = 500, draft_len: int = 10) -> Tuple[List[int], int]:
+    """
+    Greedy decoding which uses the input tokens as a draft: a run of copied tokens is verified with one
+    decoder forward, and the model's own token is taken from the first disagreement. Every emitted token is
+    the greedy argmax, so the result is the same as model.generate(num_beams=1). Batch size must be 1.
+    Returns output ids and number of decoder calls.
+    """
+    processors = greedy_logits_processors(model, min_length, max_length)
+    eos_token_id = model.config.eos_token_id
+    draft = input_ids[0].tolist()
+    output = [model.config.decoder_start_token_id]
+    past_key_values = None
+    decoder_calls = 0
+
+    with torch.no_grad():
+        encoder_outputs = model.get_encoder()(input_ids=input_ids, return_dict=True)
+        while len(output) < max_length:
+            proposal = copy_draft(draft, output, draft_len)[: max_length - len(output) - 1]
+            # the last emitted token isn't in the cache yet
+            block = output[-1:] + proposal
+            result = model(encoder_outputs=encoder_outputs, past_key_values=past_key_values, use_cache=True,
+                           decoder_input_ids=torch.tensor([block], device=input_ids.device), return_dict=True)
+            decoder_calls += 1
+
+            new_tokens = []
+            for k in range(len(proposal) + 1):
+                prefix = torch.tensor([output + proposal[:k]], device=input_ids.device)
+                scores = processors(prefix, result.logits[:, k, :].clone())
+                next_token = scores.argmax(dim=-1).item()
+                new_tokens.append(next_token)
+                if k == len(proposal) or next_token != proposal[k] or next_token == eos_token_id:
+                    break
+
+            output += new_tokens
+            if output[-1] == eos_token_id:
+                break
+            past_key_values = trim_past_key_values(result.past_key_values, len(output) - 1)
+
+    return output, decoder_calls
+
+
+class TokenTrie:
+    def __init__(self):
+        self.children = {}
+        self.is_end = False
+
+    def add(self, token_ids: List[int]):
+        node = self
+        for token_id in token_ids:
+            node = node.children.setdefault(token_id, TokenTrie())
+        node.is_end = True
+
+
+class CopyConstraint:
+    """
+    prefix_allowed_tokens_fn for generate: the output must be the input text with every masked word replaced
+    by one of its candidates. Segments between masks are copied token by token, at a mask any path of the
+    candidates' token trie is allowed. Decoder prefix is assumed to start with decoder start token and BOS.
+    """
+
+    def __init__(self, segments: List[TokenTrie], bos_token_id: int, eos_token_id: int):
+        self.segments = segments
+        self.bos_token_id = bos_token_id
+        self.eos_token_id = eos_token_id
+        # decoder prefix -> states (segment index, trie node); beams share prefixes, so states are built incrementally
+        self._states: Dict[Tuple[int, ...], List[Tuple[int, TokenTrie]]] = {}
+
+    @classmethod
+    def from_spells(cls, tokenizer, text: str, intervals: List[Tuple[int, int]],
+                    candidates: List[List[str]]) -> 'CopyConstraint':
+        # A space before a masked word goes to the candidate (' word' is one BPE token), so segments are
+        # tokenized the same way as in the whole text
+        segments, prev_finish = [], 0
+        for (start, finish), cands in zip(intervals, candidates):
+            prefix = text[prev_finish: start]
+            space = ' ' if prefix.endswith(' ') else ''
+            segments.append(cls._fixed_segment(tokenizer, prefix[: len(prefix) - len(space)]))
+            trie = TokenTrie()
+            for cand in cands:
+                trie.add(tokenizer.encode(space + cand, add_special_tokens=False))
+            segments.append(trie)
+            prev_finish = finish
+        segments.append(cls._fixed_segment(tokenizer, text[prev_finish:]))
+        return cls(segments, tokenizer.bos_token_id, tokenizer.eos_token_id)
+
+    @staticmethod
+    def _fixed_segment(tokenizer, text: str) -> TokenTrie:
+        trie = TokenTrie()
+        trie.add(tokenizer.encode(text, add_special_tokens=False) if len(text) > 0 else [])
+        return trie
+
+    def _closure(self, states: List[Tuple[int, TokenTrie]]) -> List[Tuple[int, TokenTrie]]:
+        # finished segment continues with the root of the next one
+        result, i = list(states), 0
+        while i < len(result):
+            segment_idx, node = result[i]
+            if node.is_end and segment_idx + 1 < len(self.segments):
+                result.append((segment_idx + 1, self.segments[segment_idx + 1]))
+            i += 1
+        return result
+
+    def _get_states(self, prefix: Tuple[int, ...]) -> List[Tuple[int, TokenTrie]]:
+        if len(prefix) == 0:
+            return self._closure([(0, self.segments[0])])
+        if prefix not in self._states:
+            self._states[prefix] = [(segment_idx, node.children[prefix[-1]])
+                                    for segment_idx, node in self._get_states(prefix[:-1])
+                                    if prefix[-1] in node.children]
+            self._states[prefix] = self._closure(self._states[prefix])
+        return self._states[prefix]
+
+    def __call__(self, batch_id: int, input_ids: torch.Tensor) -> List[int]:
+        decoded = input_ids.tolist()
+        if len(decoded) < 2:
+            return [self.bos_token_id]
+        states = self._get_states(tuple(decoded[2:]))
+        allowed = set()
+        for segment_idx, node in states:
+            allowed.update(node.children.keys())
+            if node.is_end and segment_idx == len(self.segments) - 1:
+                allowed.add(self.eos_token_id)
+        return list(allowed) if len(allowed) > 0 else [self.eos_token_id]
@@ -1,6 +1,7 @@
 import re
+import string
 from abc import ABC, abstractmethod
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 
 import nltk
 from nltk.corpus import words as nltk_words
@@ -8,6 +9,8 @@ from nltk.corpus import words as nltk_words
 from hunspell import Hunspell
 
 from model.base import SpelledWord
+from model.ranking_utils.ngram_lm import HashedNgramLM, ngram_hash
+from model.tiny_tagger import TinyTagger, encode_words
 from data_utils.tokenizer import SyntokTextTokenizer
 from transformers import AutoTokenizer
 from transformers import AutoModelForTokenClassification
@@ -25,6 +28,9 @@ class BaseDetector(ABC):
     def detect(self, text: str, **kwargs) -> List[SpelledWord]:
         raise NotImplementedError
 
+    def detect_batch(self, texts: List[str], **kwargs) -> List[List[SpelledWord]]:
+        return [self.detect(text, **kwargs) for text in texts]
+
 
 class IdealDetector(BaseDetector):
     def detect(self, text: str, **kwargs) -> List[SpelledWord]:
@@ -45,64 +51,125 @@ class IdealDetector(BaseDetector):
 
 
 class BERTDetector(BaseDetector):
-    def __init__(self, threshold: float = 0.5):
+    def __init__(self, threshold: float = 0.5,
+                 model_checkpoint: str = '/home/ubuntu/omelnikov/spellchecker/training/checkpoints/BERT-detector-2-epochs',
+                 batch_size: int = 32):
         super().__init__()
         # model_checkpoint = '/home/ubuntu/omelnikov/distilbert-base-uncased-finetuned-tagging/checkpoint-124500'\
-        model_checkpoint = '/home/ubuntu/omelnikov/spellchecker/training/checkpoints/BERT-detector-2-epochs'
         self.model = AutoModelForTokenClassification.from_pretrained(model_checkpoint, num_labels=2)
 
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model = self.model.to(self.device)
+        self.model.eval()
         tokenizer_checkpoint = "distilbert-base-uncased"
         self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_checkpoint)
         self.threshold = threshold
+        self.batch_size = batch_size
 
-    def detect(self, text: str, **kwargs) -> List[SpelledWord]:
-
-        word_tokens = nltk.word_tokenize(text)
-        tokenized_inputs = self.tokenizer(word_tokens, truncation=True, is_split_into_words=True,
-                                          return_tensors='pt').to(self.device)["input_ids"]
-        result = self.model(tokenized_inputs)
-        # labels = torch.argmax(result.logits, dim=2).to('cpu').tolist()[0]
-        labels_threshold = torch.softmax(result.logits.to('cpu')[0], dim=1)[:, 1] > self.threshold
-
-        tokenized_input = self.tokenizer(word_tokens, is_split_into_words=True)
-        word_ids = tokenized_input.word_ids()
-
-        # DEBUG
-        # print('Word ids:', word_ids)
-        # print('Logits:', result.logits.to('cpu'))
-        # print('Probs:', torch.softmax(result.logits.to('cpu')[0], dim=1))
-        # print('Diffs:', torch.softmax(result.logits.to('cpu')[0], dim=1)[:, 1] > threshold)
-        # print('Labels:', labels)
-        # print()
+    @staticmethod
+    def word_spans(text: str, word_tokens: List[str]) -> List[Tuple[int, int]]:
+        spans, offset = [], 0
+        for token in word_tokens:
+            offset = text.find(token, offset)
+            spans.append((offset, offset + len(token)))
+            offset += len(token)
+        return spans
+
+    def _forward(self, words_batch: List[List[str]]) -> Tuple[torch.Tensor, torch.Tensor]:
+        # error probabilities of subwords [batch, len] and their word ids (-1 for special and padding tokens)
+        encoding = self.tokenizer(words_batch, truncation=True, is_split_into_words=True, padding=True,
+                                  return_tensors='pt')
+        word_ids = torch.tensor([[-1 if word_id is None else word_id for word_id in encoding.word_ids(batch_index=i)]
+                                 for i in range(len(words_batch))], device=self.device)
+        with torch.no_grad():
+            logits = self.model(input_ids=encoding['input_ids'].to(self.device),
+                                attention_mask=encoding['attention_mask'].to(self.device)).logits
+        return torch.softmax(logits, dim=-1)[:, :, 1], word_ids
+
+    def _word_batches(self, texts: List[str]):
+        # (indices of texts, their nltk words) for batches of non-empty texts
+        words = [nltk.word_tokenize(text) for text in texts]
+        indices = [i for i in range(len(texts)) if len(words[i]) > 0]
+        for batch_start in range(0, len(indices), self.batch_size):
+            batch_indices = indices[batch_start: batch_start + self.batch_size]
+            yield batch_indices, [words[i] for i in batch_indices]
 
-        intervals = []
+    def detect(self, text: str, **kwargs) -> List[SpelledWord]:
+        return self.detect_batch([text])[0]
+
+    def detect_batch(self, texts: List[str], **kwargs) -> List[List[SpelledWord]]:
+        results: List[List[SpelledWord]] = [[] for _ in texts]
+        for batch_indices, words_batch in self._word_batches(texts):
+            probs, word_ids = self._forward(words_batch)
+            # word is spelled if any of its subwords is above the threshold
+            flags = (probs > self.threshold) & (word_ids >= 0)
+            rows = torch.arange(len(words_batch), device=self.device).unsqueeze(1).expand_as(word_ids)
+            word_flags = torch.zeros(len(words_batch), max(len(words) for words in words_batch), dtype=torch.long,
+                                     device=self.device)
+            word_flags.index_put_((rows[flags], word_ids[flags]), torch.ones_like(word_ids[flags]), accumulate=True)
+
+            spans = {}
+            for row, word_idx in word_flags.gt(0).nonzero().tolist():
+                text = texts[batch_indices[row]]
+                if row not in spans:
+                    spans[row] = self.word_spans(text, words_batch[row])
+                results[batch_indices[row]].append(SpelledWord(text, spans[row][word_idx]))
+
+        return results
+
+    def word_probs(self, texts: List[str]) -> List[List[float]]:
+        # error probability of every nltk word, taken from its first subword as in training (bert_tagger.py);
+        # words cut by truncation get 0
+        results: List[List[float]] = [[] for _ in texts]
+        for batch_indices, words_batch in self._word_batches(texts):
+            probs, word_ids = self._forward(words_batch)
+            first_subword = word_ids >= 0
+            first_subword[:, 1:] &= word_ids[:, 1:] != word_ids[:, :-1]
+            rows = torch.arange(len(words_batch), device=self.device).unsqueeze(1).expand_as(word_ids)
+            word_probs = torch.zeros(len(words_batch), max(len(words) for words in words_batch), device=self.device)
+            word_probs[rows[first_subword], word_ids[first_subword]] = probs[first_subword]
+
+            for row, row_probs in enumerate(word_probs.tolist()):
+                results[batch_indices[row]] = row_probs[: len(words_batch[row])]
+
+        return results
+
+
+class TinyDetector(BaseDetector):
+    # char CNN + BiLSTM tagger distilled from BERTDetector (training/tiny_detector_distil.py), words are nltk ones
+    def __init__(self, checkpoint: str = '/home/ubuntu/omelnikov/spellchecker/training/checkpoints/tiny-detector.pt',
+                 threshold: float = 0.5, device: torch.device = torch.device('cpu'), model: Optional[TinyTagger] = None):
+        super().__init__()
+        self.device = device
+        self.model = model.to(device) if model is not None else TinyTagger.load(checkpoint, device)
+        self.model.eval()
+        self.threshold = threshold
 
-        def spans(txt):
-            tokens = nltk.word_tokenize(txt)
-            offset = 0
-            for token in tokens:
-                offset = txt.find(token, offset)
-                yield offset, offset + len(token)
-                offset += len(token)
+    def detect(self, text: str, **kwargs) -> List[SpelledWord]:
+        return self.detect_batch([text])[0]
 
-        word_spans = list(spans(text))
+    def word_probs(self, words_batch: List[List[str]]) -> torch.Tensor:
+        # error probabilities [batch, words], 0 for padding words
+        char_ids, mask = encode_words(words_batch, self.model.max_word_len)
+        with torch.no_grad():
+            return torch.sigmoid(self.model(char_ids.to(self.device), mask.to(self.device)))
 
-        final_labels = [0 for i in word_tokens]
-        for ind in range(len(labels_threshold)):
-            if labels_threshold[ind]:
-                final_labels[word_ids[ind]] = 1
+    def detect_batch(self, texts: List[str], **kwargs) -> List[List[SpelledWord]]:
+        if len(texts) == 0:
+            return []
+        words_batch = [nltk.word_tokenize(text) for text in texts]
+        probs = self.word_probs(words_batch)
 
-        for ind, i in enumerate(final_labels):
-            if i == 1:
-                intervals.append(SpelledWord(text, word_spans[ind]))
+        results: List[List[SpelledWord]] = [[] for _ in texts]
+        spans = {}
+        for row, word_idx in (probs > self.threshold).nonzero().tolist():
+            if row not in spans:
+                spans[row] = BERTDetector.word_spans(texts[row], words_batch[row])
+            results[row].append(SpelledWord(texts[row], spans[row][word_idx]))
+        return results
 
-        # DEBUG
-        # print(f'Final labels:', final_labels)
-        # print(f'Intervals:', intervals)
 
-        return intervals
+CONTRACTION_SUFFIXES = ["'re", "'ve", "'s", "'t", "n't", "'d"]
 
 
 class WordBaseDetector(BaseDetector):
@@ -111,34 +178,18 @@ class WordBaseDetector(BaseDetector):
         self._tokenizer = SyntokTextTokenizer()
 
     def detect(self, text: str, **kwargs) -> List[SpelledWord]:
-        fict_text = text
         intervals = []
-        words = self._tokenizer.tokenize(text)
-
-        # single quote handle
-        real_words = []
-        for i, word in enumerate(words):
-            if i < len(words) - 1 and words[i + 1] in ["'re", "'ve", "'s", "'t", "n't", "'d"]:
-                real_words.append(word + words[i + 1])
+        tokens = self._tokenizer.tokenize_with_offsets(text)
+
+        for i, (word, start) in enumerate(tokens):
+            finish = start + len(word)
+            # single quote handle: contraction is merged with the word right before it
+            if i < len(tokens) - 1 and tokens[i + 1][0] in CONTRACTION_SUFFIXES and tokens[i + 1][1] == finish:
+                finish += len(tokens[i + 1][0])
+            elif word in CONTRACTION_SUFFIXES:
                 continue
-            if word in ["'re", "'ve", "'s", "'t", "n't", "'d"]:
-                continue
-            real_words.append(word)
-        words = real_words
-
-        # Тут тоже только первое вхождение ошибки - Fixed
-        cur_shift = 0
-        for i, word in enumerate(words):
-            start = fict_text.find(word, cur_shift)
-            if self.is_spelled(word):
-                finish = start + len(word)
-                assert fict_text[start:finish] == word
-                # mark this occurrence of word
-                gap = ''.join('#' for ind in range(start, finish))
-                fict_text = fict_text[:start] + gap + fict_text[finish:]
+            if self.is_spelled(text[start:finish]):
                 intervals.append(SpelledWord(text, (start, finish)))
-            cur_shift += len(word)
-            cur_shift = max(cur_shift, start + len(word))
 
         return intervals
 
@@ -180,6 +231,71 @@ class HunspellDetector(WordBaseDetector):
         return spelled
 
 
+class CascadeDetector(BaseDetector):
+    """
+    Hunspell runs on every text, BERT only on texts which the cheap gate marks as risky: Hunspell found errors,
+    text is longer than max_words words, it has a word outside frequent_words, or a word seen less than
+    rare_word_count times in the unigram counts of the n-gram LM (rare words are where real-word errors which
+    Hunspell accepts hide). BERT errors which don't overlap Hunspell ones are added to the result.
+    """
+
+    def __init__(self, bert_detector: BERTDetector = None, hunspell_detector: HunspellDetector = None,
+                 gate_on_spells: bool = True, max_words: Optional[int] = None,
+                 frequent_words: Optional[Set[str]] = None, rare_word_count: Optional[int] = 5,
+                 unigram_lm_path: str = '/home/ubuntu/omelnikov/spellchecker/model/ranking_utils/ngram_lm_3/'):
+        super().__init__()
+        self.hunspell_detector = hunspell_detector if hunspell_detector is not None else HunspellDetector()
+        self.bert_detector = bert_detector if bert_detector is not None else BERTDetector()
+        self.gate_on_spells = gate_on_spells
+        self.max_words = max_words
+        self.frequent_words = frequent_words
+        self.rare_word_count = rare_word_count
+        # only the memory-mapped unigram counts are read
+        self.unigram_lm = HashedNgramLM.load(unigram_lm_path) if rare_word_count is not None else None
+        self.texts = 0
+        self.bert_texts = 0
+
+    def is_risky(self, text: str, spells: List[SpelledWord]) -> bool:
+        if self.gate_on_spells and len(spells) > 0:
+            return True
+        words = text.split()
+        if self.max_words is not None and len(words) > self.max_words:
+            return True
+        words = [word.lower() for word in (word.strip(string.punctuation) for word in words) if self.is_word(word)]
+        if self.frequent_words is not None and any(word not in self.frequent_words for word in words):
+            return True
+        if self.unigram_lm is not None and len(words) > 0:
+            hashes = [ngram_hash([word], self.unigram_lm.num_buckets) for word in words]
+            return bool((self.unigram_lm.counts[1][hashes] < self.rare_word_count).any())
+        return False
+
+    def detect(self, text: str, **kwargs) -> List[SpelledWord]:
+        return self.detect_batch([text])[0]
+
+    def detect_batch(self, texts: List[str], **kwargs) -> List[List[SpelledWord]]:
+        results = self.hunspell_detector.detect_batch(texts)
+        risky = [i for i, text in enumerate(texts) if self.is_risky(text, results[i])]
+        self.texts += len(texts)
+        self.bert_texts += len(risky)
+
+        for i, bert_spells in zip(risky, self.bert_detector.detect_batch([texts[i] for i in risky])):
+            spells = results[i] + [bert_spell for bert_spell in bert_spells
+                                   if not any(self._overlap(bert_spell, spell) for spell in results[i])]
+            results[i] = sorted(spells, key=lambda spell: spell.interval[0])
+        return results
+
+    @staticmethod
+    def _overlap(first: SpelledWord, second: SpelledWord) -> bool:
+        return first.interval[0] < second.interval[1] and second.interval[0] < first.interval[1]
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'Texts': self.texts,
+            'BERT texts': self.bert_texts,
+            'BERT rate': round(self.bert_texts / self.texts, 4) if self.texts > 0 else 0.0,
+        }
+
+
 def test():
     bert_detector = BERTDetector()
     sent = 'Hello we arre th company of frineds'
@@ -187,6 +303,19 @@ def test():
     bert_detector.detect(sent)
 
 
+def tiny_detector_test():
+    # a sentence gets the same probabilities and detections alone and padded inside a batch
+    detector = TinyDetector(model=TinyTagger(), threshold=0.5)
+    texts = ['Hello we arre th company of frineds', 'Thx', 'This sentense is much longer than the first one of the batch']
+    words_batch = [nltk.word_tokenize(text) for text in texts]
+    batch_probs = detector.word_probs(words_batch)
+    for row, (text, words) in enumerate(zip(texts, words_batch)):
+        alone_probs = detector.word_probs([words])[0]
+        assert torch.allclose(alone_probs, batch_probs[row, :len(words)], atol=1e-6), text
+        assert detector.detect_batch([text]) == [detector.detect_batch(texts)[row]], text
+    assert detector.detect_batch([]) == []
+
+
 if __name__ == '__main__':
     test()
     # h = HunspellDetector()
@@ -0,0 +1,71 @@
+from typing import Dict, List, Tuple
+
+import torch
+from torch import nn
+from transformers import BartConfig, BartForConditionalGeneration, BartTokenizer
+from transformers.modeling_outputs import BaseModelOutput
+
+
+class BartForJointDetectionCorrection(BartForConditionalGeneration):
+    """
+    End-to-end BART with a token classification head on the encoder. One encoder pass gives both error tags of
+    the input tokens and the hidden states which the decoder attends to, so detection needs no separate model.
+    """
+
+    def __init__(self, config: BartConfig, detection_loss_weight: float = 1.0):
+        super().__init__(config)
+        self.detection_head = nn.Linear(config.d_model, 2)
+        self.detection_loss_weight = detection_loss_weight
+
+    def detect_tokens(self, input_ids: torch.Tensor,
+                      attention_mask: torch.Tensor = None) -> Tuple[BaseModelOutput, torch.Tensor]:
+        # encoder outputs and error logits of input tokens [batch, len, 2]
+        encoder_outputs = self.get_encoder()(input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+        return encoder_outputs, self.detection_head(encoder_outputs.last_hidden_state)
+
+    def forward(self, *args, detection_labels: torch.Tensor = None, **kwargs):
+        if detection_labels is None:
+            return super().forward(*args, **kwargs)
+
+        # training call, inputs are passed as keyword arguments
+        encoder_outputs, detection_logits = self.detect_tokens(kwargs['input_ids'], kwargs.get('attention_mask'))
+        result = super().forward(encoder_outputs=encoder_outputs, **kwargs)
+        detection_loss = nn.functional.cross_entropy(detection_logits.view(-1, 2), detection_labels.view(-1),
+                                                     ignore_index=-100)
+        if result.loss is not None:
+            result.loss = result.loss + self.detection_loss_weight * detection_loss
+        else:
+            result.loss = self.detection_loss_weight * detection_loss
+        return result
+
+
+def detection_token_labels(tokenizer: BartTokenizer, text_noise: str, text_gt: str,
+                           max_length: int = 1024) -> Tuple[List[int], List[int]]:
+    # input ids of the noised text built word by word and their labels: 1 for tokens of changed words,
+    # -100 for special tokens and for texts where number of words changed
+    words_noise, words_gt = text_noise.split(' '), text_gt.split(' ')
+    aligned = len(words_noise) == len(words_gt)
+    input_ids, labels = [tokenizer.bos_token_id], [-100]
+    for idx, word_noise in enumerate(words_noise):
+        word_ids = tokenizer.encode(word_noise if idx == 0 else ' ' + word_noise, add_special_tokens=False)
+        input_ids += word_ids
+        labels += [int(word_noise != words_gt[idx]) if aligned else -100] * len(word_ids)
+    input_ids, labels = input_ids[:max_length - 1] + [tokenizer.eos_token_id], labels[:max_length - 1] + [-100]
+    return input_ids, labels
+
+
+def encode_joint_batch(tokenizer: BartTokenizer, prefix: List[str], suffix: List[str],
+                       device: torch.device) -> Dict[str, torch.Tensor]:
+    # model kwargs for training: noised texts with detection labels, gt texts as decoder labels
+    encoded = [detection_token_labels(tokenizer, text_noise, text_gt) for text_noise, text_gt in zip(prefix, suffix)]
+    max_len = max(len(input_ids) for input_ids, _ in encoded)
+    input_ids = torch.tensor([ids + [tokenizer.pad_token_id] * (max_len - len(ids)) for ids, _ in encoded])
+    attention_mask = torch.tensor([[1] * len(ids) + [0] * (max_len - len(ids)) for ids, _ in encoded])
+    detection_labels = torch.tensor([labels + [-100] * (max_len - len(labels)) for _, labels in encoded])
+    decoder_input = tokenizer(suffix, return_tensors='pt', padding=True)
+    return {
+        'input_ids': input_ids.to(device),
+        'attention_mask': attention_mask.to(device),
+        'detection_labels': detection_labels.to(device),
+        'labels': decoder_input['input_ids'].to(device),
+    }
@@ -1,14 +1,16 @@
 from abc import ABC, abstractmethod
-from model.base import SpelledWord
-from typing import List, Dict
+from model.base import CandidatesScorer, SpelledWord
+from typing import List, Dict, Callable, Optional, Tuple, Type
 import torch
 from transformers import BartForConditionalGeneration, BartTokenizer
 from model.candidator import HunspellCandidator
 from model.detector import HunspellDetector
-from model.ranking_utils.ranker_over_features import LogisticRegressionRanker
-import math
+from model.ranking_utils.ranker_over_features import LightGBMRanker, LogisticRegressionRanker, Ranker
 from model.ranking_utils.features_collector import FeaturesCollector
 from model.ranking_utils.ranker_over_features import RankQuery, RankVariant
+from model.cache import LRUCache, hash_key
+from model.ranking_utils.mlm_scorer import MaskedLMScorer
+from model.ranking_utils.ngram_lm import HashedNgramLM
 PATH_PREFIX = '/home/ubuntu/omelnikov/spellchecker/'
 
 
@@ -18,67 +20,136 @@ class BaseRanker(ABC):
         raise NotImplementedError
 
 
-class BartRanker(BaseRanker):
-    def __init__(self, checkpoint_path: str = 'facebook/bart-base', device: torch.device = None):
-        self.device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.model = BartForConditionalGeneration.from_pretrained(checkpoint_path).to(self.device)
-        self.tokenizer = BartTokenizer.from_pretrained(checkpoint_path)
-        self.model.eval()
+def is_separate_word(spelled_word: SpelledWord) -> bool:
+    # space or start_of_text in the begin and end_of_text or not alpha after phrase
+    text, start, finish = spelled_word.text, spelled_word.interval[0], spelled_word.interval[1]
+    return (start == 0 or text[start - 1] == ' ') and (finish == len(text) or not text[finish].isalpha())
 
-    def rank(self, text: str, spelled_words: List[SpelledWord], candidates: List[List[str]], **kwargs) -> List[str]:
-        texts = []
-        outs = []
-        texts_inds = []
-        cands_ranges = []
-        all_candidates = []
-        for i, (spelled_word, cands) in enumerate(zip(spelled_words, candidates)):
-            text, start, finish = spelled_word.text, spelled_word.interval[0], spelled_word.interval[1]
-            text_start = text[: start]
-            # remove if it is not separate phrase (space or start_of_text in the begin and end_of_text or not alpha after phrase
-            if (start == 0 or text[start - 1] == ' ') and (finish == len(text) or not text[finish].isalpha()):
-                all_candidates += cands
-                texts_inds += [i for _ in cands]
 
-                input_text = text[:start] + '<mask>' + text[finish:]
-                texts += [input_text for _ in cands]
+# Encoder inputs for different BART tasks, built from (spelled word, text before it, text after it)
+def mask_input_format(word: str, text_pref: str, text_suff: str) -> str:
+    return text_pref + '<mask>' + text_suff
+
+
+def sep_mask_input_format(word: str, text_pref: str, text_suff: str) -> str:
+    return word + ' </s> ' + text_pref + '<mask>' + text_suff
+
 
-                output_texts = [text_start + syn + text[finish:] for syn in cands]
-                outs += output_texts
+def plain_input_format(word: str, text_pref: str, text_suff: str) -> str:
+    return text_pref + word + text_suff
 
-                cands_ranges += [(len(self.tokenizer.encode(text_start[:-1])),
-                                  len(self.tokenizer.encode(syn, add_special_tokens=False))) for syn in cands]
 
-        encoded_input = self.tokenizer(texts, return_tensors='pt', truncation=True,
-                                       padding=True).to(self.device)['input_ids']
-        encoded_output = self.tokenizer(outs, return_tensors='pt', truncation=True,
-                                        padding=True).to(self.device)['input_ids']
+def crop_context(text_pref: str, text_suff: str, window: int) -> Tuple[str, str]:
+    # keep `window` words on each side; text_pref ends with space, punctuation glued to the word stays in text_suff
+    text_pref = ' '.join(text_pref.split(' ')[-(window + 1):])
+    text_suff = ' '.join(text_suff.split(' ')[:window + 1])
+    return text_pref, text_suff
 
-        all_logits = self.model(encoded_input, labels=encoded_output).logits.cpu()
 
-        scores: Dict[int, List[float]] = {}
-        for i, logits in enumerate(all_logits):
+class BartCandidatesScorer(CandidatesScorer):
+    """
+    Computes log-probability of every candidate in place of the spelled word with teacher-forced BART decoder.
+    Decoder logits at the first position of the word depend only on the text before it, so all single-token
+    candidates of a spelled word are read from one decoder pass; multi-token candidates get their own pass.
+    With context_window set, only that many words around the spelled word are fed to the model, so cost per
+    error doesn't grow with the length of the text.
+    Scores are cached by (model_id, model input, candidate) when cache is given; the cache can be shared between
+    scorers, model_id keeps their scores apart.
+    """
 
-            ind = texts_inds[i]
-            if ind not in scores:
-                scores[ind] = []
+    def __init__(self, model: BartForConditionalGeneration, tokenizer: BartTokenizer, device: torch.device,
+                 input_format: Callable[[str, str, str], str] = sep_mask_input_format, batch_size: int = 16,
+                 context_window: Optional[int] = None, cache: Optional[LRUCache] = None, model_id: str = ''):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.input_format = input_format
+        self.batch_size = batch_size
+        self.context_window = context_window
+        self.cache = cache
+        self.model_id = model_id
 
-            syn_range = cands_ranges[i]
+    def candidate_token_ids(self, text_pref: str, candidate: str) -> List[int]:
+        # BPE glues the space before the word to its first token
+        return self.tokenizer.encode((' ' if len(text_pref) > 0 else '') + candidate, add_special_tokens=False)
 
-            word_logits = logits[syn_range[0] - 1: syn_range[0] + syn_range[1] - 1]
-            log_probs = torch.log_softmax(word_logits, dim=1)
-            word_log_prob = torch.tensor(0.0)
-            for j, token_idx in enumerate(encoded_output[i][syn_range[0] - 1: syn_range[0] + syn_range[1] - 1]):
-                word_log_prob += log_probs[j, token_idx]
+    def score(self, spelled_words: List[SpelledWord], candidates: List[List[str]]) -> List[List[float]]:
+        scores: List[List[float]] = [[0.0 for _ in cands] for cands in candidates]
+        cache_keys: Dict[Tuple[int, int], bytes] = {}
 
-            scores[ind].append(math.exp(word_log_prob.item()))
+        # every row is one (input, output) pair for the decoder and the list of candidates read from its logits
+        inputs, outputs, rows_targets = [], [], []
+        for i, (spelled_word, cands) in enumerate(zip(spelled_words, candidates)):
+            text, start, finish = spelled_word.text, spelled_word.interval[0], spelled_word.interval[1]
+            text_pref, text_suff = text[:start], text[finish:]
+            if self.context_window is not None:
+                text_pref, text_suff = crop_context(text_pref, text_suff, self.context_window)
+            input_text = self.input_format(spelled_word.word, text_pref, text_suff)
+            position = len(self.tokenizer.encode(text_pref[:-1])) - 1
+
+            single_targets, first_row = [], len(inputs)
+            for j, cand in enumerate(cands):
+                if self.cache is not None:
+                    cache_keys[(i, j)] = hash_key(self.model_id, input_text, text_pref, text_suff, cand)
+                    cached_score = self.cache.get(cache_keys[(i, j)])
+                    if cached_score is not None:
+                        scores[i][j] = cached_score
+                        continue
+                cand_ids = self.candidate_token_ids(text_pref, cand)
+                if len(cand_ids) == 1:
+                    single_targets.append((i, j, position, cand_ids))
+                    continue
+                inputs.append(input_text)
+                outputs.append(text_pref + cand + text_suff)
+                rows_targets.append([(i, j, position, cand_ids)])
+
+            if len(single_targets) > 0:
+                if first_row == len(inputs):
+                    inputs.append(input_text)
+                    outputs.append(text_pref + cands[single_targets[0][1]] + text_suff)
+                    rows_targets.append([])
+                rows_targets[first_row] += single_targets
+
+        with torch.no_grad():
+            for start in range(0, len(inputs), self.batch_size):
+                end = min(start + self.batch_size, len(inputs))
+                encoded_input = self.tokenizer(inputs[start: end], return_tensors='pt', truncation=True,
+                                               padding=True).to(self.device)
+                encoded_output = self.tokenizer(outputs[start: end], return_tensors='pt', truncation=True,
+                                                padding=True).to(self.device)['input_ids']
+
+                all_logits = self.model(input_ids=encoded_input['input_ids'],
+                                        attention_mask=encoded_input['attention_mask'],
+                                        labels=encoded_output).logits
+
+                for row, logits in enumerate(all_logits):
+                    for i, j, position, cand_ids in rows_targets[start + row]:
+                        log_probs = torch.log_softmax(logits[position: position + len(cand_ids)], dim=1)
+                        cand_ids = torch.tensor(cand_ids[:log_probs.shape[0]], device=log_probs.device)
+                        positions = torch.arange(len(cand_ids), device=log_probs.device)
+                        scores[i][j] = log_probs[positions, cand_ids].sum().item()
+                        if self.cache is not None:
+                            self.cache.put(cache_keys[(i, j)], scores[i][j])
+
+        return scores
+
+
+class ScoringRanker(BaseRanker):
+    # picks the best candidate by scorer.score: BART, masked LM or n-gram LM scorer
+    scorer: CandidatesScorer
+
+    def rank(self, text: str, spelled_words: List[SpelledWord], candidates: List[List[str]], **kwargs) -> List[str]:
+        indices = [i for i, spelled_word in enumerate(spelled_words)
+                   if is_separate_word(spelled_word) and len(candidates[i]) > 0]
+        scores = self.scorer.score([spelled_words[i] for i in indices], [candidates[i] for i in indices])
 
         result: List[str] = ['' for _ in spelled_words]
-        for i in scores:
+        for i, cur_scores in zip(indices, scores):
             mx = -1e18
             mx_ind = None
-            for j, score in enumerate(i):
+            for j, score in enumerate(cur_scores):
                 # DEBUG
-                # print(f'Candidate: {candidates[i][j]}, Score: {score}')
+                # print(f'Candidate: {candidates[i][j]}, score: {score}')
                 if mx < score:
                     mx = score
                     mx_ind = j
@@ -86,36 +157,65 @@ class BartRanker(BaseRanker):
         return result
 
 
-class LogisticRegressionMetaRanker(BaseRanker):
-    def __init__(self):
-        self.model = LogisticRegressionRanker()
+BartScoringRanker = ScoringRanker
+
+
+class BartRanker(ScoringRanker):
+    def __init__(self, checkpoint_path: str = 'facebook/bart-base', device: torch.device = None,
+                 context_window: Optional[int] = None, scores_cache: Optional[LRUCache] = None):
+        self.device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.model = BartForConditionalGeneration.from_pretrained(checkpoint_path).to(self.device)
+        self.tokenizer = BartTokenizer.from_pretrained(checkpoint_path)
+        self.model.eval()
+        self.scorer = BartCandidatesScorer(self.model, self.tokenizer, self.device, input_format=mask_input_format,
+                                           context_window=context_window, cache=scores_cache,
+                                           model_id=checkpoint_path)
+
+
+class MaskedLMRanker(ScoringRanker):
+    # encoder-only masked LM instead of BART decoder, one forward pass per error for single-token candidates
+    def __init__(self, checkpoint_path: str = 'distilroberta-base', device: torch.device = None,
+                 batch_size: int = 32):
+        self.scorer = MaskedLMScorer(checkpoint_path, device=device, batch_size=batch_size)
+        self.device = self.scorer.device
+
+
+class NgramLMRanker(ScoringRanker):
+    # no transformer: hashed n-gram LM over the words around the error
+    def __init__(self, path: str = PATH_PREFIX + 'model/ranking_utils/ngram_lm_3/', method: str = 'stupid_backoff'):
+        self.scorer = HashedNgramLM.load(path, method=method)
+
+
+class FeaturesMetaRanker(BaseRanker):
+    # Ranker (logistic regression or LightGBM) over features of candidates,
+    # e.g. features_names=['ngram_lm', 'levenshtein'] with a model trained on the same features for a CPU-only ranker
+    def __init__(self, model_path: str = PATH_PREFIX + 'model/ranking_utils/distilbart-re05_ranker.pickle',
+                 features_names: List[str] = None, features_configs: Optional[Dict[str, Dict]] = None,
+                 ranker_class: Type[Ranker] = LogisticRegressionRanker):
+        # ranker_class=LightGBMRanker for a lambdarank model saved by LightGBMRanker.save
+        self.model = ranker_class()
         # self.model.load(PATH_PREFIX + 'model/ranking_utils/oldbartLN_lev_ranker.pickle')
-        self.model.load(PATH_PREFIX + 'model/ranking_utils/distilbart-re05_ranker.pickle')
+        self.model.load(model_path)
+        self.features_names = features_names if features_names is not None else ['bart_prob']
+        # features are shared with other rankers of the process and loaded on the first rank call
+        self.features_collector = FeaturesCollector(features_names=self.features_names,
+                                                    features_configs=features_configs)
 
     def rank(self, text: str, spelled_words: List[SpelledWord], candidates: List[List[str]], **kwargs) -> List[str]:
-        features_collector = FeaturesCollector(features_names=['bart_prob'])
-        all_features = features_collector.collect(spelled_words, candidates)
-        print(all_features)
-        scores = self.model.predict(all_features)
-        result: List[str] = ['' for _ in spelled_words]
+        all_features = self.features_collector.collect(spelled_words, candidates)
+        best = self.model.predict_best(all_features)
+        # a word without candidates is left as is
+        return [candidates[i][j] if j >= 0 else spelled_word.word for i, (spelled_word, j) in
+                enumerate(zip(spelled_words, best.tolist()))]
 
-        for i, cur_scores in enumerate(scores):
-            mx = -1e18
-            mx_ind = None
-            for j, score in enumerate(cur_scores):
-                # DEBUG
-                print(f'Candidate: {candidates[i][j]}, Features: {all_features[i][j]}, Score: {score}')
-                if mx < score:
-                    mx = score
-                    mx_ind = j
-            result[i] = candidates[i][mx_ind]
-        return result
 
+LogisticRegressionMetaRanker = FeaturesMetaRanker
 
 
-class BartSepMaskAllRanker(BaseRanker):
+class BartSepMaskAllRanker(ScoringRanker):
 
-    def __init__(self, checkpoint_path: str = '----', config=None, device: torch.device = None):
+    def __init__(self, checkpoint_path: str = '----', config=None, device: torch.device = None,
+                 context_window: Optional[int] = None, scores_cache: Optional[LRUCache] = None):
         self.device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
         if config is None:
             config = BartForConditionalGeneration.from_pretrained('facebook/bart-base').config
@@ -128,172 +228,26 @@ class BartSepMaskAllRanker(BaseRanker):
         self.model = self.model.to(self.device)
         self.tokenizer = BartTokenizer.from_pretrained('facebook/bart-base')
         self.model.eval()
-
-    def rank(self, text: str, spelled_words: List[SpelledWord], candidates: List[List[str]], **kwargs) -> List[str]:
-        texts = []
-        outs = []
-        texts_inds = []
-        cands_ranges = []
-        all_candidates = []
-        for i, (spelled_word, cands) in enumerate(zip(spelled_words, candidates)):
-            text, word, start, finish = spelled_word.text, spelled_word.word, spelled_word.interval[0], spelled_word.interval[1]
-            text_pref = text[: start]
-            text_suff = text[finish:]
-            # remove if it is not separate phrase (space or start_of_text in the begin and end_of_text or not alpha after phrase
-            if (start == 0 or text[start - 1] == ' ') and (finish == len(text) or not text[finish].isalpha()):
-                all_candidates += cands
-                texts_inds += [i for _ in cands]
-
-                sep_token = '</s>'
-                # sep_token = '<sep>'
-
-                input_text = word + f' {sep_token} ' + text_pref + '<mask>' + text_suff
-                texts += [input_text for _ in cands]
-
-                output_texts = [text_pref + syn + text_suff for syn in cands]
-                outs += output_texts
-
-                cands_ranges += [(len(self.tokenizer.encode(text_pref[:-1])),
-                                  len(self.tokenizer.encode(syn, add_special_tokens=False))) for syn in cands]
-
-        # DEBUG
-        # print(f'Input BART texts: {texts}')
-        # print()
-        # print(f'Output BART texts: {outs}')
-
-        encoded_input = self.tokenizer.batch_encode_plus(
-            texts,
-            add_special_tokens=True,
-            return_tensors='pt',
-            return_attention_mask=True,
-            truncation=True, padding=True
-        ).to(self.device)['input_ids']
-        encoded_output = self.tokenizer.batch_encode_plus(
-            outs,
-            add_special_tokens=True,
-            return_tensors='pt',
-            return_attention_mask=True,
-            truncation=True, padding=True
-        ).to(self.device)['input_ids']
-
-        all_logits = self.model(encoded_input, labels=encoded_output).logits.cpu()
-
-        scores: Dict[int, List[float]] = {}
-        for i, logits in enumerate(all_logits):
-
-            ind = texts_inds[i]
-            if ind not in scores:
-                scores[ind] = []
-
-            # DEBUG print all tokens and their probs
-            # if 'course' in outs[i] or 'ours' in outs[i]:
-            #     tokenized_input = self.tokenizer(outs[i])
-            #     tokens = self.tokenizer.convert_ids_to_tokens(tokenized_input["input_ids"])
-            #     print(f'Output tokens:{tokens}')
-            #     token_probs = []
-            #     all_probs = torch.softmax(logits, dim=1)
-            #     for j, token_idx in enumerate(encoded_output[i]):
-            #         token_probs.append(all_probs[j, token_idx].item())
-            #     print(f'Output tokens probs: {token_probs}')
-
-            syn_range = cands_ranges[i]
-
-            word_logits = logits[syn_range[0] - 1:syn_range[0] + syn_range[1] - 1]
-            log_probs = torch.log_softmax(word_logits, dim=1)
-            word_log_prob = torch.tensor(0.0)
-            for j, token_idx in enumerate(encoded_output[i][syn_range[0] - 1:syn_range[0] + syn_range[1] - 1]):
-                word_log_prob += log_probs[j, token_idx]
-
-            scores[ind].append(math.exp(word_log_prob.item()))
-
-        result: List[str] = ['' for _ in spelled_words]
-        for i in scores:
-            mx = -1e18
-            mx_ind = None
-            for j, score in enumerate(scores[i]):
-                # DEBUG
-                print(f'Candidate: {candidates[i][j]}, score: {score}')
-                if mx < score:
-                    mx = score
-                    mx_ind = j
-            result[i] = candidates[i][mx_ind]
-        return result
+        self.scorer = BartCandidatesScorer(self.model, self.tokenizer, self.device,
+                                           input_format=sep_mask_input_format, context_window=context_window,
+                                           cache=scores_cache, model_id=checkpoint_path)
 # Sep Mask All
 
 
-class BartFineTuneRanker(BaseRanker):
-    def __init__(self, checkpoint_path: str = PATH_PREFIX + 'training/checkpoints/bart-base_v1_4.pt', device: torch.device = None):
+class BartFineTuneRanker(ScoringRanker):
+    def __init__(self, checkpoint_path: str = PATH_PREFIX + 'training/checkpoints/bart-base_v1_4.pt', device: torch.device = None,
+                 context_window: Optional[int] = None, scores_cache: Optional[LRUCache] = None):
         self.device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.tokenizer = BartTokenizer.from_pretrained('facebook/bart-base')
 
         config = BartForConditionalGeneration.from_pretrained('facebook/bart-base').config
         self.model = BartForConditionalGeneration(config)
         self.model.load_state_dict(torch.load(checkpoint_path))
-        self.model = self.model.to(device)
+        self.model = self.model.to(self.device)
         self.model.eval()
-
-    def rank(self, text: str, spelled_words: List[SpelledWord], candidates: List[List[str]], **kwargs) -> List[str]:
-        texts = []
-        outs = []
-        texts_inds = []
-        cands_ranges = []
-        all_candidates = []
-        for i, (spelled_word, cands) in enumerate(zip(spelled_words, candidates)):
-            text, start, finish = spelled_word.text, spelled_word.interval[0], spelled_word.interval[1]
-            text_start = text[: start]
-            # remove if it is not separate phrase (space or start_of_text in the begin and end_of_text or not alpha after phrase
-            if (start == 0 or text[start - 1] == ' ') and (finish == len(text) or not text[finish].isalpha()):
-                all_candidates += cands
-                texts_inds += [i for _ in cands]
-
-                # input_text = text
-                texts += [text for _ in cands]
-
-                output_texts = [text_start + syn + text[finish:] for syn in cands]
-                outs += output_texts
-
-                cands_ranges += [(len(self.tokenizer.encode(text_start[:-1])),
-                                  len(self.tokenizer.encode(syn, add_special_tokens=False))) for syn in cands]
-
-        encoded_input = self.tokenizer(texts, return_tensors='pt', truncation=True,
-                                       padding=True).to(self.device)['input_ids']
-        encoded_output = self.tokenizer(outs, return_tensors='pt', truncation=True,
-                                        padding=True).to(self.device)['input_ids']
-
-        all_logits = self.model(encoded_input, labels=encoded_output).logits.cpu()
-
-
-        scores: Dict[int, List[float]] = {}
-        for i, logits in enumerate(all_logits):
-
-            ind = texts_inds[i]
-            if ind not in scores:
-                scores[ind] = []
-
-            syn_range = cands_ranges[i]
-
-            word_logits = logits[syn_range[0] - 1: syn_range[0] + syn_range[1] - 1]
-
-            log_probs = torch.log_softmax(word_logits, dim=1)
-            word_log_prob = torch.tensor(0.0)
-            for j, token_idx in enumerate(encoded_output[i][syn_range[0] - 1: syn_range[0] + syn_range[1] - 1]):
-                word_log_prob += log_probs[j, token_idx]
-
-            scores[ind].append(math.exp(word_log_prob.item()))
-
-        result: List[str] = ['' for _ in spelled_words]
-        for i in scores:
-            mx = -1e18
-            mx_ind = None
-            for j, score in enumerate(scores[i]):
-                if mx < score:
-                    mx = score
-                    mx_ind = j
-            result[i] = candidates[i][mx_ind]
-        return result
-
-
-
+        self.scorer = BartCandidatesScorer(self.model, self.tokenizer, self.device, input_format=plain_input_format,
+                                           context_window=context_window, cache=scores_cache,
+                                           model_id=checkpoint_path)
 
 
 def test_bart():
@@ -1,19 +1,71 @@
 import torch
 from transformers import BartForConditionalGeneration, BartTokenizer, BartConfig
 from model.base import SpelledWord
+from model.ranking_utils.mlm_scorer import MaskedLMScorer
+from model.ranking_utils.ngram_lm import HashedNgramLM, ngram_hash
 from abc import ABC, abstractmethod
 from typing import List
+import attr
 import nltk
+import numpy as np
 PATH_PREFIX = '/home/ubuntu/omelnikov/spellchecker/'
 
 
+def candidate_offsets(candidates: List[List[str]]) -> np.ndarray:
+    # candidates of spelled word i are rows offsets[i]:offsets[i + 1] of flat arrays
+    offsets = np.zeros(len(candidates) + 1, dtype=np.int64)
+    np.cumsum([len(cands) for cands in candidates], out=offsets[1:])
+    return offsets
+
+
+@attr.s(auto_attribs=True)
+class FeaturesMatrix:
+    # features of all candidates of a call in one contiguous matrix [total candidates, features]
+    values: np.ndarray
+    offsets: np.ndarray
+    features_names: List[str]
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def word_features(self, idx: int) -> np.ndarray:
+        return self.values[self.offsets[idx]: self.offsets[idx + 1]]
+
+    def to_lists(self) -> List[List[List[float]]]:
+        return [self.word_features(idx).tolist() for idx in range(len(self))]
+
+    @classmethod
+    def empty(cls, candidates: List[List[str]], features_names: List[str]) -> 'FeaturesMatrix':
+        offsets = candidate_offsets(candidates)
+        return cls(np.zeros((offsets[-1], len(features_names)), dtype=np.float32), offsets, features_names)
+
+
 class BaseFeature(ABC):
     @abstractmethod
     def compute_candidates(self, spelled_words: List[SpelledWord], candidates: List[List[str]]) -> List[List[float]]:
         raise NotImplementedError
 
+    def compute_column(self, spelled_words: List[SpelledWord], candidates: List[List[str]], out: np.ndarray):
+        # writes values of all candidates into out [total candidates], e.g. a column of FeaturesMatrix.values
+        values = self.compute_candidates(spelled_words, candidates)
+        out[:] = np.fromiter((value for cur_values in values for value in cur_values), dtype=out.dtype,
+                             count=len(out))
 
-class BartProbFeature(BaseFeature):
+
+class ColumnFeature(BaseFeature):
+    # vectorized feature: values of all candidates are computed as one array, lists are made only on request
+    @abstractmethod
+    def compute_column(self, spelled_words: List[SpelledWord], candidates: List[List[str]], out: np.ndarray):
+        raise NotImplementedError
+
+    def compute_candidates(self, spelled_words: List[SpelledWord], candidates: List[List[str]]) -> List[List[float]]:
+        offsets = candidate_offsets(candidates)
+        out = np.zeros(offsets[-1], dtype=np.float32)
+        self.compute_column(spelled_words, candidates, out)
+        return [out[offsets[idx]: offsets[idx + 1]].tolist() for idx in range(len(candidates))]
+
+
+class BartProbFeature(ColumnFeature):
     def __init__(self, bart_type: str = 'std'):
         self.bart_type = bart_type
         if bart_type == 'std':
@@ -36,19 +88,17 @@ class BartProbFeature(BaseFeature):
         self.model = self.model.to(self.device)
         self.model.eval()
 
-    def compute_candidates(self, spelled_words: List[SpelledWord], candidates: List[List[str]]) -> List[List[float]]:
+    def compute_column(self, spelled_words: List[SpelledWord], candidates: List[List[str]], out: np.ndarray):
 
-        # prep data for BART
+        # prep data for BART, row k of texts is candidate k of the flat column
         texts = []
         outs = []
-        texts_inds = []
         cands_ranges = []
         for i, (spelled_word, cands) in enumerate(zip(spelled_words, candidates)):
             text, start, finish = spelled_word.text, spelled_word.interval[0], spelled_word.interval[1]
             text_pref = text[: start]
             text_suff = text[finish:]
             if (start == 0 or text[start - 1] == ' ') and (finish == len(text) or not text[finish].isalpha()):
-                texts_inds += [i for _ in cands]
 
                 if self.bart_type == 'std':
                     input_texts = [text_pref + '<mask>' + text_suff for _ in cands]
@@ -70,8 +120,6 @@ class BartProbFeature(BaseFeature):
 
         batch_size = 16
 
-        scores: List[List[float]] = [[] for _ in spelled_words]
-
         for start in range(0, len(texts), batch_size):
             end = min(start + batch_size, len(texts))
 
@@ -84,31 +132,226 @@ class BartProbFeature(BaseFeature):
             all_logits = self.model(encoded_input, labels=encoded_output).logits.cpu()
 
             for i, logits in enumerate(all_logits):
-                ind = texts_inds[start + i]
                 syn_range = cands_ranges[start + i]
                 word_logits = logits[syn_range[0] - 1: syn_range[0] + syn_range[1] - 1]
                 log_probs = torch.log_softmax(word_logits, dim=1)
-                word_log_prob = torch.tensor(0.0)
-                for j, token_idx in enumerate(encoded_output[i][syn_range[0] - 1: syn_range[0] + syn_range[1] - 1]):
-                    word_log_prob += log_probs[j, token_idx]
-                # scores[ind].append(math.exp(word_log_prob.item()))
-                scores[ind].append(word_log_prob.item())
+                token_ids = encoded_output[i][syn_range[0] - 1: syn_range[0] + syn_range[1] - 1].cpu()
+                out[start + i] = log_probs[torch.arange(len(token_ids)), token_ids].sum().item()
 
 
+class MaskedLMProbFeature(ColumnFeature):
+    def __init__(self, checkpoint: str = 'distilroberta-base'):
+        self.scorer = MaskedLMScorer(checkpoint)
 
-        return scores
+    def compute_column(self, spelled_words: List[SpelledWord], candidates: List[List[str]], out: np.ndarray):
+        out[:] = self.scorer.score_flat(spelled_words, candidates).numpy()
 
 
-class LevenshteinFeature(BaseFeature):
-    def compute_candidates(self, spelled_words: List[SpelledWord], candidates: List[List[str]]) -> List[List[float]]:
+class NgramLMFeature(ColumnFeature):
+    def __init__(self, path: str = PATH_PREFIX + 'model/ranking_utils/ngram_lm_3/', method: str = 'stupid_backoff'):
+        self.model = HashedNgramLM.load(path, method=method)
+
+    def compute_column(self, spelled_words: List[SpelledWord], candidates: List[List[str]], out: np.ndarray):
+        out[:] = self.model.score_flat(spelled_words, candidates)
+
+
+class LevenshteinFeature(ColumnFeature):
+    def compute_column(self, spelled_words: List[SpelledWord], candidates: List[List[str]], out: np.ndarray):
+        out[:] = np.fromiter((nltk.edit_distance(spelled_word.word, candidate, transpositions=True)
+                              for spelled_word, cands in zip(spelled_words, candidates) for candidate in cands),
+                             dtype=np.float64, count=len(out))
+
+
+QWERTY_ROWS = ['1234567890-=', 'qwertyuiop[]', "asdfghjkl;'", 'zxcvbnm,./']
+# shift of every row to the right in key widths
+QWERTY_ROW_SHIFTS = [0.0, 0.5, 0.75, 1.25]
+
+
+def qwerty_cost_matrix(adjacent_cost: float = 0.5, case_cost: float = 0.1) -> np.ndarray:
+    # substitution cost between ASCII chars: 0 for same, case_cost for the other case, adjacent_cost
+    # for neighbouring keys and 1 otherwise
+    positions = {}
+    for row, (keys, shift) in enumerate(zip(QWERTY_ROWS, QWERTY_ROW_SHIFTS)):
+        for col, key in enumerate(keys):
+            positions[key] = (row, col + shift)
+    costs = np.ones((128, 128), dtype=np.float32)
+    for first, (row1, col1) in positions.items():
+        for second, (row2, col2) in positions.items():
+            if first != second and abs(row1 - row2) <= 1 and abs(col1 - col2) <= 1:
+                costs[ord(first), ord(second)] = adjacent_cost
+
+    # keys don't depend on case
+    lower = np.array([ord(chr(code).lower()) for code in range(128)])
+    costs = costs[np.ix_(lower, lower)]
+    costs[lower[:, None] == lower[None, :]] = case_cost
+    np.fill_diagonal(costs, 0.0)
+    return costs
+
+
+QWERTY_COSTS = qwerty_cost_matrix()
+
+
+def char_codes(words: List[str], max_len: int) -> np.ndarray:
+    # [len(words), max_len] code points, padding is 0
+    codes = np.zeros((len(words), max_len), dtype=np.int64)
+    for i, word in enumerate(words):
+        codes[i, :len(word)] = [ord(char) for char in word]
+    return codes
+
 
-        scores: List[List[float]] = [[] for _ in spelled_words]
-        for idx, (spelled_word, cands) in enumerate(zip(spelled_words, candidates)):
-            for candidate in cands:
-                dist = nltk.edit_distance(spelled_word.word, candidate, transpositions=True)
-                scores[idx].append(dist)
+def substitution_costs(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    # QWERTY costs for pairs of ASCII chars, 0 for the same char and 1 for other pairs with a non-ASCII char
+    ascii_pair = (first < 128) & (second < 128)
+    costs = np.where(ascii_pair, QWERTY_COSTS[np.minimum(first, 127), np.minimum(second, 127)], 1.0)
+    return np.where(first == second, 0.0, costs)
 
-        return scores
+
+def keyboard_distances(words: List[str], cands: List[str]) -> np.ndarray:
+    # Damerau-Levenshtein distance with QWERTY substitution costs of every (word, candidate) pair, one DP for all
+    word_lens, cand_lens = np.array([len(w) for w in words]), np.array([len(c) for c in cands])
+    word_codes = char_codes(words, max(word_lens.max(), 1))
+    cand_codes = char_codes(cands, max(cand_lens.max(), 1))
+    n, rows, cols = len(words), word_codes.shape[1] + 1, cand_codes.shape[1] + 1
+
+    dist = np.zeros((n, rows, cols), dtype=np.float32)
+    dist[:, :, 0] = np.arange(rows)
+    dist[:, 0, :] = np.arange(cols)
+    for i in range(1, rows):
+        for j in range(1, cols):
+            substitution = dist[:, i - 1, j - 1] + substitution_costs(word_codes[:, i - 1], cand_codes[:, j - 1])
+            best = np.minimum(np.minimum(dist[:, i - 1, j] + 1, dist[:, i, j - 1] + 1), substitution)
+            if i > 1 and j > 1:
+                swapped = (word_codes[:, i - 1] == cand_codes[:, j - 2]) & \
+                          (word_codes[:, i - 2] == cand_codes[:, j - 1])
+                best = np.where(swapped, np.minimum(best, dist[:, i - 2, j - 2] + 1), best)
+            dist[:, i, j] = best
+    return dist[np.arange(n), word_lens, cand_lens]
+
+
+class KeyboardEditFeature(ColumnFeature):
+    # pairs are sorted by length and cut into chunks, so the DP of a chunk is as long as its own longest pair
+    # and memory doesn't grow with the number of candidates in the call
+    def __init__(self, chunk_size: int = 4096):
+        self.chunk_size = chunk_size
+
+    def compute_column(self, spelled_words: List[SpelledWord], candidates: List[List[str]], out: np.ndarray):
+        words = [spelled_word.word for spelled_word, cands in zip(spelled_words, candidates) for _ in cands]
+        cands = [cand for cur_cands in candidates for cand in cur_cands]
+        order = np.argsort([max(len(word), len(cand)) for word, cand in zip(words, cands)], kind='stable')
+        for start in range(0, len(order), self.chunk_size):
+            chunk = order[start: start + self.chunk_size]
+            out[chunk] = keyboard_distances([words[idx] for idx in chunk], [cands[idx] for idx in chunk])
+
+
+class UnigramFrequencyFeature(ColumnFeature):
+    # log frequency of the candidate from unigram counts of the n-gram LM, one array lookup for all candidates
+    def __init__(self, path: str = PATH_PREFIX + 'model/ranking_utils/ngram_lm_3/'):
+        self.model = HashedNgramLM.load(path)
+
+    def compute_column(self, spelled_words: List[SpelledWord], candidates: List[List[str]], out: np.ndarray):
+        hashes = np.array([ngram_hash([cand.lower()], self.model.num_buckets)
+                           for cands in candidates for cand in cands], dtype=np.int64)
+        counts = np.asarray(self.model.counts[1][hashes], dtype=np.float64)
+        out[:] = np.log((counts + 1) / (self.model.total + self.model.num_buckets))
+
+
+def soundex_codes() -> np.ndarray:
+    # soundex digit of every ASCII char, 0 for vowels and h, w, y; -1 for non-letters
+    codes = np.full(128, -1, dtype=np.int64)
+    for digit, letters in enumerate(['aeiouhwy', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r']):
+        for letter in letters:
+            codes[ord(letter)] = digit
+    return codes
+
+
+SOUNDEX_CODES = soundex_codes()
+
+
+def soundex(word: str) -> str:
+    letters = [char for char in word.lower() if char.isascii() and SOUNDEX_CODES[ord(char)] >= 0]
+    if len(letters) == 0:
+        return ''
+    codes = SOUNDEX_CODES[[ord(char) for char in letters]]
+    result, previous = [letters[0]], codes[0]
+    for char, code in zip(letters[1:], codes[1:]):
+        if code != 0 and code != previous:
+            result.append(str(code))
+        # h and w don't separate letters with the same code
+        if char not in 'hw':
+            previous = code
+    return ''.join(result)[:4].ljust(4, '0')
+
+
+def soundex_keys(words: List[str]) -> np.ndarray:
+    # soundex of every word as [len(words), 4] ints (first letter code and 3 digits), same as soundex() of the
+    # words, computed over their char codes at once; words without letters get -1 as the first letter
+    codes = char_codes(words, max([len(word) for word in words] + [1]))
+    lower = np.where((codes >= ord('A')) & (codes <= ord('Z')), codes + 32, codes)
+    digits = np.where(lower < 128, SOUNDEX_CODES[np.minimum(lower, 127)], -1)
+    letters = digits >= 0
+    rows = np.arange(len(words))
+    has_letters, first = letters.any(axis=1), letters.argmax(axis=1)
+
+    # h and w neither give a digit nor separate letters with the same code, so they are dropped (except the first
+    # letter), kept letters are moved to the front of the row
+    kept = letters & (lower != ord('h')) & (lower != ord('w'))
+    kept[rows, first] = letters[rows, first]
+    order = np.argsort(~kept, axis=1, kind='stable')
+    sequence = np.take_along_axis(np.where(kept, digits, -1), order, axis=1)
+    previous = np.concatenate([np.full((len(words), 1), -1), sequence[:, :-1]], axis=1)
+    appended = (sequence > 0) & (sequence != previous)
+    appended[:, 0] = False
+
+    keys = np.zeros((len(words), 4), dtype=np.int64)
+    keys[:, 0] = np.where(has_letters, lower[rows, first], -1)
+    position = np.cumsum(appended, axis=1)
+    for k in range(1, 4):
+        selected = appended & (position == k)
+        keys[:, k] = np.where(selected.any(axis=1), sequence[rows, selected.argmax(axis=1)], 0)
+    return keys
+
+
+class SoundexMatchFeature(ColumnFeature):
+    def compute_column(self, spelled_words: List[SpelledWord], candidates: List[List[str]], out: np.ndarray):
+        word_keys = soundex_keys([spelled_word.word for spelled_word in spelled_words])
+        cand_keys = soundex_keys([cand for cands in candidates for cand in cands])
+        out[:] = (np.repeat(word_keys, [len(cands) for cands in candidates], axis=0) == cand_keys).all(axis=1)
+
+
+def case_pattern(word: str) -> int:
+    # 0 - lower, 1 - capitalized, 2 - upper, 3 - mixed
+    if word.islower() or not any(char.isalpha() for char in word):
+        return 0
+    if word.isupper():
+        return 2
+    if word[0].isupper() and word[1:].islower():
+        return 1
+    return 3
+
+
+def case_patterns(words: List[str]) -> np.ndarray:
+    # case_pattern() of every word over char codes at once, case of distinct chars of the call is looked up once
+    codes = char_codes(words, max([len(word) for word in words] + [1]))
+    unique, inverse = np.unique(codes, return_inverse=True)
+    upper = np.array([chr(code).isupper() for code in unique])[inverse].reshape(codes.shape)
+    lower = np.array([chr(code).islower() for code in unique])[inverse].reshape(codes.shape)
+    num_upper, num_lower = upper.sum(axis=1), lower.sum(axis=1)
+    capitalized = upper[:, 0] & (num_upper == 1) & (num_lower > 0)
+    return np.select([num_upper == 0, num_lower == 0, capitalized], [0, 2, 1], default=3)
+
+
+class CaseMatchFeature(ColumnFeature):
+    def compute_column(self, spelled_words: List[SpelledWord], candidates: List[List[str]], out: np.ndarray):
+        word_patterns = case_patterns([spelled_word.word for spelled_word in spelled_words])
+        cand_patterns = case_patterns([cand for cands in candidates for cand in cands])
+        out[:] = np.repeat(word_patterns, [len(cands) for cands in candidates]) == cand_patterns
+
+
+class LengthDiffFeature(ColumnFeature):
+    def compute_column(self, spelled_words: List[SpelledWord], candidates: List[List[str]], out: np.ndarray):
+        word_lens = np.array([len(spelled_word.word) for spelled_word in spelled_words], dtype=np.int64)
+        cand_lens = np.fromiter((len(cand) for cands in candidates for cand in cands), dtype=np.int64, count=len(out))
+        out[:] = np.abs(cand_lens - np.repeat(word_lens, [len(cands) for cands in candidates]))
 
 
 def test(feature: BaseFeature):
@@ -124,6 +367,18 @@ def test(feature: BaseFeature):
             print(f'{cand} - {round(score, 2)}')
 
 
+def cheap_features_test():
+    # vectorized soundex and case patterns agree with the per-word functions, non-ASCII substitutions aren't free
+    words = ['Robert', 'Rupert', 'Rubin', 'Ashcraft', 'Tymczak', 'Pfister', 'Honeyman', 'hello', 'HELLO', 'Hello',
+             'hELLo', 'café', 'cafè', '123', '', 'x']
+    for word, key in zip(words, soundex_keys(words)):
+        code = soundex(word)
+        expected = [ord(code[0]) if code else -1] + [int(digit) for digit in code[1:]] + [0] * (3 - len(code[1:]))
+        assert list(key) == expected, (word, code, key)
+    assert case_patterns(words).tolist() == [case_pattern(word) for word in words]
+    assert keyboard_distances(['café', 'cafe'], ['cafè', 'cafe']).tolist() == [1.0, 0.0]
+
+
 def main():
     test(LevenshteinFeature())
 
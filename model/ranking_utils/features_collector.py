@@ -1,29 +1,70 @@
-from typing import Dict, Callable
+import threading
+from typing import Any, Dict, Callable, Optional, Tuple
 from model.ranking_utils.features import *
 
+FEATURES_REGISTRY: Dict[str, Callable[..., BaseFeature]] = {
+    "levenshtein": lambda **config: LevenshteinFeature(**config),
+    "bart_prob": lambda **config: BartProbFeature(**config),
+    "mlm_prob": lambda **config: MaskedLMProbFeature(**config),
+    "ngram_lm": lambda **config: NgramLMFeature(**config),
+    "unigram_freq": lambda **config: UnigramFrequencyFeature(**config),
+    "keyboard_edit": lambda **config: KeyboardEditFeature(**config),
+    "soundex_match": lambda **config: SoundexMatchFeature(**config),
+    "case_match": lambda **config: CaseMatchFeature(**config),
+    "length_diff": lambda **config: LengthDiffFeature(**config),
+}
+
+# (feature name, sorted config items) -> feature, shared by all collectors of the process
+_shared_features: Dict[Tuple[str, Tuple[Tuple[str, Any], ...]], BaseFeature] = {}
+_shared_features_lock = threading.Lock()
+
+
+def get_feature(feature_name: str, config: Optional[Dict[str, Any]] = None) -> BaseFeature:
+    # feature is built on the first request (models are loaded once) and reused for the same name and config
+    config = config or {}
+    key = (feature_name, tuple(sorted(config.items())))
+    feature = _shared_features.get(key)
+    if feature is None:
+        with _shared_features_lock:
+            feature = _shared_features.get(key)
+            if feature is None:
+                feature = FEATURES_REGISTRY[feature_name](**config)
+                _shared_features[key] = feature
+    return feature
+
 
 class FeaturesCollector:
-    def __init__(self, features_names: List[str]):
-        self._all_features: Dict[str, Callable[[], BaseFeature]] = {
-            "levenshtein": lambda: LevenshteinFeature(),
-            "bart_prob": lambda: BartProbFeature(),
-        }
-        self._features = {fname: self._all_features[fname]() for fname in features_names}
+    # features_configs: feature name -> kwargs of its constructor, e.g. {'bart_prob': {'bart_type': 'distilbart-de05'}}
+    def __init__(self, features_names: List[str], features_configs: Optional[Dict[str, Dict[str, Any]]] = None):
+        unknown = [fname for fname in features_names if fname not in FEATURES_REGISTRY]
+        if unknown:
+            raise ValueError(f'Unknown features: {unknown}')
         self._features_names = features_names
+        self._features_configs = features_configs or {}
+        self._features: Optional[Dict[str, BaseFeature]] = None
 
-    def collect(self, spelled_words: List[SpelledWord], candidates: List[List[str]]) -> List[List[List[float]]]:
-        if not candidates:
-            return []
-        all_features: List[List[List[float]]] = [[[] for _ in candidates[idx]] for idx, _ in enumerate(spelled_words)]
-        if not candidates:
+    @property
+    def features(self) -> Dict[str, BaseFeature]:
+        # built on the first collect, so a collector is cheap to construct
+        if self._features is None:
+            self._features = {fname: get_feature(fname, self._features_configs.get(fname))
+                              for fname in self._features_names}
+        return self._features
+
+    def collect(self, spelled_words: List[SpelledWord], candidates: List[List[str]]) -> FeaturesMatrix:
+        # every feature fills its column of one float32 matrix [total candidates, features]
+        all_features = FeaturesMatrix.empty(candidates, self._features_names)
+        if all_features.values.shape[0] == 0:
             return all_features
+        features = self.features
         for jdx, feature_name in enumerate(self._features_names):
-            feature_values = self._features[feature_name].compute_candidates(spelled_words, candidates)
-            for idx, spelled_word in enumerate(spelled_words):
-                for kdx, value in enumerate(feature_values[idx]):
-                    all_features[idx][kdx].append(value)
+            features[feature_name].compute_column(spelled_words, candidates, all_features.values[:, jdx])
         return all_features
 
     @property
     def features_names(self):
         return self._features_names
+
+    @property
+    def features_configs(self) -> Dict[str, Dict[str, Any]]:
+        return self._features_configs
@@ -0,0 +1,143 @@
+import json
+import os
+import tempfile
+from multiprocessing import Pool
+from typing import Any, Dict, List, Optional, Tuple
+
+import attr
+import numpy as np
+from tqdm import tqdm
+
+from data_utils.utils import get_texts_from_file
+from model.base import SpelledWord
+from model.cache import hash_key
+from model.candidator import HunspellCandidator
+from model.ranking_utils.features import FeaturesMatrix
+from model.ranking_utils.features_collector import FeaturesCollector
+
+# bump when features or candidates change, so stores of older code aren't reused
+FEATURES_STORE_VERSION = 1
+# features which run on GPU: computed in the main process in big batches, others in worker processes
+NEURAL_FEATURES = {'bart_prob', 'mlm_prob'}
+
+
+@attr.s(auto_attribs=True)
+class RankingFeatures:
+    # features of candidates of every spelled word of a dataset, targets (1 for the gt word) and index of the text
+    # every spelled word (query) comes from
+    features: FeaturesMatrix
+    targets: np.ndarray
+    query_ids: np.ndarray
+    candidates: List[List[str]]
+
+    def save(self, path: str, meta: Dict[str, Any]):
+        # written to a temp file next to path and moved in place, so a killed run never leaves a truncated store
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, values=self.features.values, offsets=self.features.offsets, targets=self.targets,
+                         query_ids=self.query_ids,
+                         candidates=np.array([cand for cands in self.candidates for cand in cands]),
+                         meta=np.array(json.dumps({**meta, 'features_names': self.features.features_names})))
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> 'RankingFeatures':
+        data = np.load(path, allow_pickle=False)
+        meta = json.loads(str(data['meta']))
+        offsets, flat_candidates = data['offsets'], data['candidates'].tolist()
+        candidates = [flat_candidates[offsets[i]: offsets[i + 1]] for i in range(len(offsets) - 1)]
+        return cls(FeaturesMatrix(data['values'], offsets, meta['features_names']), data['targets'],
+                   data['query_ids'], candidates)
+
+
+def extract_spells(texts_noise: List[str], texts_gt: List[str],
+                   first_text_id: int = 0) -> Tuple[List[SpelledWord], List[str], List[int]]:
+    # changed words of texts with the same number of words, their gt words and ids of their texts
+    spelled_words, gt_words, text_ids = [], [], []
+    for text_id, (text_noise, text_gt) in enumerate(zip(texts_noise, texts_gt), first_text_id):
+        words_noise, words_gt = text_noise.split(' '), text_gt.split(' ')
+        if len(words_noise) != len(words_gt):
+            continue
+        cur_shift = 0
+        for word_noise, word_gt in zip(words_noise, words_gt):
+            if word_noise != word_gt:
+                spelled_words.append(SpelledWord(text_noise, interval=(cur_shift, cur_shift + len(word_noise))))
+                gt_words.append(word_gt)
+                text_ids.append(text_id)
+            cur_shift += len(word_noise) + 1
+    return spelled_words, gt_words, text_ids
+
+
+_worker_candidator: Optional[HunspellCandidator] = None
+
+
+def _extract_shard(args: Tuple[List[str], List[str], int, List[str], Dict[str, Dict]]):
+    # runs in a worker: candidates and non-neural features of one shard, hunspell and feature tables are
+    # loaded once per process
+    global _worker_candidator
+    texts_noise, texts_gt, first_text_id, features_names, features_configs = args
+    if _worker_candidator is None:
+        _worker_candidator = HunspellCandidator()
+    spelled_words, gt_words, text_ids = extract_spells(texts_noise, texts_gt, first_text_id)
+    candidates = _worker_candidator.get_candidates('fictive string', spelled_words)
+    features = FeaturesCollector(features_names, features_configs).collect(spelled_words, candidates)
+    targets = np.array([float(cand == gt_word) for gt_word, cands in zip(gt_words, candidates) for cand in cands],
+                       dtype=np.float32)
+    return spelled_words, candidates, features.values, targets, np.array(text_ids, dtype=np.int64)
+
+
+def extract_ranking_features(texts_noise: List[str], texts_gt: List[str], features_names: List[str],
+                             features_configs: Optional[Dict[str, Dict]] = None, num_workers: int = 8,
+                             shard_size: int = 2000) -> RankingFeatures:
+    features_configs = features_configs or {}
+    cpu_names = [fname for fname in features_names if fname not in NEURAL_FEATURES]
+    neural_names = [fname for fname in features_names if fname in NEURAL_FEATURES]
+    shards = [(texts_noise[start: start + shard_size], texts_gt[start: start + shard_size], start, cpu_names,
+               features_configs) for start in range(0, len(texts_noise), shard_size)]
+    if len(shards) == 0:
+        return RankingFeatures(FeaturesMatrix.empty([], features_names), np.zeros(0, dtype=np.float32),
+                               np.zeros(0, dtype=np.int64), [])
+    with Pool(num_workers) as pool:
+        results = list(tqdm(pool.imap(_extract_shard, shards), total=len(shards), desc='Extracting features'))
+
+    spelled_words = [spelled_word for result in results for spelled_word in result[0]]
+    candidates = [cands for result in results for cands in result[1]]
+    matrix = FeaturesMatrix.empty(candidates, features_names)
+    for fname, column in zip(cpu_names, np.concatenate([result[2] for result in results]).T):
+        matrix.values[:, features_names.index(fname)] = column
+    if neural_names and len(candidates) > 0:
+        # all spelled words go in one call, features batch them on the device themselves
+        neural_features = FeaturesCollector(neural_names, features_configs).collect(spelled_words, candidates)
+        for fname, column in zip(neural_names, neural_features.values.T):
+            matrix.values[:, features_names.index(fname)] = column
+    targets = np.concatenate([result[3] for result in results])
+    query_ids = np.concatenate([result[4] for result in results])
+    return RankingFeatures(matrix, targets, query_ids, candidates)
+
+
+def features_store_path(store_dir: str, dataset_name: str, features_names: List[str],
+                        features_configs: Optional[Dict[str, Dict]] = None) -> str:
+    key = hash_key(dataset_name, json.dumps(features_names), json.dumps(features_configs or {}, sort_keys=True),
+                   str(FEATURES_STORE_VERSION)).hex()[:16]
+    return os.path.join(store_dir, f'{dataset_name}_v{FEATURES_STORE_VERSION}_{key}.npz')
+
+
+def load_or_extract_ranking_features(data_prefix: str, store_dir: str, features_names: List[str],
+                                     features_configs: Optional[Dict[str, Dict]] = None,
+                                     num_workers: int = 8) -> RankingFeatures:
+    # features of data_prefix + '.noise' / '.gt' texts, extracted once and reloaded from store_dir afterwards
+    path = features_store_path(store_dir, os.path.basename(data_prefix), features_names, features_configs)
+    if os.path.exists(path):
+        return RankingFeatures.load(path)
+    texts_noise, texts_gt = get_texts_from_file(data_prefix + '.noise'), get_texts_from_file(data_prefix + '.gt')
+    ranking_features = extract_ranking_features(texts_noise, texts_gt, features_names, features_configs, num_workers)
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    ranking_features.save(path, {'data_prefix': data_prefix, 'version': FEATURES_STORE_VERSION,
+                                 'features_configs': features_configs or {}})
+    return ranking_features
@@ -0,0 +1,95 @@
+from typing import List, Tuple
+
+import torch
+from transformers import AutoModelForMaskedLM, AutoTokenizer
+
+from model.base import CandidatesScorer, SpelledWord
+
+
+class MaskedLMScorer(CandidatesScorer):
+    """
+    Scores candidates in place of the spelled word with an encoder-only masked LM, no decoder passes.
+    All single-token candidates of a spelled word are read from one forward pass with the word masked;
+    a multi-token candidate gets pseudo-log-likelihood: its tokens are masked one at a time, rows of all
+    candidates go to the model in shared padded batches.
+    """
+
+    def __init__(self, checkpoint: str = 'distilroberta-base', device: torch.device = None, batch_size: int = 32,
+                 max_length: int = 128):
+        self.device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+        self.model = AutoModelForMaskedLM.from_pretrained(checkpoint).to(self.device)
+        self.model.eval()
+        self.batch_size = batch_size
+        # tokens of context around the word, so the cost doesn't grow with the text
+        self.max_length = max_length
+
+    def _context(self, spelled_word: SpelledWord) -> Tuple[List[int], List[int], str]:
+        # ids of text before and after the word and the space which goes to the word ('Ġword' is one BPE token)
+        text, start, finish = spelled_word.text, spelled_word.interval[0], spelled_word.interval[1]
+        text_pref = text[:start]
+        space = ' ' if text_pref.endswith(' ') else ''
+        pref_ids = self.tokenizer.encode(text_pref[: len(text_pref) - len(space)], add_special_tokens=False)
+        suff_ids = self.tokenizer.encode(text[finish:], add_special_tokens=False)
+        budget = max(self.max_length // 2 - 4, 0)
+        return pref_ids[-budget:] if budget > 0 else [], suff_ids[:budget], space
+
+    def _rows(self, spelled_words: List[SpelledWord], candidates: List[List[str]]):
+        # (input ids, masked position, [(word index, candidate index, target token)])
+        for i, (spelled_word, cands) in enumerate(zip(spelled_words, candidates)):
+            pref_ids, suff_ids, space = self._context(spelled_word)
+            bos, eos, mask = [self.tokenizer.cls_token_id], [self.tokenizer.sep_token_id], self.tokenizer.mask_token_id
+            single_targets = []
+            for j, cand in enumerate(cands):
+                cand_ids = self.tokenizer.encode(space + cand, add_special_tokens=False)
+                if len(cand_ids) == 1:
+                    single_targets.append((i, j, cand_ids[0]))
+                    continue
+                for k, token_id in enumerate(cand_ids):
+                    masked = cand_ids[:k] + [mask] + cand_ids[k + 1:]
+                    yield bos + pref_ids + masked + suff_ids + eos, 1 + len(pref_ids) + k, [(i, j, token_id)]
+            if len(single_targets) > 0:
+                yield bos + pref_ids + [mask] + suff_ids + eos, 1 + len(pref_ids), single_targets
+
+    def score(self, spelled_words: List[SpelledWord], candidates: List[List[str]]) -> List[List[float]]:
+        # log-probability (pseudo-log-likelihood for multi-token candidates) of every candidate
+        flat_scores = self.score_flat(spelled_words, candidates).tolist()
+        scores, offset = [], 0
+        for cands in candidates:
+            scores.append(flat_scores[offset: offset + len(cands)])
+            offset += len(cands)
+        return scores
+
+    def score_flat(self, spelled_words: List[SpelledWord], candidates: List[List[str]]) -> torch.Tensor:
+        # scores of all candidates one after another [total candidates], on cpu
+        offsets = [0]
+        for cands in candidates:
+            offsets.append(offsets[-1] + len(cands))
+        scores = torch.tensor([0.0 if len(cand) > 0 else float('-inf') for cands in candidates for cand in cands],
+                              dtype=torch.float32, device=self.device)
+        rows = list(self._rows(spelled_words, candidates))
+
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start: start + self.batch_size]
+            max_len = max(len(input_ids) for input_ids, _, _ in batch)
+            pad = self.tokenizer.pad_token_id
+            input_ids = torch.tensor([ids + [pad] * (max_len - len(ids)) for ids, _, _ in batch], device=self.device)
+            attention_mask = torch.tensor([[1] * len(ids) + [0] * (max_len - len(ids)) for ids, _, _ in batch],
+                                          device=self.device)
+            positions = torch.tensor([position for _, position, _ in batch], device=self.device)
+
+            with torch.no_grad():
+                logits = self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+                log_probs = torch.log_softmax(logits[torch.arange(len(batch), device=self.device), positions], dim=-1)
+
+            # one gather for all targets of the batch, summed into candidates' scores on the device
+            row_ids, token_ids, owners = [], [], []
+            for row, (_, _, targets) in enumerate(batch):
+                for i, j, token_id in targets:
+                    row_ids.append(row)
+                    token_ids.append(token_id)
+                    owners.append(offsets[i] + j)
+            values = log_probs[torch.tensor(row_ids, device=self.device), torch.tensor(token_ids, device=self.device)]
+            scores.index_add_(0, torch.tensor(owners, device=self.device), values.to(scores.dtype))
+
+        return scores.cpu()
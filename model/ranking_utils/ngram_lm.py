@@ -0,0 +1,220 @@
+import json
+import math
+import os
+import zlib
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+from tqdm import tqdm
+
+from model.base import CandidatesScorer, SpelledWord
+PATH_PREFIX = '/home/ubuntu/omelnikov/spellchecker/'
+
+
+def ngram_hash(words: List[str], num_buckets: int) -> int:
+    # stable across processes, unlike hash()
+    return zlib.crc32('\x00'.join(words).encode('utf-8')) % num_buckets
+
+
+class HashedNgramLM(CandidatesScorer):
+    """
+    Word n-gram LM over lowercased space-separated tokens with counts in hashed arrays (collisions are ignored).
+    Saved as a directory of .npy arrays which load memory-mapped, so the model isn't read into memory.
+    Scoring is stupid backoff or interpolated Kneser-Ney (absolute discounting on raw counts of higher orders,
+    add-one continuation counts for unigrams).
+    counts[k][h] - count of k-gram with hash h, followers[k][h] - number of distinct words after k-gram,
+    prefix_counts[k][h] - number of (k+1)-grams starting with k-gram (its count without the text ends),
+    continuation[h] - number of distinct words before the word.
+    """
+
+    def __init__(self, order: int = 3, num_buckets: int = 2 ** 22, method: str = 'stupid_backoff',
+                 backoff: float = 0.4, discount: float = 0.75):
+        self.order = order
+        self.num_buckets = num_buckets
+        self.method = method
+        self.backoff = backoff
+        self.discount = discount
+        self.counts: Dict[int, np.ndarray] = {k: np.zeros(num_buckets, dtype=np.uint32) for k in range(1, order + 1)}
+        self.followers: Dict[int, np.ndarray] = {k: np.zeros(num_buckets, dtype=np.uint32) for k in range(1, order)}
+        self.prefix_counts: Dict[int, np.ndarray] = {k: np.zeros(num_buckets, dtype=np.uint32)
+                                                     for k in range(1, order)}
+        self.continuation = np.zeros(num_buckets, dtype=np.uint32)
+        self.total = 0
+        self.bigram_types = 0
+        self.unigram_types = 0
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return text.lower().split()
+
+    def fit(self, texts: List[str], chunk_size: int = 100000):
+        for chunk_start in tqdm(range(0, len(texts), chunk_size), desc='Counting n-grams'):
+            self._count_chunk(texts[chunk_start: chunk_start + chunk_size])
+
+    def _count_chunk(self, texts: List[str]):
+        hashes = {k: [] for k in range(1, self.order + 1)}
+        # hash of the context (k-1 words) and of the last word of every k-gram
+        context_hashes = {k: [] for k in range(2, self.order + 1)}
+        word_hashes = {k: [] for k in range(2, self.order + 1)}
+        for text in texts:
+            words = self.tokenize(text)
+            self.total += len(words)
+            for i in range(len(words)):
+                for k in range(1, min(self.order, i + 1) + 1):
+                    hashes[k].append(ngram_hash(words[i - k + 1: i + 1], self.num_buckets))
+                    if k > 1:
+                        context_hashes[k].append(ngram_hash(words[i - k + 1: i], self.num_buckets))
+                        word_hashes[k].append(ngram_hash(words[i: i + 1], self.num_buckets))
+
+        for k in range(1, self.order + 1):
+            ngrams = np.array(hashes[k], dtype=np.int64)
+            if len(ngrams) == 0:
+                continue
+            unique, first_index = np.unique(ngrams, return_index=True)
+            new = self.counts[k][unique] == 0
+            if k == 1:
+                self.unigram_types += int(new.sum())
+            else:
+                # n-grams seen for the first time add a follower to the context (and a left neighbour to the word)
+                contexts = np.array(context_hashes[k], dtype=np.int64)
+                np.add.at(self.followers[k - 1], contexts[first_index[new]], 1)
+                np.add.at(self.prefix_counts[k - 1], contexts, 1)
+                if k == 2:
+                    np.add.at(self.continuation, np.array(word_hashes[k], dtype=np.int64)[first_index[new]], 1)
+                    self.bigram_types += int(new.sum())
+            np.add.at(self.counts[k], ngrams, 1)
+
+    def _count(self, words: List[str]) -> int:
+        return int(self.counts[len(words)][ngram_hash(words, self.num_buckets)])
+
+    def _prefix_count(self, context: List[str]) -> int:
+        # how many times a word followed the context, denominator of conditional probabilities
+        return int(self.prefix_counts[len(context)][ngram_hash(context, self.num_buckets)])
+
+    def _unigram_prob(self, word: str) -> float:
+        if self.method == 'kneser_ney' and self.bigram_types > 0:
+            # add-one over seen words sums to 1 over the vocabulary, unseen words get the mass of one seen word
+            continuation = int(self.continuation[ngram_hash([word], self.num_buckets)])
+            return (continuation + 1) / (self.bigram_types + self.unigram_types)
+        return (self._count([word]) + 1) / (self.total + self.num_buckets)
+
+    def prob(self, word: str, context: List[str]) -> float:
+        context = context[len(context) - self.order + 1:] if self.order > 1 else []
+        if self.method == 'kneser_ney':
+            return self._kneser_ney_prob(word, context)
+        multiplier = 1.0
+        for start in range(len(context) + 1):
+            cur_context = context[start:]
+            if len(cur_context) == 0:
+                return multiplier * self._unigram_prob(word)
+            count = self._count(cur_context + [word])
+            context_count = self._prefix_count(cur_context)
+            if count > 0 and context_count > 0:
+                return multiplier * count / context_count
+            multiplier *= self.backoff
+        return multiplier * self._unigram_prob(word)
+
+    def _kneser_ney_prob(self, word: str, context: List[str]) -> float:
+        prob = self._unigram_prob(word)
+        for start in range(len(context) - 1, -1, -1):
+            cur_context = context[start:]
+            # contexts seen only at the end of texts have no followers, the level is skipped
+            context_count = self._prefix_count(cur_context)
+            if context_count == 0:
+                continue
+            count = self._count(cur_context + [word])
+            followers = int(self.followers[len(cur_context)][ngram_hash(cur_context, self.num_buckets)])
+            prob = max(count - self.discount, 0) / context_count + \
+                self.discount * followers / context_count * prob
+        return prob
+
+    def log_prob(self, words: List[str], start: int = 0) -> float:
+        # sum of log-probabilities of words[start:] given the words before them
+        return sum(math.log(self.prob(words[i], words[max(0, i - self.order + 1): i]))
+                   for i in range(start, len(words)))
+
+    def _scores(self, spelled_words: List[SpelledWord], candidates: List[List[str]]) -> Iterator[float]:
+        # log-probability of the candidate with the following order-1 words given the words before it,
+        # for all candidates one after another
+        for spelled_word, cands in zip(spelled_words, candidates):
+            text, start, finish = spelled_word.text, spelled_word.interval[0], spelled_word.interval[1]
+            left = self.tokenize(text[:start])[-(self.order - 1):] if self.order > 1 else []
+            right = self.tokenize(text[finish:])[:self.order - 1]
+            for cand in cands:
+                yield self.log_prob(left + self.tokenize(cand) + right, len(left))
+
+    def score(self, spelled_words: List[SpelledWord], candidates: List[List[str]]) -> List[List[float]]:
+        scores = self._scores(spelled_words, candidates)
+        return [[next(scores) for _ in cands] for cands in candidates]
+
+    def score_flat(self, spelled_words: List[SpelledWord], candidates: List[List[str]]) -> np.ndarray:
+        # scores of all candidates one after another [total candidates]
+        return np.fromiter(self._scores(spelled_words, candidates), dtype=np.float64,
+                           count=sum(len(cands) for cands in candidates))
+
+    def save(self, path: str):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for k, counts in self.counts.items():
+            np.save(os.path.join(path, f'counts_{k}.npy'), counts)
+        for k, followers in self.followers.items():
+            np.save(os.path.join(path, f'followers_{k}.npy'), followers)
+        for k, prefix_counts in self.prefix_counts.items():
+            np.save(os.path.join(path, f'prefix_counts_{k}.npy'), prefix_counts)
+        np.save(os.path.join(path, 'continuation.npy'), self.continuation)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'order': self.order, 'num_buckets': self.num_buckets, 'total': self.total,
+                       'bigram_types': self.bigram_types, 'unigram_types': self.unigram_types,
+                       'method': self.method, 'backoff': self.backoff, 'discount': self.discount}, f)
+
+    @classmethod
+    def load(cls, path: str, method: Optional[str] = None, mmap: bool = True) -> 'HashedNgramLM':
+        # method overrides the saved one, the same counts serve both scorings
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        model = cls.__new__(cls)
+        model.order, model.num_buckets = meta['order'], meta['num_buckets']
+        model.total, model.bigram_types, model.unigram_types = meta['total'], meta['bigram_types'], \
+            meta['unigram_types']
+        model.method = method if method is not None else meta['method']
+        model.backoff, model.discount = meta['backoff'], meta['discount']
+        mmap_mode = 'r' if mmap else None
+        model.counts = {k: np.load(os.path.join(path, f'counts_{k}.npy'), mmap_mode=mmap_mode)
+                        for k in range(1, model.order + 1)}
+        model.followers = {k: np.load(os.path.join(path, f'followers_{k}.npy'), mmap_mode=mmap_mode)
+                           for k in range(1, model.order)}
+        model.prefix_counts = {k: np.load(os.path.join(path, f'prefix_counts_{k}.npy'), mmap_mode=mmap_mode)
+                               for k in range(1, model.order)}
+        model.continuation = np.load(os.path.join(path, 'continuation.npy'), mmap_mode=mmap_mode)
+        return model
+
+
+def train():
+    texts = []
+    with open(PATH_PREFIX + 'dataset/1blm/1blm.train.gt') as f:
+        for line in f:
+            texts.append(line[:-1])
+    model = HashedNgramLM(order=3, num_buckets=2 ** 24)
+    model.fit(texts)
+    model.save(PATH_PREFIX + 'model/ranking_utils/ngram_lm_3/')
+
+
+def test():
+    # Kneser-Ney probabilities over the vocabulary sum to 1 and are positive, also after contexts which
+    # only end texts ('it', 'cheese')
+    texts = ['i like it', 'you like cheese', 'the cat sat on the mat'] * 50
+    model = HashedNgramLM(order=3, num_buckets=2 ** 16, method='kneser_ney')
+    model.fit(texts)
+    vocabulary = sorted({word for text in texts for word in model.tokenize(text)})
+    for context in [[], ['it'], ['like'], ['i', 'like'], ['the', 'cat'], ['on', 'the'], ['cheese'], ['the', 'czt']]:
+        probs = [model.prob(word, context) for word in vocabulary]
+        assert abs(sum(probs) - 1) < 1e-6, (context, sum(probs))
+        assert min(probs) > 0, context
+    assert model.prob('very', ['it']) > 0
+    spelled_word = SpelledWord('the czt sat on', (4, 7))
+    print(model.score([spelled_word], [['cat', 'cut', 'czt']]))
+
+
+if __name__ == '__main__':
+    # test()
+    train()
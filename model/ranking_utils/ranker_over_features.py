@@ -1,8 +1,12 @@
 from sklearn.linear_model import LogisticRegression
+import lightgbm as lgb
 import pickle
 import attr
+from typing import Optional, Tuple
 from model.candidator import *
+from model.ranking_utils.features import FeaturesMatrix
 from model.ranking_utils.features_collector import FeaturesCollector
+from model.ranking_utils.features_store import RankingFeatures, extract_spells, load_or_extract_ranking_features
 from tqdm import tqdm
 from data_utils.utils import get_texts_from_file
 import numpy as np
@@ -30,9 +34,17 @@ class RankResult:
 
 class Ranker(ABC):
     @abstractmethod
-    def predict(self, features: List[List[float]]) -> List[float]:
+    def predict_flat(self, matrix: np.ndarray) -> np.ndarray:
+        # scores of all rows of [total candidates, features] matrix in one call
         raise NotImplementedError
 
+    def predict(self, features: FeaturesMatrix) -> List[np.ndarray]:
+        return np.split(self.predict_flat(features.values), features.offsets[1:-1])
+
+    def predict_best(self, features: FeaturesMatrix) -> np.ndarray:
+        # index of the best candidate of every spelled word, -1 if it has no candidates
+        return segmented_argmax(self.predict_flat(features.values), features.offsets)
+
     @abstractmethod
     def fit(self, train_data: List[RankQuery], test_data: List[RankQuery]):
         raise NotImplementedError
@@ -50,15 +62,33 @@ class Ranker(ABC):
         raise NotImplementedError
 
 
+def segmented_argmax(scores: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    # index of the first best score inside every segment, -1 for empty segments
+    lengths = np.diff(offsets)
+    best = np.full(len(lengths), -1, dtype=np.int64)
+    non_empty = np.flatnonzero(lengths > 0)
+    if len(non_empty) == 0:
+        return best
+    segment_ids = np.repeat(np.arange(len(lengths)), lengths)
+    maxes = np.maximum.reduceat(scores, offsets[non_empty])
+    segment_max = np.empty(len(lengths), dtype=scores.dtype)
+    segment_max[non_empty] = maxes
+    positions = np.flatnonzero(scores == segment_max[segment_ids])
+    segments, first = np.unique(segment_ids[positions], return_index=True)
+    best[segments] = positions[first] - offsets[segments]
+    return best
+
+
 class LogisticRegressionRanker(Ranker):
     def __init__(self):
         self.model = LogisticRegression(random_state=0)
 
-    def predict(self, features: List[List[List[float]]]) -> List[List[float]]:
-        res = []
-        for cur_features in features:
-            res.append(self.model.predict_proba(cur_features)[:, 1])
-        return res
+    def predict_flat(self, matrix: np.ndarray) -> np.ndarray:
+        # same as predict_proba(matrix)[:, 1] of the binary model without sklearn validation per call
+        if len(matrix) == 0:
+            return np.zeros(0, dtype=np.float64)
+        logits = matrix @ self.model.coef_[0] + self.model.intercept_[0]
+        return 1.0 / (1.0 + np.exp(-logits))
 
     def fit(self, train_data: List[RankQuery], test_data: List[RankQuery]):
         X_train, y_train = [], []
@@ -95,6 +125,55 @@ class LogisticRegressionRanker(Ranker):
         self.model = pickle.load(open(path, 'rb'))
 
 
+def queries_to_arrays(data: List[RankQuery]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # features [total variants, features], targets and number of variants of every query
+    X = np.array([variant.features for rq in data for variant in rq.variants], dtype=np.float32)
+    y = np.array([variant.target for rq in data for variant in rq.variants], dtype=np.float32)
+    group_sizes = np.array([len(rq.variants) for rq in data], dtype=np.int64)
+    return X, y, group_sizes
+
+
+class LightGBMRanker(Ranker):
+    # lambdarank over candidates of every spelled word, model is kept as a native booster (text format)
+    def __init__(self, num_leaves: int = 15, learning_rate: float = 0.05, num_boost_round: int = 300,
+                 min_data_in_leaf: int = 20, early_stopping_rounds: Optional[int] = 30):
+        self.params = {'objective': 'lambdarank', 'metric': 'ndcg', 'eval_at': [1, 3], 'num_leaves': num_leaves,
+                       'learning_rate': learning_rate, 'min_data_in_leaf': min_data_in_leaf, 'verbose': -1}
+        self.num_boost_round = num_boost_round
+        self.early_stopping_rounds = early_stopping_rounds
+        self.model: Optional[lgb.Booster] = None
+
+    def predict_flat(self, matrix: np.ndarray) -> np.ndarray:
+        if len(matrix) == 0:
+            return np.zeros(0, dtype=np.float64)
+        # one thread: for a sentence worth of candidates thread startup costs more than the trees
+        return self.model.predict(matrix, num_threads=1)
+
+    def fit(self, train_data: List[RankQuery], test_data: List[RankQuery]):
+        # test_data is used for early stopping and the printed accuracy, it must not share queries with train_data
+        X_train, y_train, group_train = queries_to_arrays(train_data)
+        X_test, y_test, group_test = queries_to_arrays(test_data)
+        train_set = lgb.Dataset(X_train, y_train, group=group_train)
+        test_set = lgb.Dataset(X_test, y_test, group=group_test, reference=train_set)
+        self.model = lgb.train(self.params, train_set, num_boost_round=self.num_boost_round, valid_sets=[test_set],
+                               early_stopping_rounds=self.early_stopping_rounds)
+
+        offsets = np.concatenate([[0], np.cumsum(group_test)])
+        best = segmented_argmax(self.predict_flat(X_test), offsets)
+        has_best = best >= 0
+        accuracy = y_test[offsets[:-1][has_best] + best[has_best]].mean() if has_best.any() else 0.0
+        print('Accuracy of the top candidate on test queries:', accuracy)
+
+    def importance_info(self):
+        print(f'LightGBM feature importance (gain): {self.model.feature_importance(importance_type="gain")}')
+
+    def save(self, path: str):
+        self.model.save_model(path)
+
+    def load(self, path: str):
+        self.model = lgb.Booster(model_file=path)
+
+
 @attr.s(auto_attribs=True, frozen=True)
 class Spell:
     spelled: str
@@ -107,43 +186,37 @@ class SpelledText:
     spells: List[Spell]
 
 
-def prepare_ranking_training_data(features_collector: FeaturesCollector) -> List[RankQuery]:
-    texts_noise, texts_gt = get_texts_from_file(PATH_PREFIX + 'dataset/bea/bea50.noise'), \
-                            get_texts_from_file(PATH_PREFIX + 'dataset/bea/bea50.gt')
-    labeled_data = []
-    spelled_words = []
-    gt_words = []
-    for text_noise, text_gt in tqdm(zip(texts_noise, texts_gt), total=len(texts_noise)):
-        words_noise, words_gt = text_noise.split(' '), text_gt.split(' ')
-        if len(words_noise) != len(words_gt):
-            continue
-        cur_shift = 0
-        for idx, (word_noise, word_gt) in enumerate(zip(words_noise, words_gt)):
-            if word_noise != word_gt:
-                start = cur_shift
-                end = start + len(word_noise)
-                spelled_word = SpelledWord(text_noise, interval=(start, end))
-                spelled_words.append(spelled_word)
-                gt_words.append(word_gt)
-            cur_shift += len(word_noise) + 1
-    candidates = HunspellCandidator().get_candidates('fictive string', spelled_words)
-    all_features = features_collector.collect(spelled_words, candidates)
-
-    # DEBUG
-    # for i, j, k in zip(spelled_words, candidates, all_features):
-    #     print(i)
-    #     print(j)
-    #     print(k)
-    #     print()
-
-    for idx in range(len(spelled_words)):
-        variants = []
-        for jdx in range(len(candidates[idx])):
-            target = int(candidates[idx][jdx] == gt_words[idx])
-            variants.append(RankVariant(all_features[idx][jdx], target))
-        labeled_data.append(RankQuery(idx, variants))
-
-    return labeled_data
+def prepare_ranking_training_data(features_collector: FeaturesCollector,
+                                  data_prefix: str = PATH_PREFIX + 'dataset/bea/bea50',
+                                  store_dir: Optional[str] = None, num_workers: int = 8) -> List[RankQuery]:
+    # with store_dir features are extracted by worker processes once and later runs reload them from there
+    if store_dir is not None:
+        ranking_features = load_or_extract_ranking_features(data_prefix, store_dir, features_collector.features_names,
+                                                            features_collector.features_configs, num_workers)
+    else:
+        texts_noise, texts_gt = get_texts_from_file(data_prefix + '.noise'), get_texts_from_file(data_prefix + '.gt')
+        spelled_words, gt_words, text_ids = extract_spells(texts_noise, texts_gt)
+        candidates = HunspellCandidator().get_candidates('fictive string', spelled_words)
+        targets = np.array([float(cand == gt_word) for gt_word, cands in zip(gt_words, candidates) for cand in cands],
+                           dtype=np.float32)
+        ranking_features = RankingFeatures(features_collector.collect(spelled_words, candidates), targets,
+                                           np.array(text_ids, dtype=np.int64), candidates)
+
+    rows, offsets = ranking_features.features.values.tolist(), ranking_features.features.offsets
+    targets = ranking_features.targets.tolist()
+    # query id is the id of the text the spelled word comes from
+    query_ids = ranking_features.query_ids.tolist()
+    return [RankQuery(query_ids[idx], [RankVariant(rows[jdx], targets[jdx])
+                                       for jdx in range(offsets[idx], offsets[idx + 1])])
+            for idx in range(len(offsets) - 1)]
+
+
+def split_queries(queries: List[RankQuery], test_fraction: float = 0.2,
+                  seed: int = 0) -> Tuple[List[RankQuery], List[RankQuery]]:
+    # train / test split by query id, so spelled words of one text never end up on both sides
+    ids = np.unique([rq.id for rq in queries])
+    test_ids = set(np.random.RandomState(seed).permutation(ids)[:int(len(ids) * test_fraction)].tolist())
+    return [rq for rq in queries if rq.id not in test_ids], [rq for rq in queries if rq.id in test_ids]
 
 
 def train():
@@ -155,6 +228,39 @@ def train():
     model.importance_info()
 
 
+def train_ngram_levenshtein():
+    # CPU-only meta ranker: n-gram LM and edit distance
+    model = LogisticRegressionRanker()
+    data_ranker_train = prepare_ranking_training_data(FeaturesCollector(features_names=['ngram_lm', 'levenshtein']))
+    model.fit(data_ranker_train, data_ranker_train)
+    model.save(PATH_PREFIX + 'model/ranking_utils/ngram_lev_ranker.pickle')
+    model.importance_info()
+
+
+def train_cheap_features():
+    # lightweight tier: only table lookups and vectorized edit costs, compare with levenshtein-only ranker
+    features_names = ['levenshtein', 'keyboard_edit', 'unigram_freq', 'soundex_match', 'case_match', 'length_diff']
+    model = LogisticRegressionRanker()
+    data_ranker_train = prepare_ranking_training_data(FeaturesCollector(features_names=features_names),
+                                                      store_dir=PATH_PREFIX + 'model/ranking_utils/features_store/')
+    model.fit(data_ranker_train, data_ranker_train)
+    model.save(PATH_PREFIX + 'model/ranking_utils/cheap_features_ranker.pickle')
+    model.importance_info()
+
+
+def train_lightgbm_cheap_features():
+    features_names = ['levenshtein', 'keyboard_edit', 'unigram_freq', 'soundex_match', 'case_match', 'length_diff',
+                      'ngram_lm']
+    model = LightGBMRanker()
+    data_ranker_train = prepare_ranking_training_data(FeaturesCollector(features_names=features_names),
+                                                      data_prefix=PATH_PREFIX + 'dataset/bea/bea60k',
+                                                      store_dir=PATH_PREFIX + 'model/ranking_utils/features_store/')
+    data_ranker_train, data_ranker_test = split_queries(data_ranker_train)
+    model.fit(data_ranker_train, data_ranker_test)
+    model.save(PATH_PREFIX + 'model/ranking_utils/lightgbm_cheap_features_ranker.txt')
+    model.importance_info()
+
+
 def test():
     data_ranker_train = prepare_ranking_training_data(FeaturesCollector(features_names=['bart_prob', 'levenshtein']))
     print(data_ranker_train)
@@ -8,11 +8,18 @@ import transformers
 from model.detector import *
 from model.candidator import *
 from model.ranker import *
+from model.cache import LRUCache, CorrectionsMemo, hash_key
+from model.decoding import copy_speculative_greedy, CopyConstraint, DecodingPolicy
+from model.joint_bart import BartForJointDetectionCorrection, BaseModelOutput
+from model import tag_and_pick
+from model.tag_and_pick import TagAndPickModel
 
 PATH_PREFIX = '/home/ubuntu/omelnikov/spellchecker/'
 
 
 class SpellCheckModelBase(ABC):
+    # True for checkers which lower-case all-caps texts and upper-case the result back
+    folds_caps: bool = False
 
     @abstractmethod
     def correct(self, text: str) -> str:
@@ -28,10 +35,130 @@ class SpellCheckModelBase(ABC):
                     dest_texts.write(self.correct(text[:-1]) + '\n')
 
 
+class CachedChecker(SpellCheckModelBase):
+    """
+    Wraps any checker with a cache of corrected sentences keyed by (checker id, normalized text).
+    With fold_caps, an all-caps text shares the entry of its lower-cased version; by default it's on only for
+    checkers which fold caps themselves, so the cache never changes results. Duplicates inside one
+    correct_strings call are corrected once. The default checker id includes the settings which change
+    corrections, so differently configured checkers can share one LRUCache.
+    """
+
+    # settings of checkers (or of their scorer) which change corrections
+    CONFIG_ATTRIBUTES = ['checkpoint', 'decoding_policy', 'speculative', 'context_window', 'threshold']
+
+    def __init__(self, checker: SpellCheckModelBase, cache: LRUCache = None, checker_id: str = None,
+                 fold_caps: Optional[bool] = None):
+        self.checker = checker
+        self.cache = cache if cache is not None else LRUCache(max_size=100000)
+        self.checker_id = checker_id or self.default_checker_id(checker)
+        self.fold_caps = fold_caps if fold_caps is not None else checker.folds_caps
+        self.in_batch_duplicates = 0
+
+    def __str__(self):
+        return str(self.checker)
+
+    @classmethod
+    def default_checker_id(cls, checker: SpellCheckModelBase) -> str:
+        parts = [type(checker).__name__]
+        for attribute in cls.CONFIG_ATTRIBUTES:
+            for owner in [checker, getattr(checker, 'scorer', None)]:
+                if owner is not None and hasattr(owner, attribute):
+                    parts.append(f'{attribute}={getattr(owner, attribute)!r}')
+                    break
+        for stage in ['detector', 'candidator', 'ranker']:
+            if hasattr(checker, stage):
+                parts.append(f'{stage}={type(getattr(checker, stage)).__name__}')
+        return ':'.join(parts)
+
+    def _normalize(self, text: str) -> Tuple[str, bool]:
+        caps = self.fold_caps and text.upper() == text
+        return (text.lower() if caps else text), caps
+
+    def correct(self, text: str) -> str:
+        return self.correct_strings([text])[0]
+
+    def correct_strings(self, texts: List[str]) -> List[str]:
+        normalized = [self._normalize(text) for text in texts]
+        keys = [hash_key(self.checker_id, norm_text) for norm_text, _ in normalized]
+
+        results: Dict[bytes, str] = {}
+        missed: Dict[bytes, str] = {}
+        for key, (norm_text, _) in zip(keys, normalized):
+            if key in results or key in missed:
+                self.in_batch_duplicates += 1
+                continue
+            cached_result = self.cache.get(key)
+            if cached_result is not None:
+                results[key] = cached_result
+            else:
+                missed[key] = norm_text
+
+        if len(missed) > 0:
+            for key, result in zip(missed.keys(), self.checker.correct_strings(list(missed.values()))):
+                self.cache.put(key, result)
+                results[key] = result
+
+        return [results[key].upper() if caps else results[key] for key, (_, caps) in zip(keys, normalized)]
+
+    def stats(self) -> Dict[str, float]:
+        return {**self.cache.stats(), 'In-batch duplicates': self.in_batch_duplicates}
+
+
+class DocumentChecker(SpellCheckModelBase):
+    """
+    Long texts: split into sentences, run the detector on each one and send only sentences with detected errors
+    to the checker, in batches of batch_size. Corrected sentences are put back at their offsets, so whitespace
+    between sentences is kept and the checker never sees more than one sentence.
+    """
+
+    def __init__(self, checker: SpellCheckModelBase, detector: BaseDetector = None, batch_size: int = 16):
+        self.checker = checker
+        self.detector = detector if detector is not None else HunspellDetector()
+        self.batch_size = batch_size
+        self._tokenizer = SyntokTextTokenizer()
+        self.sentences = 0
+        self.corrected_sentences = 0
+
+    def __str__(self):
+        return f'Document mode, {str(self.checker)}'
+
+    def correct(self, text: str) -> str:
+        return self.correct_strings([text])[0]
+
+    def correct_strings(self, texts: List[str]) -> List[str]:
+        # (text index, sentence interval) of sentences with errors, batched across all texts
+        sentences: List[Tuple[int, Tuple[int, int]]] = [(text_idx, span) for text_idx, text in enumerate(texts)
+                                                         for span in self._tokenizer.split_to_sentence_spans(text)]
+        spells = self.detector.detect_batch([texts[text_idx][start:end] for text_idx, (start, end) in sentences])
+        erroneous = [sentence for sentence, sentence_spells in zip(sentences, spells) if len(sentence_spells) > 0]
+        self.sentences += len(sentences)
+        self.corrected_sentences += len(erroneous)
+
+        corrections: List[str] = []
+        for batch_start in range(0, len(erroneous), self.batch_size):
+            batch = erroneous[batch_start: batch_start + self.batch_size]
+            corrections.extend(self.checker.correct_strings([texts[text_idx][start:end]
+                                                             for text_idx, (start, end) in batch]))
+
+        # put sentences back from the end, so offsets of previous ones stay valid
+        results = list(texts)
+        for (text_idx, (start, end)), correction in reversed(list(zip(erroneous, corrections))):
+            results[text_idx] = results[text_idx][:start] + correction + results[text_idx][end:]
+        return results
+
+    def stats(self) -> Dict[str, float]:
+        return {'Sentences': self.sentences, 'Corrected sentences': self.corrected_sentences}
+
+
 class OldBartChecker(SpellCheckModelBase):
+    folds_caps = True
+
     def __init__(self, checkpoint: str = 'No learning', model: BartForConditionalGeneration = None,
-                 device: torch.device = None, tokenizer: RobertaTokenizer = None):
+                 device: torch.device = None, tokenizer: RobertaTokenizer = None,
+                 decoding_policy: Optional[DecodingPolicy] = None):
         self.checkpoint = checkpoint
+        self.decoding_policy = decoding_policy if decoding_policy is not None else DecodingPolicy()
         transformers.set_seed(42)
         if tokenizer is None:
             self.tokenizer = BartTokenizer.from_pretrained('facebook/bart-base')
@@ -78,8 +205,8 @@ class OldBartChecker(SpellCheckModelBase):
             text = text[: shift + spell.interval[0]] + '<mask>' + text[shift + spell.interval[1]:]
             shift += 6 - len(spell.word)
 
-        ans_ids = self.model.generate(self.tokenizer([text], return_tensors='pt').to(self.device)["input_ids"],
-                                      num_beams=5, min_length=5, max_length=500)
+        input_ids = self.tokenizer([text], return_tensors='pt').to(self.device)["input_ids"]
+        ans_ids = self.model.generate(input_ids, **self.decoding_policy.generate_kwargs(input_ids.shape[1], len(spells)))
         ans_tokens = self.tokenizer.batch_decode(ans_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
         text = ' '.join(ans_tokens)
 
@@ -93,9 +220,13 @@ class OldBartChecker(SpellCheckModelBase):
 
 
 class DCR(SpellCheckModelBase):
-    def __init__(self):
+    folds_caps = True
+
+    def __init__(self, context_window: Optional[int] = None, scores_cache: Optional[LRUCache] = None,
+                 memo: Optional[CorrectionsMemo] = None):
         self.detector: BaseDetector = HunspellDetector()
         self.candidator: BaseCandidator = HunspellCandidator()
+        self.memo = memo
 
         checkpoint_path = PATH_PREFIX + 'training/checkpoints/bart-sep-mask-all-sent-distil-dec05_v0_81396.pt'
         config = BartConfig(vocab_size=50265, max_position_embeddings=1024, encoder_layers=6, encoder_ffn_dim=3072,
@@ -112,11 +243,19 @@ class DCR(SpellCheckModelBase):
         model.eval()
         self.ranker_tokenizer = BartTokenizer.from_pretrained('facebook/bart-base')
         self.ranker_model: BartForConditionalGeneration = model
+        self.scorer = BartCandidatesScorer(self.ranker_model, self.ranker_tokenizer, self.device,
+                                           input_format=sep_mask_input_format, context_window=context_window,
+                                           cache=scores_cache, model_id=checkpoint_path)
 
     def from_pretrained(self):
         self.ranker_model = BartForConditionalGeneration.from_pretrained('melnikoff-oleg/distilbart-sep-mask-all')
         self.ranker_model.to(self.device)
+        self.ranker_model.eval()
         self.ranker_tokenizer = BartTokenizer.from_pretrained('melnikoff-oleg/distilbart-sep-mask-all')
+        self.scorer = BartCandidatesScorer(self.ranker_model, self.ranker_tokenizer, self.device,
+                                           input_format=sep_mask_input_format,
+                                           context_window=self.scorer.context_window, cache=self.scorer.cache,
+                                           model_id='melnikoff-oleg/distilbart-sep-mask-all')
 
     def correct(self, text: str, return_all_stages: bool = False) -> str:
 
@@ -125,6 +264,9 @@ class DCR(SpellCheckModelBase):
             text = text.lower()
 
         spelled_words = self.detector.detect(text)
+        memo_words, memo_corrections = [], []
+        if self.memo is not None:
+            spelled_words, memo_words, memo_corrections = self.memo.split(spelled_words)
         candidates = self.candidator.get_candidates(text, spelled_words)
 
         _spelled_words, _candidates = [], []
@@ -134,54 +276,14 @@ class DCR(SpellCheckModelBase):
                 _candidates.append(cands)
         spelled_words, candidates = _spelled_words, _candidates
 
-        texts = []
-        outs = []
-        texts_inds = []
-        cands_ranges = []
-        for i, (spelled_word, cands) in enumerate(zip(spelled_words, candidates)):
-            text, start, finish = spelled_word.text, spelled_word.interval[0], spelled_word.interval[1]
-            text_pref = text[: start]
-            text_suff = text[finish:]
-            if (start == 0 or text[start - 1] == ' ') and (finish == len(text) or not text[finish].isalpha()):
-                texts_inds += [i for _ in cands]
-
-                input_texts = [spelled_word.word + ' </s> ' + text_pref + '<mask>' + text_suff for _ in cands]
-                output_texts = [text_pref + syn + text_suff for syn in cands]
-
-                texts += input_texts
-                outs += output_texts
-                cands_ranges += [(len(self.ranker_tokenizer.encode(text_pref[:-1])),
-                                  len(self.ranker_tokenizer.encode(syn, add_special_tokens=False))) for syn in cands]
-            else:
+        for spelled_word, cands in zip(spelled_words, candidates):
+            if not is_separate_word(spelled_word):
                 print('Error with SpelledWord')
                 print('SpelledWord:', spelled_word)
                 print('Candidates:', cands)
                 raise Exception
 
-        batch_size = 16
-
-        scores: List[List[float]] = [[] for _ in spelled_words]
-
-        for start in range(0, len(texts), batch_size):
-            end = min(start + batch_size, len(texts))
-
-            encoded_input = self.ranker_tokenizer(texts[start: end], return_tensors='pt', truncation=True,
-                                           padding=True).to(self.device)['input_ids']
-            encoded_output = self.ranker_tokenizer(outs[start: end], return_tensors='pt', truncation=True,
-                                            padding=True).to(self.device)['input_ids']
-
-            # BART eval
-            all_logits = self.ranker_model(encoded_input, labels=encoded_output).logits.cpu()
-
-            for i, logits in enumerate(all_logits):
-                ind = texts_inds[start + i]
-                syn_range = cands_ranges[start + i]
-                word_logits = logits[syn_range[0] - 1: syn_range[0] + syn_range[1] - 1]
-                log_probs = torch.log_softmax(word_logits, dim=1)
-                word_log_prob = torch.tensor(0.0)
-                for j, token_idx in enumerate(encoded_output[i][syn_range[0] - 1: syn_range[0] + syn_range[1] - 1]):
-                    word_log_prob += log_probs[j, token_idx]
-                scores[ind].append(word_log_prob.item())
+        scores: List[List[float]] = self.scorer.score(spelled_words, candidates)
 
         result: List[str] = ['' for _ in spelled_words]
 
@@ -196,6 +298,13 @@ class DCR(SpellCheckModelBase):
 
         corrections = result
 
+        if self.memo is not None:
+            if self.memo.learn_online:
+                for spelled_word, correction in zip(spelled_words, corrections):
+                    self.memo.observe(spelled_word, correction)
+            spelled_words, candidates, corrections = CorrectionsMemo.merge(spelled_words, candidates, corrections,
+                                                                           memo_words, memo_corrections)
+
         shift = 0
         res_text = text
         for i, spelled_word in enumerate(spelled_words):
@@ -213,10 +322,14 @@ class DCR(SpellCheckModelBase):
 
 
 class DetectorCandidatorRanker(SpellCheckModelBase):
-
-    def __init__(self):
-        self.detector: BaseDetector = HunspellDetector()
-        self.candidator: BaseCandidator = HunspellCandidator()
+    folds_caps = True
+
+    def __init__(self, memo: Optional[CorrectionsMemo] = None, detector: Optional[BaseDetector] = None,
+                 candidator: Optional[BaseCandidator] = None, ranker: Optional[BaseRanker] = None):
+        # StoredDetector / StoredCandidator from model.stage_store replay precomputed stages for ranker experiments
+        self.detector: BaseDetector = detector if detector is not None else HunspellDetector()
+        self.candidator: BaseCandidator = candidator if candidator is not None else HunspellCandidator()
+        self.memo = memo
         # self.ranker: BaseRanker = BartRanker()
         # config = BartConfig(vocab_size=50265, max_position_embeddings=1024, encoder_layers=6, encoder_ffn_dim=3072,
         #                     encoder_attention_heads=12, decoder_layers=3, decoder_ffn_dim=3072,
@@ -236,7 +349,7 @@ class DetectorCandidatorRanker(SpellCheckModelBase):
         #     checkpoint_path=PATH_PREFIX + 'training/checkpoints/bart-sep-mask-all-sent_v0_1236504.pt',
         #     device=torch.device('cuda'))
         # self.ranker: BaseRanker = BartFineTuneRanker()
-        self.ranker: BaseRanker = LogisticRegressionMetaRanker()
+        self.ranker: BaseRanker = ranker if ranker is not None else FeaturesMetaRanker()
 
     def correct(self, text: str, return_all_stages: bool = False):
 
@@ -252,6 +365,10 @@ class DetectorCandidatorRanker(SpellCheckModelBase):
         # DEBUG
         print(f'Detections: {spelled_words}')
 
+        memo_words, memo_corrections = [], []
+        if self.memo is not None:
+            spelled_words, memo_words, memo_corrections = self.memo.split(spelled_words)
+
         candidates = self.candidator.get_candidates(text, spelled_words)
 
         # DEBUG
@@ -269,6 +386,13 @@ class DetectorCandidatorRanker(SpellCheckModelBase):
         # DEBUG
         print(f'Corrections: {corrections}')
 
+        if self.memo is not None:
+            if self.memo.learn_online:
+                for spelled_word, correction in zip(spelled_words, corrections):
+                    self.memo.observe(spelled_word, correction)
+            spelled_words, candidates, corrections = CorrectionsMemo.merge(spelled_words, candidates, corrections,
+                                                                           memo_words, memo_corrections)
+
         shift = 0
         res_text = text
         for i, spelled_word in enumerate(spelled_words):
@@ -291,8 +415,9 @@ class CharBasedTransformerChecker(SpellCheckModelBase):
                              "merges_file": PATH_PREFIX + "data_utils/char_based_transformer_vocab/merges.txt"}
 
     def __init__(self, config, checkpoint: str = 'No learning', model: BartForConditionalGeneration = None,
-                 device: torch.device = None):
+                 device: torch.device = None, decoding_policy: Optional[DecodingPolicy] = None):
         self.checkpoint = checkpoint
+        self.decoding_policy = decoding_policy if decoding_policy is not None else DecodingPolicy()
         transformers.set_seed(42)
         self.tokenizer = CharBasedTransformerChecker.BartTokenizer(
             PATH_PREFIX + "data_utils/char_based_transformer_vocab/url_vocab.json",
@@ -322,8 +447,8 @@ class CharBasedTransformerChecker(SpellCheckModelBase):
 
     def correct(self, text: str) -> str:
         text = text.replace(' ', '_')
-        ans_ids = self.model.generate(self.tokenizer([text], return_tensors='pt').to(self.device)["input_ids"],
-                                      num_beams=5, min_length=5, max_length=500)
+        input_ids = self.tokenizer([text], return_tensors='pt').to(self.device)["input_ids"]
+        ans_ids = self.model.generate(input_ids, **self.decoding_policy.generate_kwargs(input_ids.shape[1]))
         ans_tokens = self.tokenizer.batch_decode(ans_ids, skip_special_tokens=False, clean_up_tokenization_spaces=False)
         for ind, i in enumerate(ans_tokens):
             ans_tokens[ind] = ans_tokens[ind].replace('_', ' ')[7:].split('<')[0]
@@ -355,9 +480,15 @@ class SpellCheckModelNeuSpell(SpellCheckModelBase):
 
 class BartChecker(SpellCheckModelBase):
 
+    # speculative: greedy decoding with the input sentence as a draft (see copy_speculative_greedy)
     def __init__(self, checkpoint: str = 'No learning', model: BartForConditionalGeneration = None,
-                 device: torch.device = None):
+                 device: torch.device = None, speculative: bool = False, draft_len: int = 10,
+                 decoding_policy: Optional[DecodingPolicy] = None):
         self.checkpoint = checkpoint
+        self.decoding_policy = decoding_policy if decoding_policy is not None else DecodingPolicy()
+        self.speculative = speculative
+        self.draft_len = draft_len
+        self.speculative_stats = {'Decoder calls': 0, 'Tokens': 0}
         transformers.set_seed(42)
         self.tokenizer = BartTokenizer.from_pretrained('facebook/bart-base')
         if device is None:
@@ -389,11 +520,173 @@ class BartChecker(SpellCheckModelBase):
         return f'BART, checkpoint: {self.checkpoint.split("/")[-1]}'
 
     def correct(self, text: str) -> str:
-        ans_ids = self.model.generate(self.tokenizer([text], return_tensors='pt').to(self.device)["input_ids"],
-                                      num_beams=5, min_length=5, max_length=500)
+        input_ids = self.tokenizer([text], return_tensors='pt').to(self.device)["input_ids"]
+        generate_kwargs = self.decoding_policy.generate_kwargs(input_ids.shape[1])
+        if self.speculative:
+            output, decoder_calls = copy_speculative_greedy(self.model, input_ids,
+                                                            min_length=generate_kwargs['min_length'],
+                                                            max_length=generate_kwargs['max_length'],
+                                                            draft_len=self.draft_len)
+            self.speculative_stats['Decoder calls'] += decoder_calls
+            self.speculative_stats['Tokens'] += len(output) - 1
+            ans_ids = torch.tensor([output])
+        else:
+            ans_ids = self.model.generate(input_ids, **generate_kwargs)
         ans_tokens = self.tokenizer.batch_decode(ans_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
         return ' '.join(ans_tokens)
 
+    def correct_strings(self, texts: List[str]) -> List[str]:
+        # speculative decoding works with one sentence at a time
+        if self.speculative or len(texts) == 0:
+            return super().correct_strings(texts)
+        batch = self.tokenizer(texts, return_tensors='pt', padding=True).to(self.device)
+        ans_ids = self.model.generate(batch["input_ids"], attention_mask=batch["attention_mask"],
+                                      **self.decoding_policy.generate_kwargs(batch["input_ids"].shape[1]))
+        return self.tokenizer.batch_decode(ans_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+
+class JointBartChecker(SpellCheckModelBase):
+    # BartForJointDetectionCorrection: encoder tags errors, decoder runs with the same encoder outputs
+    # and only for texts with at least one token above the threshold
+
+    def __init__(self, checkpoint: str = 'No learning', model: BartForJointDetectionCorrection = None,
+                 device: torch.device = None, tokenizer: RobertaTokenizer = None, threshold: float = 0.5,
+                 decoding_policy: Optional[DecodingPolicy] = None):
+        self.checkpoint = checkpoint
+        self.threshold = threshold
+        self.decoding_policy = decoding_policy if decoding_policy is not None else DecodingPolicy()
+        self.sentences = 0
+        self.decoded_sentences = 0
+        transformers.set_seed(42)
+        if tokenizer is None:
+            self.tokenizer = BartTokenizer.from_pretrained('facebook/bart-base')
+        else:
+            self.tokenizer = tokenizer
+        if device is None:
+            self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        else:
+            self.device = device
+
+        if model is not None:
+            self.model = model
+        else:
+            if checkpoint == 'No learning':
+                self.model = BartForJointDetectionCorrection.from_pretrained('facebook/bart-base')
+            else:
+                config = BartForConditionalGeneration.from_pretrained('facebook/bart-base').config
+                self.model = BartForJointDetectionCorrection(config)
+                # Model was trained on GPU, maybe we are inferring on CPU
+                if self.device == torch.device('cpu'):
+                    self.model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+                else:
+                    self.model.load_state_dict(torch.load(checkpoint, map_location=self.device))
+
+        self.model = self.model.to(self.device)
+
+    def __str__(self):
+        return f'Joint BART, checkpoint: {self.checkpoint.split("/")[-1]}'
+
+    def correct(self, text: str) -> str:
+        return self.correct_strings([text])[0]
+
+    def correct_strings(self, texts: List[str]) -> List[str]:
+        if len(texts) == 0:
+            return []
+        batch = self.tokenizer(texts, return_tensors='pt', padding=True).to(self.device)
+        with torch.no_grad():
+            encoder_outputs, detection_logits = self.model.detect_tokens(batch["input_ids"], batch["attention_mask"])
+            error_tokens = (torch.softmax(detection_logits, dim=-1)[:, :, 1] > self.threshold) & \
+                           batch["attention_mask"].bool()
+        num_errors = error_tokens.sum(dim=1)
+        rows = num_errors.gt(0).nonzero().view(-1)
+        self.sentences += len(texts)
+        self.decoded_sentences += len(rows)
+
+        results = list(texts)
+        if len(rows) == 0:
+            return results
+        ans_ids = self.model.generate(batch["input_ids"][rows], attention_mask=batch["attention_mask"][rows],
+                                      encoder_outputs=BaseModelOutput(
+                                          last_hidden_state=encoder_outputs.last_hidden_state[rows]),
+                                      **self.decoding_policy.generate_kwargs(batch["input_ids"].shape[1],
+                                                                             num_errors.max().item()))
+        answers = self.tokenizer.batch_decode(ans_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+        for row, answer in zip(rows.tolist(), answers):
+            results[row] = answer
+        return results
+
+    def stats(self) -> Dict[str, float]:
+        return {'Sentences': self.sentences, 'Decoded sentences': self.decoded_sentences}
+
+
+class TagAndPickChecker(SpellCheckModelBase):
+    # Non-autoregressive: words tagged as replace get the best scored candidate, others are kept,
+    # so tokenization by spaces is always preserved
+
+    def __init__(self, checkpoint: str = 'No learning', model: TagAndPickModel = None, device: torch.device = None,
+                 tokenizer=None, candidator: BaseCandidator = None, threshold: float = 0.5, batch_size: int = 32):
+        self.checkpoint = checkpoint
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.candidator = candidator if candidator is not None else HunspellCandidator()
+        if device is None:
+            self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        else:
+            self.device = device
+
+        if model is not None:
+            self.model = model
+        elif checkpoint == 'No learning':
+            self.model = TagAndPickModel()
+        else:
+            self.model = TagAndPickModel.load(checkpoint, self.device)
+        self.model = self.model.to(self.device)
+        self.model.eval()
+        if tokenizer is None:
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model.encoder_checkpoint)
+        else:
+            self.tokenizer = tokenizer
+
+    def __str__(self):
+        return f'Tag and pick, checkpoint: {self.checkpoint.split("/")[-1]}'
+
+    def correct(self, text: str) -> str:
+        return self.correct_strings([text])[0]
+
+    def correct_strings(self, texts: List[str]) -> List[str]:
+        results = []
+        for batch_start in range(0, len(texts), self.batch_size):
+            results.extend(self._correct_batch(texts[batch_start: batch_start + self.batch_size]))
+        return results
+
+    def _correct_batch(self, texts: List[str]) -> List[str]:
+        words_batch = [text.split(' ') for text in texts]
+        input_ids, attention_mask, word_index, word_mask = tag_and_pick.encode_words(self.tokenizer, words_batch,
+                                                                                      self.device)
+        with torch.no_grad():
+            word_states, tag_logits = self.model.encode(input_ids, attention_mask, word_index)
+            replace = (torch.softmax(tag_logits, dim=-1)[:, :, 1] > self.threshold) & word_mask
+            rows, word_ids = replace.nonzero(as_tuple=True)
+            if len(rows) == 0:
+                return texts
+
+            # candidates only for words tagged as replace
+            spelled_words, positions = [], []
+            for row, word_idx in zip(rows.tolist(), word_ids.tolist()):
+                start = sum(len(word) + 1 for word in words_batch[row][:word_idx])
+                spelled_words.append(SpelledWord(texts[row], (start, start + len(words_batch[row][word_idx]))))
+                positions.append((row, word_idx))
+            candidates = [self.candidator.get_candidates(spelled_word.text, [spelled_word])[0]
+                          for spelled_word in spelled_words]
+            candidate_ids, candidate_mask = tag_and_pick.encode_candidates(self.tokenizer, candidates, self.device)
+            scores = self.model.pick(word_states[rows, word_ids], candidate_ids, candidate_mask)
+            picked = scores.argmax(dim=-1).tolist()
+
+        for (row, word_idx), cands, cand_idx in zip(positions, candidates, picked):
+            if cand_idx < len(cands):
+                words_batch[row][word_idx] = cands[cand_idx]
+        return [' '.join(words) for words in words_batch]
+
 
 def is_needed_to_add_dot_to_end(s: string):
     if len(s) == 0:
@@ -402,10 +695,18 @@ def is_needed_to_add_dot_to_end(s: string):
 
 
 class BartSepMaskAllChecker(SpellCheckModelBase):
+    folds_caps = True
 
+    # candidator: constrained mode, output is the input with every mask replaced by one of its candidates
+    # (or the spelled word itself), so beam search can be replaced with a few beams or greedy decoding
     def __init__(self, checkpoint: str = 'No learning', model: BartForConditionalGeneration = None,
-                 device: torch.device = None, tokenizer: RobertaTokenizer = None):
+                 device: torch.device = None, tokenizer: RobertaTokenizer = None,
+                 candidator: Optional[BaseCandidator] = None, decoding_policy: Optional[DecodingPolicy] = None):
         self.checkpoint = checkpoint
+        self.candidator = candidator
+        if decoding_policy is None:
+            decoding_policy = DecodingPolicy() if candidator is None else DecodingPolicy(num_beams=1)
+        self.decoding_policy = decoding_policy
         transformers.set_seed(42)
         if tokenizer is None:
             self.tokenizer = BartTokenizer.from_pretrained('facebook/bart-base')
@@ -440,6 +741,43 @@ class BartSepMaskAllChecker(SpellCheckModelBase):
         self.tokenizer = BartTokenizer.from_pretrained('melnikoff-oleg/distilbart-sep-mask-all')
 
     def correct(self, text: str) -> str:
+        return self.correct_strings([text])[0]
+
+    def correct_strings(self, texts: List[str]) -> List[str]:
+        # one padded generate call for all texts
+        if len(texts) == 0:
+            return []
+        tasks, caps, constraints, num_errors = [], [], [], 0
+        for text in texts:
+            task, text_caps, spells, constraint = self._make_task(text)
+            tasks.append(task)
+            caps.append(text_caps)
+            constraints.append(constraint)
+            num_errors = max(num_errors, len(spells))
+
+        # print('Tokenized text:', self.tokenizer(tasks, return_tensors='pt')["input_ids"])
+
+        batch = self.tokenizer(tasks, return_tensors='pt', padding=True).to(self.device)
+        generate_kwargs = self.decoding_policy.generate_kwargs(batch["input_ids"].shape[1], num_errors)
+        if self.candidator is None:
+            ans_ids = self.model.generate(batch["input_ids"], attention_mask=batch["attention_mask"],
+                                          **generate_kwargs)
+        else:
+            # copied text may repeat n-grams and may be shorter than 5 tokens
+            generate_kwargs['min_length'] = 0
+            ans_ids = self.model.generate(batch["input_ids"], attention_mask=batch["attention_mask"],
+                                          no_repeat_ngram_size=0,
+                                          prefix_allowed_tokens_fn=lambda batch_id, ids: constraints[batch_id](
+                                              batch_id, ids),
+                                          **generate_kwargs)
+        results = self.tokenizer.batch_decode(ans_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+        # print('Res text:', results)
+
+        return [result.upper() if text_caps else result for result, text_caps in zip(results, caps)]
+
+    def _make_task(self, text: str) -> Tuple[str, bool, List[SpelledWord], Optional[CopyConstraint]]:
+        # (model input, caps flag, detected spells, constraint of constrained mode)
 
         # CAPS handling
         caps = (text.upper() == text)
@@ -452,6 +790,7 @@ class BartSepMaskAllChecker(SpellCheckModelBase):
         #     text += '.'
 
         spells = self.detector.detect(text)
+        constraint = self.copy_constraint(text, spells) if self.candidator is not None else None
 
         # Надо подравить инференс на все токены
         shift = 0
@@ -464,17 +803,96 @@ class BartSepMaskAllChecker(SpellCheckModelBase):
                 pref += ' </s> '
         text = pref + ' </s> ' + text
         # print('Input text:', text)
-        # from time import sleep
-        # sleep(5)
 
-        # print('Tokenized text:', self.tokenizer([text], return_tensors='pt')["input_ids"])
+        return text, caps, spells, constraint
+
+    def copy_constraint(self, text: str, spells: List[SpelledWord]) -> CopyConstraint:
+        candidates = self.candidator.get_candidates(text, spells)
+        # the spelled word is kept as a candidate, detector may be wrong
+        candidates = [list(dict.fromkeys(cands + [spell.word])) for spell, cands in zip(spells, candidates)]
+        return CopyConstraint.from_spells(self.tokenizer, text, [spell.interval for spell in spells], candidates)
+
+
+SPAN_SEP_TOKEN = '<sep>'
 
-        ans_ids = self.model.generate(self.tokenizer([text], return_tensors='pt').to(self.device)["input_ids"],
-                                      num_beams=5, min_length=5, max_length=500)
-        ans_tokens = self.tokenizer.batch_decode(ans_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-        text = ' '.join(ans_tokens)
 
-        # print('Res text:', text)
+class BartSepMaskSpansChecker(SpellCheckModelBase):
+    folds_caps = True
+
+    # Input is the same as for BartSepMaskAllChecker, but decoder writes only the words in place of masks,
+    # separated with SPAN_SEP_TOKEN, and they are put back into the text at the detected intervals
+
+    def __init__(self, checkpoint: str = 'No learning', model: BartForConditionalGeneration = None,
+                 device: torch.device = None, tokenizer: RobertaTokenizer = None,
+                 decoding_policy: Optional[DecodingPolicy] = None):
+        self.checkpoint = checkpoint
+        self.decoding_policy = decoding_policy if decoding_policy is not None else DecodingPolicy()
+        transformers.set_seed(42)
+        if tokenizer is None:
+            self.tokenizer = BartTokenizer.from_pretrained('facebook/bart-base')
+            self.tokenizer.add_tokens([SPAN_SEP_TOKEN])
+        else:
+            self.tokenizer = tokenizer
+        self.detector = HunspellDetector()
+        if device is None:
+            self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        else:
+            self.device = device
+
+        if model is not None:
+            self.model = model
+        else:
+            if checkpoint == 'No learning':
+                self.model = BartForConditionalGeneration.from_pretrained('facebook/bart-base')
+                self.model.resize_token_embeddings(len(self.tokenizer))
+            else:
+                config = BartForConditionalGeneration.from_pretrained('facebook/bart-base').config
+                self.model = BartForConditionalGeneration(config)
+                self.model.resize_token_embeddings(len(self.tokenizer))
+                # Model was trained on GPU, maybe we are inferring on CPU
+                if self.device == torch.device('cpu'):
+                    self.model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+                else:
+                    self.model.load_state_dict(torch.load(checkpoint))
+
+        self.model = self.model.to(self.device)
+
+    def __str__(self):
+        return f'BART spans, checkpoint: {self.checkpoint.split("/")[-1]}'
+
+    def correct(self, text: str) -> str:
+
+        # CAPS handling
+        caps = (text.upper() == text)
+        if caps:
+            text = text.lower()
+
+        spells = self.detector.detect(text)
+        if len(spells) == 0:
+            return text.upper() if caps else text
+
+        shift = 0
+        masked_text = text
+        for spell in spells:
+            masked_text = masked_text[: shift + spell.interval[0]] + '<mask>' + \
+                          masked_text[shift + spell.interval[1]:]
+            shift += 6 - len(spell.word)
+        task = ' </s> '.join(spell.word for spell in spells) + ' </s> ' + masked_text
+
+        # few tokens per replaced word instead of the whole sentence
+        max_length = 2 + sum(len(self.tokenizer.tokenize(' ' + spell.word)) + 4 for spell in spells)
+        input_ids = self.tokenizer([task], return_tensors='pt').to(self.device)["input_ids"]
+        generate_kwargs = self.decoding_policy.generate_kwargs(input_ids.shape[1], len(spells))
+        generate_kwargs['min_length'] = 0
+        generate_kwargs['max_length'] = min(generate_kwargs['max_length'], max_length)
+        ans_ids = self.model.generate(input_ids, no_repeat_ngram_size=0, **generate_kwargs)
+        answer = self.tokenizer.decode(ans_ids[0], skip_special_tokens=True, clean_up_tokenization_spaces=False)
+        spans = [span.strip() for span in answer.split(SPAN_SEP_TOKEN)]
+
+        # put replacements from the end, so intervals of previous words stay valid
+        for idx in reversed(range(len(spells))):
+            if idx < len(spans) and len(spans[idx]) > 0:
+                text = text[: spells[idx].interval[0]] + spans[idx] + text[spells[idx].interval[1]:]
 
         if caps:
             text = text.upper()
@@ -483,14 +901,16 @@ class BartSepMaskAllChecker(SpellCheckModelBase):
 
 
 class CharBasedSepMask(SpellCheckModelBase):
+    folds_caps = True
 
     class BartTokenizer(RobertaTokenizer):
         vocab_files_names = {"vocab_file": PATH_PREFIX + "data_utils/char_based_transformer_vocab/vocab.json",
                              "merges_file": PATH_PREFIX + "data_utils/char_based_transformer_vocab/merges.txt"}
 
     def __init__(self, config: dict = None, checkpoint: str = 'No learning', model: BartForConditionalGeneration = None,
-                 device: torch.device = None):
+                 device: torch.device = None, decoding_policy: Optional[DecodingPolicy] = None):
         self.checkpoint = checkpoint
+        self.decoding_policy = decoding_policy if decoding_policy is not None else DecodingPolicy()
         transformers.set_seed(42)
         self.tokenizer = CharBasedTransformerChecker.BartTokenizer(
             PATH_PREFIX + "data_utils/char_based_transformer_vocab/url_vocab.json",
@@ -544,8 +964,8 @@ class CharBasedSepMask(SpellCheckModelBase):
                 print('Cur text:', text)
                 print(f'New spell:|{spells[spell_ind].word}|')
             new_text = new_text.replace(' ', '_')
-            ans_ids = self.model.generate(self.tokenizer([new_text], return_tensors='pt').to(self.device)["input_ids"],
-                                      num_beams=5, min_length=5, max_length=500)
+            input_ids = self.tokenizer([new_text], return_tensors='pt').to(self.device)["input_ids"]
+            ans_ids = self.model.generate(input_ids, **self.decoding_policy.generate_kwargs(input_ids.shape[1], len(spells)))
             ans_tokens = self.tokenizer.batch_decode(ans_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
             for ind, i in enumerate(ans_tokens):
                 ans_tokens[ind] = ans_tokens[ind].replace('_', ' ')[7:].split('<')[0]
@@ -566,8 +986,9 @@ class CharBasedSepMask(SpellCheckModelBase):
 class MaskWordBartChecker(SpellCheckModelBase):
 
     def __init__(self, checkpoint: str = 'No learning', model: BartForConditionalGeneration = None,
-                 device: torch.device = None):
+                 device: torch.device = None, decoding_policy: Optional[DecodingPolicy] = None):
         self.checkpoint = checkpoint
+        self.decoding_policy = decoding_policy if decoding_policy is not None else DecodingPolicy()
         transformers.set_seed(42)
         self.tokenizer = BartTokenizer.from_pretrained('facebook/bart-base')
         if device is None:
@@ -608,8 +1029,8 @@ class MaskWordBartChecker(SpellCheckModelBase):
             spell_ind = random.randint(0, len(spells) - 1)
             new_text = spells[spell_ind].word + ' <sep> ' + text[: spells[spell_ind].interval[0]] + '<mask>'+ text[spells[spell_ind].interval[1]: ]
             print(f'Task: |{new_text}|')
-            ans_ids = self.model.generate(self.tokenizer([new_text], return_tensors='pt').to(self.device)["input_ids"],
-                                      num_beams=5, min_length=5, max_length=500)
+            input_ids = self.tokenizer([new_text], return_tensors='pt').to(self.device)["input_ids"]
+            ans_ids = self.model.generate(input_ids, **self.decoding_policy.generate_kwargs(input_ids.shape[1], len(spells)))
             ans_tokens = self.tokenizer.batch_decode(ans_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
             corr_word = ' '.join(ans_tokens)
             print( f'Corr word: |{corr_word}|')
@@ -0,0 +1,116 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+import pyarrow as pa
+from tqdm import tqdm
+
+from data_utils.utils import get_texts_from_file
+from model.base import SpelledWord
+from model.candidator import BaseCandidator, HunspellCandidator
+from model.detector import BaseDetector, HunspellDetector
+PATH_PREFIX = '/home/ubuntu/omelnikov/spellchecker/'
+
+STAGE_STORE_SCHEMA = pa.schema([
+    ('text', pa.string()),
+    ('starts', pa.list_(pa.int32())),
+    ('ends', pa.list_(pa.int32())),
+    ('candidates', pa.list_(pa.list_(pa.string()))),
+])
+
+
+def detector_input(text: str) -> str:
+    # DetectorCandidatorRanker.correct gives the detector lowercased text if the text is all caps
+    return text.lower() if text.upper() == text else text
+
+
+def build_stage_store(detector: BaseDetector, candidator: BaseCandidator, texts: List[str], path: str,
+                      batch_size: int = 1000):
+    # runs detection and candidate generation once over texts and writes an Arrow IPC file, one row per text
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    metadata = {'detector': type(detector).__name__, 'candidator': type(candidator).__name__}
+    with pa.OSFile(path, 'wb') as sink, \
+            pa.ipc.new_file(sink, STAGE_STORE_SCHEMA.with_metadata(metadata)) as writer:
+        for start in tqdm(range(0, len(texts), batch_size), desc='Detection and candidates'):
+            batch_texts = [detector_input(text) for text in texts[start: start + batch_size]]
+            rows = {'text': batch_texts, 'starts': [], 'ends': [], 'candidates': []}
+            for text, spelled_words in zip(batch_texts, detector.detect_batch(batch_texts)):
+                rows['starts'].append([spelled_word.interval[0] for spelled_word in spelled_words])
+                rows['ends'].append([spelled_word.interval[1] for spelled_word in spelled_words])
+                rows['candidates'].append(candidator.get_candidates(text, spelled_words))
+            writer.write_batch(pa.RecordBatch.from_pydict(rows, schema=STAGE_STORE_SCHEMA))
+
+
+class StageStore:
+    """
+    Detector and candidator outputs of a corpus, read memory-mapped from a file of build_stage_store.
+    Only the text column is read at load to index rows, spells and candidates of a row are decoded on request.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+        self.metadata = {key.decode(): value.decode() for key, value in (self.table.schema.metadata or {}).items()}
+        # the first row wins for repeated texts, they have the same outputs
+        self._rows: Dict[str, int] = {}
+        for row, text in enumerate(self.table.column('text').to_pylist()):
+            self._rows.setdefault(text, row)
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def __contains__(self, text: str) -> bool:
+        return text in self._rows
+
+    def spelled_words(self, text: str) -> List[SpelledWord]:
+        row = self._rows[text]
+        starts, ends = self.table.column('starts')[row].as_py(), self.table.column('ends')[row].as_py()
+        return [SpelledWord(text, (start, end)) for start, end in zip(starts, ends)]
+
+    def candidates(self, text: str) -> Dict[Tuple[int, int], List[str]]:
+        # interval of every spelled word -> its candidates
+        row = self._rows[text]
+        starts, ends = self.table.column('starts')[row].as_py(), self.table.column('ends')[row].as_py()
+        return dict(zip(zip(starts, ends), self.table.column('candidates')[row].as_py()))
+
+
+class StoredDetector(BaseDetector):
+    # replays detections from a StageStore, texts missing in the store go to fallback if it's given
+    def __init__(self, store: StageStore, fallback: Optional[BaseDetector] = None):
+        super().__init__()
+        self.store = store
+        self.fallback = fallback
+
+    def detect(self, text: str, **kwargs) -> List[SpelledWord]:
+        if text in self.store or self.fallback is None:
+            return self.store.spelled_words(text)
+        return self.fallback.detect(text, **kwargs)
+
+
+class StoredCandidator(BaseCandidator):
+    # replays candidates from a StageStore, spelled words which weren't stored go to fallback if it's given
+    def __init__(self, store: StageStore, fallback: Optional[BaseCandidator] = None):
+        self.store = store
+        self.fallback = fallback
+
+    def get_candidates(self, text: str, spelled_words: List[SpelledWord], **kwargs) -> List[List[str]]:
+        stored = self.store.candidates(text) if text in self.store else {}
+        candidates = [stored.get(tuple(spelled_word.interval)) for spelled_word in spelled_words]
+        missing = [spelled_word for spelled_word, cands in zip(spelled_words, candidates) if cands is None]
+        if len(missing) > 0:
+            if self.fallback is None:
+                raise KeyError(f'No stored candidates for {missing}')
+            missing_candidates = iter(self.fallback.get_candidates(text, missing, **kwargs))
+            candidates = [cands if cands is not None else next(missing_candidates) for cands in candidates]
+        return candidates
+
+
+def main():
+    texts_noise = get_texts_from_file(PATH_PREFIX + 'dataset/bea/bea60k.noise')
+    build_stage_store(HunspellDetector(), HunspellCandidator(), texts_noise,
+                      PATH_PREFIX + 'dataset/stage_store/bea60k_hunspell.arrow')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+from typing import Dict, List, Tuple
+
+import torch
+from torch import nn
+from transformers import AutoModel, AutoTokenizer
+
+
+class TagAndPickModel(nn.Module):
+    """
+    Non-autoregressive corrector: one encoder pass gives a state of every word, tag head decides keep / replace
+    and pick head scores candidates of replaced words against the word state. Candidates are embedded as mean of
+    their subword input embeddings, so picking needs no second encoder pass.
+    """
+
+    def __init__(self, encoder_checkpoint: str = 'distilbert-base-uncased'):
+        super().__init__()
+        self.encoder_checkpoint = encoder_checkpoint
+        self.encoder = AutoModel.from_pretrained(encoder_checkpoint)
+        hidden = self.encoder.config.hidden_size
+        self.tag_head = nn.Linear(hidden, 2)
+        self.pick_query = nn.Linear(hidden, hidden)
+        self.candidate_projection = nn.Linear(hidden, hidden)
+
+    def encode(self, input_ids: torch.Tensor, attention_mask: torch.Tensor,
+               word_index: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # word states [batch, words, hidden] taken from first subwords, tag logits [batch, words, 2]
+        hidden_states = self.encoder(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+        word_states = hidden_states.gather(1, word_index.unsqueeze(-1).expand(-1, -1, hidden_states.shape[-1]))
+        return word_states, self.tag_head(word_states)
+
+    def pick(self, word_states: torch.Tensor, candidate_ids: torch.Tensor,
+             candidate_mask: torch.Tensor) -> torch.Tensor:
+        # word_states [n, hidden], candidate subwords [n, candidates, len] -> scores [n, candidates]
+        embeddings = self.encoder.get_input_embeddings()(candidate_ids) * candidate_mask.unsqueeze(-1)
+        lengths = candidate_mask.sum(dim=-1, keepdim=True)
+        candidates = self.candidate_projection(embeddings.sum(dim=2) / lengths.clamp(min=1))
+        scores = torch.einsum('nh,nch->nc', self.pick_query(word_states), candidates)
+        return scores.masked_fill(lengths.squeeze(-1) == 0, float('-inf'))
+
+    def save(self, path: str):
+        torch.save({'encoder_checkpoint': self.encoder_checkpoint, 'state_dict': self.state_dict()}, path)
+
+    @classmethod
+    def load(cls, path: str, device: torch.device = torch.device('cpu')) -> 'TagAndPickModel':
+        checkpoint: Dict = torch.load(path, map_location=device)
+        model = cls(checkpoint['encoder_checkpoint'])
+        model.load_state_dict(checkpoint['state_dict'])
+        return model.to(device)
+
+
+def encode_words(tokenizer: AutoTokenizer, words_batch: List[List[str]],
+                 device: torch.device) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    # input ids, attention mask, index of the first subword of every word [batch, words] and mask of words
+    # which survived truncation
+    encoding = tokenizer(words_batch, truncation=True, is_split_into_words=True, padding=True, return_tensors='pt')
+    max_words = max(max(len(words) for words in words_batch), 1)
+    word_index = torch.zeros(len(words_batch), max_words, dtype=torch.long)
+    word_mask = torch.zeros(len(words_batch), max_words, dtype=torch.bool)
+    for i in range(len(words_batch)):
+        previous_word_id = None
+        for token_idx, word_id in enumerate(encoding.word_ids(batch_index=i)):
+            if word_id is not None and word_id != previous_word_id:
+                word_index[i, word_id] = token_idx
+                word_mask[i, word_id] = True
+            previous_word_id = word_id
+    return encoding['input_ids'].to(device), encoding['attention_mask'].to(device), word_index.to(device), \
+        word_mask.to(device)
+
+
+def encode_candidates(tokenizer: AutoTokenizer, candidates: List[List[str]], device: torch.device,
+                      max_candidates: int = 10, max_len: int = 8) -> Tuple[torch.Tensor, torch.Tensor]:
+    # subword ids [words, max_candidates, max_len] and their mask, padding candidates have empty mask
+    candidate_ids = torch.zeros(len(candidates), max_candidates, max_len, dtype=torch.long)
+    candidate_mask = torch.zeros(len(candidates), max_candidates, max_len, dtype=torch.bool)
+    for i, cands in enumerate(candidates):
+        for j, cand in enumerate(cands[:max_candidates]):
+            ids = tokenizer.encode(cand, add_special_tokens=False)[:max_len]
+            candidate_ids[i, j, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            candidate_mask[i, j, :len(ids)] = True
+    return candidate_ids.to(device), candidate_mask.to(device)
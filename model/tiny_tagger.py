@@ -0,0 +1,64 @@
+from typing import Dict, List, Tuple
+
+import torch
+from torch import nn
+
+
+# char ids: 0 - padding, 1 - unknown char, 2.. - chars with code < 256
+CHAR_VOCAB_SIZE = 258
+
+
+def char_id(char: str) -> int:
+    code = ord(char)
+    return code + 2 if code < 256 else 1
+
+
+def encode_words(words_batch: List[List[str]], max_word_len: int = 20) -> Tuple[torch.Tensor, torch.Tensor]:
+    # char ids [batch, words, max_word_len] and word mask [batch, words]
+    max_words = max([len(words) for words in words_batch] + [1])
+    padding_word = [0] * max_word_len
+    char_ids = [[[char_id(char) for char in word[:max_word_len]] + [0] * (max_word_len - len(word[:max_word_len]))
+                 for word in words] + [padding_word] * (max_words - len(words)) for words in words_batch]
+    mask = [[True] * len(words) + [False] * (max_words - len(words)) for words in words_batch]
+    char_ids, mask = torch.tensor(char_ids, dtype=torch.long), torch.tensor(mask, dtype=torch.bool)
+    return char_ids, mask
+
+
+class TinyTagger(nn.Module):
+    """
+    Word-level error tagger small enough for CPU: char CNN gives a vector of every word,
+    BiLSTM over words adds the sentence context, linear layer gives an error logit per word.
+    """
+
+    def __init__(self, char_dim: int = 32, filters: int = 64, kernel_size: int = 3, hidden: int = 64,
+                 max_word_len: int = 20):
+        super().__init__()
+        self.config = {'char_dim': char_dim, 'filters': filters, 'kernel_size': kernel_size, 'hidden': hidden,
+                       'max_word_len': max_word_len}
+        self.max_word_len = max_word_len
+        self.char_embedding = nn.Embedding(CHAR_VOCAB_SIZE, char_dim, padding_idx=0)
+        self.char_cnn = nn.Conv1d(char_dim, filters, kernel_size, padding=kernel_size // 2)
+        self.lstm = nn.LSTM(filters, hidden, batch_first=True, bidirectional=True)
+        self.classifier = nn.Linear(2 * hidden, 1)
+
+    def forward(self, char_ids: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        # error logits [batch, words], padding words get -inf
+        batch_size, num_words, word_len = char_ids.shape
+        chars = self.char_embedding(char_ids.view(batch_size * num_words, word_len)).transpose(1, 2)
+        words = torch.relu(self.char_cnn(chars)).max(dim=2).values.view(batch_size, num_words, -1)
+        # packed, so padding words don't reach the backward direction and logits don't depend on the batch
+        lengths = mask.sum(dim=1).clamp(min=1).cpu()
+        packed = nn.utils.rnn.pack_padded_sequence(words, lengths, batch_first=True, enforce_sorted=False)
+        context, _ = nn.utils.rnn.pad_packed_sequence(self.lstm(packed)[0], batch_first=True, total_length=num_words)
+        logits = self.classifier(context).squeeze(-1)
+        return logits.masked_fill(~mask, float('-inf'))
+
+    def save(self, path: str):
+        torch.save({'config': self.config, 'state_dict': self.state_dict()}, path)
+
+    @classmethod
+    def load(cls, path: str, device: torch.device = torch.device('cpu')) -> 'TinyTagger':
+        checkpoint: Dict = torch.load(path, map_location=device)
+        model = cls(**checkpoint['config'])
+        model.load_state_dict(checkpoint['state_dict'])
+        return model.to(device)
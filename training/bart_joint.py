@@ -0,0 +1,33 @@
+from model.spellcheck_model import JointBartChecker
+from model.joint_bart import encode_joint_batch
+from training.common_parts import joint_bart_model_init, get_end_2_end_training_dataset, launch_training
+# PATH_PREFIX = '/Users/olegmelnikov/PycharmProjects/spellchecker/'
+PATH_PREFIX = '/home/ubuntu/omelnikov/spellchecker/'
+
+
+def main():
+    # data and model prep: end-to-end pairs, detection labels come from words which differ
+    train_data, val_data = get_end_2_end_training_dataset()
+    tokenizer, model = joint_bart_model_init()
+
+    # set important learning params ------------------------------------------
+    device_name = 'cuda:0'
+    model_version = 0
+    model_name = 'bart-joint-detection-correction'
+    lr = 0.00005
+    test_mode = False
+    batch_size = 32
+    num_epochs = 2
+    print_n_batches = 2000
+    st_epoch = 0
+    spellcheck_class = JointBartChecker
+    save_model_interval = 30000
+
+    # setup all remaining parts for learning
+    launch_training(model, tokenizer, train_data, val_data, batch_size, print_n_batches,
+                    num_epochs, st_epoch, model_name, spellcheck_class, device_name, test_mode, model_version,
+                    save_model_interval, lr, checkpoint=None, encode_batch=encode_joint_batch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+from model.spellcheck_model import BartSepMaskSpansChecker, SPAN_SEP_TOKEN
+from training.common_parts import bart_model_init, get_sep_mask_spans_training_dataset, launch_training
+# PATH_PREFIX = '/Users/olegmelnikov/PycharmProjects/spellchecker/'
+PATH_PREFIX = '/home/ubuntu/omelnikov/spellchecker/'
+
+
+def main():
+    # data and model prep
+    train_data, val_data = get_sep_mask_spans_training_dataset()
+    tokenizer, model = bart_model_init()
+    tokenizer.add_tokens([SPAN_SEP_TOKEN])
+    model.resize_token_embeddings(len(tokenizer))
+
+    # set important learning params ------------------------------------------
+    device_name = 'cuda:0'
+    model_version = 0
+    model_name = 'bart-sep-mask-spans'
+    lr = 0.0001
+    test_mode = False
+    batch_size = 32
+    num_epochs = 2
+    print_n_batches = 2000
+    st_epoch = 0
+    spellcheck_class = BartSepMaskSpansChecker
+    save_model_interval = 30000
+
+    # setup all remaining parts for learning
+    launch_training(model, tokenizer, train_data, val_data, batch_size, print_n_batches,
+                    num_epochs, st_epoch, model_name, spellcheck_class, device_name, test_mode, model_version,
+                    save_model_interval, lr, checkpoint=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 from model.spellcheck_model import CharBasedTransformerChecker
+from model.joint_bart import BartForJointDetectionCorrection
 from transformers import BartConfig, BartForConditionalGeneration, BartTokenizer
 from data_utils.utils import get_parallel_texts_from_files
 from transformers import get_cosine_with_hard_restarts_schedule_with_warmup
@@ -31,6 +32,12 @@ def bart_model_init(checkpoint: str = None, config: BartConfig = None):
     return tokenizer, model
 
 
+def joint_bart_model_init():
+    tokenizer = BartTokenizer.from_pretrained('facebook/bart-base')
+    model = BartForJointDetectionCorrection.from_pretrained('facebook/bart-base')
+    return tokenizer, model
+
+
 def bart_distil_model_init(checkpoint, config):
     tokenizer = BartTokenizer.from_pretrained('facebook/bart-base')
     model = BartForConditionalGeneration.from_pretrained(checkpoint, config)
@@ -85,9 +92,19 @@ def get_sep_mask_training_dataset(char_based: bool = False, all_mistakes: bool =
     return train, val
 
 
+def get_sep_mask_spans_training_dataset(char_based: bool = False):
+    train = get_parallel_texts_from_files(file1_path=PATH_PREFIX + 'dataset/1blm/1blm.train.noise.sep_mask_spans',
+                                          file2_path=PATH_PREFIX + 'dataset/1blm/1blm.train.gt.sep_mask_spans',
+                                          char_based=char_based)
+    val = get_parallel_texts_from_files(file1_path=PATH_PREFIX + 'dataset/1blm/1blm.test.noise.sep_mask_spans',
+                                        file2_path=PATH_PREFIX + 'dataset/1blm/1blm.test.gt.sep_mask_spans',
+                                        char_based=char_based)
+    return train, val
+
+
 def launch_training(model, tokenizer, train_data, val_data, batch_size, print_n_batches,
                     num_epochs, st_epoch, model_name, spellcheck_class, device_name, test_mode, model_version,
-                    save_model_interval, lr, checkpoint):
+                    save_model_interval, lr, checkpoint, encode_batch=None):
 
     num_sent = 1000 if test_mode else 1000000000
     train_data = train_data[:num_sent]
@@ -111,4 +128,4 @@ def launch_training(model, tokenizer, train_data, val_data, batch_size, print_n_
                 val_data=val_data, batch_size=batch_size, print_n_batches=print_n_batches, num_epochs=num_epochs,
                 st_epoch=st_epoch, model_name=model_name, spellcheck_class=spellcheck_class,
                 device=device, save_model=not test_mode, use_tensorboard=not test_mode, model_version=model_version,
-                test_mode=test_mode, save_model_interval=save_model_interval)
+                test_mode=test_mode, save_model_interval=save_model_interval, encode_batch=encode_batch)
@@ -0,0 +1,115 @@
+# Training of TagAndPickModel on 1blm end-to-end pairs: tag loss on every word, pick loss on changed words
+import os
+import random
+from typing import List, Tuple
+
+import torch
+from tqdm import tqdm
+from transformers import AutoTokenizer
+
+from model.base import SpelledWord
+from model.candidator import HunspellCandidator
+from model.tag_and_pick import TagAndPickModel, encode_words, encode_candidates
+from model.spellcheck_model import TagAndPickChecker
+from training.common_parts import get_end_2_end_training_dataset
+from data_utils.utils import get_texts_from_file
+from evaluation.evaluate import evaluate
+# PATH_PREFIX = '/Users/olegmelnikov/PycharmProjects/spellchecker/'
+PATH_PREFIX = '/home/ubuntu/omelnikov/spellchecker/'
+
+
+def make_targets(candidator: HunspellCandidator, batch: List[Tuple[str, str]], max_candidates: int):
+    # words, tag labels and for every changed word its candidates with index of the gt word among them;
+    # pairs with different number of words are skipped
+    words_batch, tags, picks = [], [], []
+    for text_noise, text_gt in batch:
+        words_noise, words_gt = text_noise.split(' '), text_gt.split(' ')
+        if len(words_noise) != len(words_gt):
+            continue
+        row, start = len(words_batch), 0
+        words_batch.append(words_noise)
+        tags.append([int(word_noise != word_gt) for word_noise, word_gt in zip(words_noise, words_gt)])
+        for word_idx, (word_noise, word_gt) in enumerate(zip(words_noise, words_gt)):
+            if word_noise != word_gt:
+                spelled_word = SpelledWord(text_noise, (start, start + len(word_noise)))
+                cands = candidator.get_candidates(text_noise, [spelled_word])[0][:max_candidates - 1]
+                if word_gt not in cands:
+                    cands.insert(random.randint(0, len(cands)), word_gt)
+                picks.append((row, word_idx, cands, cands.index(word_gt)))
+            start += len(word_noise) + 1
+    return words_batch, tags, picks
+
+
+def main():
+    # data prep
+    train_data, val_data = get_end_2_end_training_dataset()
+    texts_gt, texts_noise = get_texts_from_file(PATH_PREFIX + 'dataset/bea/bea500.gt'), \
+                            get_texts_from_file(PATH_PREFIX + 'dataset/bea/bea500.noise')
+
+    # set learning params
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    model_name = 'tag-and-pick'
+    model_version = 0
+    lr = 0.00003
+    batch_size = 32
+    num_epochs = 2
+    max_candidates = 10
+    print_n_batches = 2000
+    test_mode = False
+
+    if test_mode:
+        train_data, texts_gt, texts_noise = train_data[:1000], texts_gt[:2], texts_noise[:2]
+    model = TagAndPickModel().to(device)
+    tokenizer = AutoTokenizer.from_pretrained(model.encoder_checkpoint)
+    candidator = HunspellCandidator()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=lr)
+    loss_function = torch.nn.CrossEntropyLoss()
+    checkpoints_dir = f'{PATH_PREFIX}training/checkpoints/'
+    if not os.path.exists(checkpoints_dir):
+        os.makedirs(checkpoints_dir)
+
+    num_batches = (len(train_data) + batch_size - 1) // batch_size
+    for epoch in tqdm(range(num_epochs), desc='Epochs', leave=True):
+        model.train()
+        epoch_loss = 0
+        for i in tqdm(range(num_batches), position=0, leave=True, desc='Batches'):
+            words_batch, tags, picks = make_targets(candidator, train_data[i * batch_size: (i + 1) * batch_size],
+                                                    max_candidates)
+            if len(words_batch) == 0:
+                continue
+            input_ids, attention_mask, word_index, word_mask = encode_words(tokenizer, words_batch, device)
+            word_states, tag_logits = model.encode(input_ids, attention_mask, word_index)
+
+            tag_labels = torch.full(word_mask.shape, -100, dtype=torch.long)
+            for row, row_tags in enumerate(tags):
+                tag_labels[row, :len(row_tags)] = torch.tensor(row_tags)
+            tag_labels = tag_labels.to(device).masked_fill(~word_mask, -100)
+            loss = loss_function(tag_logits.view(-1, 2), tag_labels.view(-1))
+
+            picks = [pick for pick in picks if word_mask[pick[0], pick[1]]]
+            if len(picks) > 0:
+                candidate_ids, candidate_mask = encode_candidates(tokenizer, [pick[2] for pick in picks], device,
+                                                                  max_candidates)
+                rows = torch.tensor([pick[0] for pick in picks], device=device)
+                word_ids = torch.tensor([pick[1] for pick in picks], device=device)
+                scores = model.pick(word_states[rows, word_ids], candidate_ids, candidate_mask)
+                loss = loss + loss_function(scores, torch.tensor([pick[3] for pick in picks], device=device))
+
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            epoch_loss += loss.cpu().item()
+
+            if i % print_n_batches == 0:
+                print(f'Epoch {epoch}, batch {i}, train loss {round(epoch_loss / (i + 1), 4)}')
+                checker = TagAndPickChecker(model=model, device=device, tokenizer=tokenizer, candidator=candidator)
+                evaluate(checker, texts_gt, texts_noise)
+                model.train()
+
+        model_path = f'{checkpoints_dir}{model_name}_v{model_version}_{epoch}.pt'
+        model.save(model_path)
+        print('Model saved in', model_path)
+
+
+if __name__ == '__main__':
+    main()
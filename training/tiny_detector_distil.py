@@ -0,0 +1,109 @@
+# Distillation of BERTDetector into TinyTagger (char CNN + BiLSTM) for CPU inference
+# data: json lines with "tokens", "labels" and "sent" from create_dataset_for_specific_task/tagging.py
+import json
+import os
+import random
+from typing import Dict, List
+
+import torch
+from tqdm import tqdm
+
+from model.detector import BERTDetector
+from model.tiny_tagger import TinyTagger, encode_words
+# PATH_PREFIX = '/Users/olegmelnikov/PycharmProjects/spellchecker/'
+PATH_PREFIX = '/home/ubuntu/omelnikov/spellchecker/'
+
+
+def read_tagging_dataset(path: str) -> List[Dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def distillation_targets(teacher: BERTDetector, batch: List[Dict], alpha: float) -> torch.Tensor:
+    # alpha * teacher probability + (1 - alpha) * gold label, [batch, words] padded with zeros
+    teacher_probs = teacher.word_probs([example['sent'] for example in batch])
+    max_words = max(max(len(example['tokens']) for example in batch), 1)
+    targets = torch.zeros(len(batch), max_words)
+    for i, (example, probs) in enumerate(zip(batch, teacher_probs)):
+        if len(probs) != len(example['tokens']):
+            # sentence tokenized differently from the stored tokens, gold labels only
+            probs = example['labels']
+        soft = [alpha * prob + (1 - alpha) * label for prob, label in zip(probs, example['labels'])]
+        targets[i, :len(soft)] = torch.tensor(soft)
+    return targets
+
+
+def evaluate_tagger(model: TinyTagger, data: List[Dict], device: torch.device, batch_size: int = 256,
+                    threshold: float = 0.5) -> Dict[str, float]:
+    tp, fp, fn = 0, 0, 0
+    model.eval()
+    with torch.no_grad():
+        for batch_start in range(0, len(data), batch_size):
+            batch = data[batch_start: batch_start + batch_size]
+            char_ids, mask = encode_words([example['tokens'] for example in batch], model.max_word_len)
+            predictions = (torch.sigmoid(model(char_ids.to(device), mask.to(device))) > threshold).cpu().tolist()
+            for example, prediction in zip(batch, predictions):
+                for label, predicted in zip(example['labels'], prediction):
+                    tp += int(label == 1 and predicted)
+                    fp += int(label == 0 and predicted)
+                    fn += int(label == 1 and not predicted)
+    model.train()
+    return {
+        'precision': round(tp / (tp + fp), 4) if tp + fp > 0 else 0.0,
+        'recall': round(tp / (tp + fn), 4) if tp + fn > 0 else 0.0,
+    }
+
+
+def main():
+    # data prep
+    train_data = read_tagging_dataset(PATH_PREFIX + 'dataset/1blm/1blm.train.tagging')
+    val_data = read_tagging_dataset(PATH_PREFIX + 'dataset/bea/bea500.tagging')
+
+    # set learning params
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    model_name = 'tiny-detector'
+    model_version = 0
+    lr = 0.001
+    batch_size = 128
+    num_epochs = 3
+    alpha = 0.7
+    print_n_batches = 2000
+
+    teacher = BERTDetector(batch_size=batch_size)
+    model = TinyTagger().to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    loss_function = torch.nn.BCEWithLogitsLoss(reduction='none')
+    checkpoints_dir = f'{PATH_PREFIX}training/checkpoints/'
+    if not os.path.exists(checkpoints_dir):
+        os.makedirs(checkpoints_dir)
+
+    num_batches = (len(train_data) + batch_size - 1) // batch_size
+    for epoch in tqdm(range(num_epochs), desc='Epochs', leave=True):
+        random.shuffle(train_data)
+        epoch_loss = 0
+        for i in tqdm(range(num_batches), position=0, leave=True, desc='Batches'):
+            batch = train_data[i * batch_size: (i + 1) * batch_size]
+            char_ids, mask = encode_words([example['tokens'] for example in batch], model.max_word_len)
+            char_ids, mask = char_ids.to(device), mask.to(device)
+            targets = distillation_targets(teacher, batch, alpha).to(device)
+
+            logits = model(char_ids, mask).masked_fill(~mask, 0)
+            loss = (loss_function(logits, targets) * mask).sum() / mask.sum()
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            epoch_loss += loss.cpu().item()
+
+            if i % print_n_batches == 0:
+                print(f'Epoch {epoch}, batch {i}, train loss {round(epoch_loss / (i + 1), 4)}, '
+                      f'val {evaluate_tagger(model, val_data, device)}')
+
+        model_path = f'{checkpoints_dir}{model_name}_v{model_version}_{epoch}.pt'
+        model.save(model_path)
+        print('Model saved in', model_path)
+
+    print('Final val metrics:', evaluate_tagger(model, val_data, device))
+
+
+if __name__ == '__main__':
+    main()
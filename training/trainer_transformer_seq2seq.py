@@ -17,7 +17,8 @@ PATH_PREFIX = '/home/ubuntu/omelnikov/spellchecker/'
 def train_model(model, tokenizer, optimizer, scheduler, train_data, val_data, batch_size: int = 32,
                 print_n_batches: int = 2000, num_epochs: int = 10, st_epoch: int = 0, model_name: str = 'bart',
                 spellcheck_class=BertBartChecker, device=torch.device('cuda'), save_model=False, use_tensorboard=False,
-                model_version=0, test_mode: bool = True, save_model_interval=None):
+                model_version=0, test_mode: bool = True, save_model_interval=None, encode_batch=None):
+    # encode_batch(tokenizer, prefix, suffix, device) -> model kwargs, replaces the default seq2seq encoding
 
     # Init tensorboard for logs writing
     if use_tensorboard:
@@ -35,9 +36,12 @@ def train_model(model, tokenizer, optimizer, scheduler, train_data, val_data, ba
             batch = train_data[i * batch_size: min(i * batch_size + batch_size, len(train_data))]
             prefix = [i[0] for i in batch]
             suffix = [i[1] for i in batch]
-            encoder_input = tokenizer(prefix, return_tensors='pt', padding=True).to(device)
-            decoder_input = tokenizer(suffix, return_tensors='pt', padding=True).to(device)
-            result = model(**encoder_input, labels=decoder_input['input_ids'])
+            if encode_batch is None:
+                encoder_input = tokenizer(prefix, return_tensors='pt', padding=True).to(device)
+                decoder_input = tokenizer(suffix, return_tensors='pt', padding=True).to(device)
+                result = model(**encoder_input, labels=decoder_input['input_ids'])
+            else:
+                result = model(**encode_batch(tokenizer, prefix, suffix, device))
             loss = result.loss
             loss.backward()
             optimizer.step()
@@ -82,9 +86,12 @@ def train_model(model, tokenizer, optimizer, scheduler, train_data, val_data, ba
                         num_objects += len(batch)
                         prefix = [k[0] for k in batch]
                         suffix = [k[1] for k in batch]
-                        encoder_input = tokenizer(prefix, return_tensors='pt', padding=True).to(device)
-                        decoder_input = tokenizer(suffix, return_tensors='pt', padding=True).to(device)
-                        result = model(**encoder_input, labels=decoder_input['input_ids'])
+                        if encode_batch is None:
+                            encoder_input = tokenizer(prefix, return_tensors='pt', padding=True).to(device)
+                            decoder_input = tokenizer(suffix, return_tensors='pt', padding=True).to(device)
+                            result = model(**encoder_input, labels=decoder_input['input_ids'])
+                        else:
+                            result = model(**encode_batch(tokenizer, prefix, suffix, device))
 
                         loss = result.loss
                         val_loss += loss.cpu().item()